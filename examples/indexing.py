@@ -0,0 +1,49 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import argparse
+import os
+import yaml
+
+from pikerag.knowledge_retrievers import BaseQaRetriever
+from pikerag.utils.config_loader import load_class, load_dot_env
+from pikerag.utils.logger import Logger
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build up the vector stores of the retriever in the QA yaml config.")
+    parser.add_argument("config", type=str, help="the path of the yaml config file you want to use")
+    parser.add_argument("--batch-size", type=int, default=None, help="the number of documents per embedding batch")
+    parser.add_argument("--num-workers", type=int, default=None, help="the number of parallel embedding workers")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as fin:
+        yaml_config: dict = yaml.safe_load(fin)
+
+    load_dot_env(env_path=yaml_config.get("dotenv_path", None))
+
+    log_dir = os.path.join(yaml_config["log_root_dir"], yaml_config["experiment_name"])
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    # Build up the collections with the resumable pipelined builder, re-run the same command to resume if killed.
+    retriever_config: dict = yaml_config["retriever"]
+    assert "vector_store" in retriever_config["args"], "No vector store configured in the retriever to build up!"
+    vector_store_config: dict = retriever_config["args"]["vector_store"]
+    build_config: dict = vector_store_config.get("bulk_build", None) or {}
+    if args.batch_size is not None:
+        build_config["batch_size"] = args.batch_size
+    if args.num_workers is not None:
+        build_config["num_workers"] = args.num_workers
+    vector_store_config["bulk_build"] = build_config
+
+    retriever_class = load_class(
+        module_path=retriever_config["module_path"],
+        class_name=retriever_config["class_name"],
+        base_class=BaseQaRetriever,
+    )
+    retriever_class(
+        retriever_config=retriever_config["args"],
+        log_dir=log_dir,
+        main_logger=Logger(name="indexing", dump_folder=log_dir),
+    )
@@ -2,6 +2,7 @@
 # Licensed under the MIT license.
 
 import math
+import os
 from functools import partial
 from typing import List, Tuple
 
@@ -9,7 +10,9 @@ from langchain_chroma import Chroma
 from langchain_core.documents import Document
 
 from pikerag.knowledge_retrievers.base_qa_retriever import BaseQaRetriever
-from pikerag.knowledge_retrievers.mixins.chroma_mixin import ChromaMetaType, ChromaMixin, load_vector_store
+from pikerag.knowledge_retrievers.mixins.chroma_mixin import (
+    ChromaMetaType, ChromaMixin, fit_compression_projection, load_compression_config, load_vector_store,
+)
 from pikerag.utils.config_loader import load_callable, load_embedding_func
 from pikerag.utils.logger import Logger
 from pikerag.workflows.common import BaseQaData
@@ -24,10 +27,18 @@ def load_vector_store_from_configs(
     if persist_directory is None:
         persist_directory = vector_store_config["persist_directory"]
 
+    embedding_args: dict = dict(embedding_config.get("args", {}))
+    compression_config, compression_tag = load_compression_config(
+        vector_store_config.get("compression", None), os.path.join(persist_directory, collection_name),
+    )
+    if compression_config is not None:
+        embedding_args["compression_config"] = compression_config
+        collection_name = f"{collection_name}_{compression_tag}"
+
     embedding = load_embedding_func(
         module_path=embedding_config.get("module_path", None),
         class_name=embedding_config.get("class_name", None),
-        **embedding_config.get("args", {}),
+        **embedding_args,
     )
 
     loading_configs: dict = vector_store_config["id_document_loading"]
@@ -35,10 +46,18 @@ def load_vector_store_from_configs(
         module_path=loading_configs["module_path"],
         name=loading_configs["func_name"],
     )(**loading_configs.get("args", {}))
+    fit_compression_projection(embedding, documents)
 
     exist_ok = vector_store_config.get("exist_ok", True)
-
-    vector_store = load_vector_store(collection_name, persist_directory, embedding, documents, ids, exist_ok)
+    sync_mode = vector_store_config.get("sync_mode", "rebuild")
+    build_config = vector_store_config.get("bulk_build", None)
+    backend = vector_store_config.get("backend", "chroma")
+    numpy_config = vector_store_config.get("numpy_config", None)
+
+    vector_store = load_vector_store(
+        collection_name, persist_directory, embedding, documents, ids, exist_ok,
+        sync_mode=sync_mode, build_config=build_config, backend=backend, numpy_config=numpy_config,
+    )
     return vector_store
 
 
@@ -105,9 +124,14 @@ class QaChunkRetriever(BaseQaRetriever, ChromaMixin):
         queries: List[str] = self._query_parser(qa)
         retrieve_k = math.ceil(self.retrieve_k / len(queries))
 
+        # Search with all the queries in one batch.
+        chunk_infos_list = self._get_docs_with_queries(
+            queries, self.vector_store, retrieve_k, self.retrieve_score_threshold,
+        )
+
         all_chunks: List[str] = []
-        for query in queries:
-            chunks = self.retrieve_contents_by_query(query, retrieve_id, retrieve_k=retrieve_k)
+        for chunk_infos in chunk_infos_list:
+            chunks = self._get_relevant_strings(chunk_infos, retrieve_id)
             all_chunks.extend(chunks)
 
         if len(all_chunks) > 0:
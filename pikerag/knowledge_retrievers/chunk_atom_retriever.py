@@ -1,6 +1,7 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
+import os
 from dataclasses import dataclass
 from typing import Any, Dict, List, Tuple, Union
 
@@ -11,7 +12,9 @@ from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
 
 from pikerag.knowledge_retrievers.base_qa_retriever import BaseQaRetriever
-from pikerag.knowledge_retrievers.mixins.chroma_mixin import ChromaMixin, load_vector_store
+from pikerag.knowledge_retrievers.mixins.chroma_mixin import (
+    ChromaMixin, fit_compression_projection, load_compression_config, load_vector_store,
+)
 from pikerag.utils.config_loader import load_callable, load_embedding_func
 from pikerag.utils.logger import Logger
 
@@ -64,12 +67,26 @@ class ChunkAtomRetriever(BaseQaRetriever, ChromaMixin):
         if persist_directory is None:
             persist_directory = self._log_dir
         exist_ok = vector_store_config.get("exist_ok", True)
+        sync_mode = vector_store_config.get("sync_mode", "rebuild")
+        build_config = vector_store_config.get("bulk_build", None)
+        backend = vector_store_config.get("backend", "chroma")
+        numpy_config = vector_store_config.get("numpy_config", None)
 
+        # The chunks and the atoms are compressed in the same way since their similarities are compared.
         embedding_config = vector_store_config.get("embedding_setting", {})
+        embedding_args: dict = dict(embedding_config.get("args", {}))
+        compression_config, compression_tag = load_compression_config(
+            vector_store_config.get("compression", None), os.path.join(persist_directory, collection_name),
+        )
+        if compression_config is not None:
+            embedding_args["compression_config"] = compression_config
+            doc_collection_name = f"{doc_collection_name}_{compression_tag}"
+            atom_collection_name = f"{atom_collection_name}_{compression_tag}"
+
         self.embedding_func: Embeddings = load_embedding_func(
             module_path=embedding_config.get("module_path", None),
             class_name=embedding_config.get("class_name", None),
-            **embedding_config.get("args", {}),
+            **embedding_args,
         )
 
         self.similarity_func = lambda x, y: np.dot(x, y) / (np.linalg.norm(x) * np.linalg.norm(y))
@@ -79,6 +96,16 @@ class ChunkAtomRetriever(BaseQaRetriever, ChromaMixin):
             module_path=loading_configs["module_path"],
             name=loading_configs["func_name"],
         )(**loading_configs.get("args", {}))
+
+        loading_configs = vector_store_config["id_atom_loading"]
+        atom_ids, atoms = load_callable(
+            module_path=loading_configs["module_path"],
+            name=loading_configs["func_name"],
+        )(**loading_configs.get("args", {}))
+
+        # The projection shared by the chunks and the atoms is fitted on both of them.
+        fit_compression_projection(self.embedding_func, list(docs) + list(atoms))
+
         self._chunk_store: Chroma = load_vector_store(
             collection_name=doc_collection_name,
             persist_directory=persist_directory,
@@ -86,13 +113,12 @@ class ChunkAtomRetriever(BaseQaRetriever, ChromaMixin):
             documents=docs,
             ids=doc_ids,
             exist_ok=exist_ok,
+            sync_mode=sync_mode,
+            build_config=build_config,
+            backend=backend,
+            numpy_config=numpy_config,
         )
 
-        loading_configs = vector_store_config["id_atom_loading"]
-        atom_ids, atoms = load_callable(
-            module_path=loading_configs["module_path"],
-            name=loading_configs["func_name"],
-        )(**loading_configs.get("args", {}))
         self._atom_store: Chroma = load_vector_store(
             collection_name=atom_collection_name,
             persist_directory=persist_directory,
@@ -100,6 +126,10 @@ class ChunkAtomRetriever(BaseQaRetriever, ChromaMixin):
             documents=atoms,
             ids=atom_ids,
             exist_ok=exist_ok,
+            sync_mode=sync_mode,
+            build_config=build_config,
+            backend=backend,
+            numpy_config=numpy_config,
         )
 
     def _atom_info_tuple_to_class(self, atom_retrieval_info: List[Tuple[str, Document, float]]) -> List[AtomRetrievalInfo]:
@@ -113,6 +143,9 @@ class ChunkAtomRetriever(BaseQaRetriever, ChromaMixin):
             for chunk_id, chunk_str in zip(chunk_doc_results["ids"], chunk_doc_results["documents"])
         }
 
+        # Reuse the atom vectors stored instead of embedding the atoms again.
+        self._prime_embedding_memo(self._atom_store, "source_chunk_id", source_chunk_ids)
+
         # Wrap up.
         retrieval_infos: List[AtomRetrievalInfo] = []
         for atom_query, atom_doc, score in atom_retrieval_info:
@@ -156,10 +189,11 @@ class ChunkAtomRetriever(BaseQaRetriever, ChromaMixin):
         if isinstance(queries, str):
             queries = [queries]
 
-        # Query `_atom_store` to get relevant atom information.
+        # Query `_atom_store` to get relevant atom information, with all the queries in one batch.
         query_atom_score_tuples: List[Tuple[str, Document, float]] = []
-        for atom_query in queries:
-            for atom_doc, score in self._get_doc_with_query(atom_query, self._atom_store, retrieve_k):
+        atom_infos_list = self._get_docs_with_queries(queries, self._atom_store, retrieve_k)
+        for atom_query, atom_infos in zip(queries, atom_infos_list):
+            for atom_doc, score in atom_infos:
                 query_atom_score_tuples.append((atom_query, atom_doc, score))
 
         # Wrap to predefined dataclass.
@@ -168,7 +202,11 @@ class ChunkAtomRetriever(BaseQaRetriever, ChromaMixin):
     def _chunk_info_tuple_to_class(self, query: str, chunk_docs: List[Document]) -> List[AtomRetrievalInfo]:
         # Calculate the best-hit (atom, similarity score, atom embedding) for each chunk.
         best_hit_atom_infos: List[Tuple[str, float, List[float]]] = []
+        # The query embedding is memoized when retrieving the chunks, the atom vectors are reused from `_atom_store`.
         query_embedding = self.embedding_func.embed_query(query)
+        self._prime_embedding_memo(
+            self._atom_store, "source_chunk_id", list(set([chunk_doc.metadata["id"] for chunk_doc in chunk_docs])),
+        )
         for chunk_doc in chunk_docs:
             best_atom, best_score, best_embedding = "", 0, []
             for atom in chunk_doc.metadata["atom_questions_str"].split("\n"):  # TODO
@@ -0,0 +1,176 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, List, Optional, Tuple
+
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from pikerag.knowledge_retrievers.mixins.chroma_manifest import CollectionManifest, get_manifest_path
+
+
+def get_checkpoint_path(persist_directory: str, collection_name: str) -> str:
+    return os.path.join(persist_directory, f"{collection_name}.build.json")
+
+
+class _BuildProgress(object):
+    def __init__(self, collection_name: str, num_total: int, num_done: int, report_interval: float) -> None:
+        self._collection_name: str = collection_name
+        self._num_total: int = num_total
+        self._num_resumed: int = num_done
+        self._num_done: int = num_done
+        self._report_interval: float = report_interval
+
+        self._start_time: float = time.perf_counter()
+        self._last_report_time: float = self._start_time
+
+    @property
+    def docs_per_sec(self) -> float:
+        elapsed = time.perf_counter() - self._start_time
+        return (self._num_done - self._num_resumed) / elapsed if elapsed > 0 else 0.0
+
+    def update(self, num_docs: int) -> None:
+        self._num_done += num_docs
+
+        now = time.perf_counter()
+        if now - self._last_report_time >= self._report_interval or self._num_done == self._num_total:
+            self._last_report_time = now
+            rate = self.docs_per_sec
+            eta = (self._num_total - self._num_done) / rate if rate > 0 else float("inf")
+            print(
+                f"[Chroma Bulk Build] {self._collection_name}: {self._num_done}/{self._num_total} docs, "
+                f"{rate:.1f} docs/sec, ETA {eta:.0f}s"
+            )
+        return
+
+
+def _load_checkpoint(checkpoint_path: str, fingerprint: str, batch_size: int) -> int:
+    """Return the number of the batches inserted by the previous build of the same documents, 0 if none."""
+    if not os.path.exists(checkpoint_path):
+        return 0
+
+    try:
+        with open(checkpoint_path, "r", encoding="utf-8") as fin:
+            checkpoint: dict = json.load(fin)
+    except (OSError, ValueError):
+        return 0
+
+    if checkpoint.get("fingerprint", None) != fingerprint or checkpoint.get("batch_size", None) != batch_size:
+        return 0
+    return checkpoint["num_batches_done"]
+
+
+def _save_checkpoint(checkpoint_path: str, fingerprint: str, batch_size: int, num_batches_done: int) -> None:
+    tmp_path = f"{checkpoint_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fout:
+        json.dump({"fingerprint": fingerprint, "batch_size": batch_size, "num_batches_done": num_batches_done}, fout)
+    os.replace(tmp_path, checkpoint_path)
+    return
+
+
+def _upsert_batch(vector_store: Chroma, ids: List[str], documents: List[Document], vectors: List[List[float]]) -> None:
+    # Chroma rejects the empty metadata, so the documents without metadata are upserted separately.
+    with_meta = [i for i, doc in enumerate(documents) if doc.metadata]
+    without_meta = [i for i, doc in enumerate(documents) if not doc.metadata]
+
+    if len(with_meta) > 0:
+        vector_store._collection.upsert(
+            ids=[ids[i] for i in with_meta],
+            embeddings=[vectors[i] for i in with_meta],
+            documents=[documents[i].page_content for i in with_meta],
+            metadatas=[documents[i].metadata for i in with_meta],
+        )
+    if len(without_meta) > 0:
+        vector_store._collection.upsert(
+            ids=[ids[i] for i in without_meta],
+            embeddings=[vectors[i] for i in without_meta],
+            documents=[documents[i].page_content for i in without_meta],
+        )
+    return
+
+
+def build_vector_store(
+    collection_name: str,
+    persist_directory: str,
+    embedding: Embeddings,
+    documents: List[Document],
+    ids: Optional[List[str]]=None,
+    metadata: dict=None,
+    batch_size: int=256,
+    num_workers: int=4,
+    queue_size: int=8,
+    report_interval: float=10.0,
+) -> Chroma:
+    """Build up the Chroma collection in a resumable pipeline, instead of one monolithic `Chroma.from_documents()`.
+
+    The documents are split into batches of `batch_size`, embedded by `num_workers` threads in parallel, and inserted
+    in order by the calling thread while the next batches are being embedded. At most `num_workers + queue_size`
+    batches are in flight, so the memory is bounded. The number of the batches inserted is checkpointed next to the
+    collection after each batch, so a killed build of the same documents resumes from where it stopped. The progress
+    is reported in docs/sec every `report_interval` seconds.
+
+    The documents without ids are given the content-hash ids (the same as the ones of the incremental sync), so that
+    the resumed batches are upserted idempotently. The manifest is saved once the build finishes.
+    """
+    assert persist_directory is not None, "persist_directory must be given to checkpoint the build!"
+    assert batch_size > 0 and num_workers > 0 and queue_size >= 0
+
+    manifest = CollectionManifest.from_documents(documents, ids)
+    if manifest.id_scheme == "content":
+        ids = list(manifest.entries.keys())
+    manifest_path = get_manifest_path(persist_directory, collection_name)
+    checkpoint_path = get_checkpoint_path(persist_directory, collection_name)
+
+    num_batches = (len(documents) + batch_size - 1) // batch_size
+    num_batches_done = _load_checkpoint(checkpoint_path, manifest.fingerprint, batch_size)
+
+    vector_store = Chroma(collection_name, embedding, persist_directory, collection_metadata=metadata)
+    if num_batches_done > 0:
+        print(f"[Chroma Bulk Build] {collection_name}: resume from batch {num_batches_done}/{num_batches}")
+    else:
+        vector_store.delete_collection()
+        CollectionManifest.remove(manifest_path)
+        # Re-create it since the deleted one cannot be inserted into any more.
+        vector_store = Chroma(collection_name, embedding, persist_directory, collection_metadata=metadata)
+
+    def get_batch(batch_idx: int) -> Tuple[List[str], List[Document]]:
+        start, end = batch_idx * batch_size, min((batch_idx + 1) * batch_size, len(documents))
+        return ids[start:end], documents[start:end]
+
+    def embed_batch(batch_idx: int) -> List[List[float]]:
+        _, batch_docs = get_batch(batch_idx)
+        return embedding.embed_documents([doc.page_content for doc in batch_docs])
+
+    progress = _BuildProgress(
+        collection_name, len(documents), min(num_batches_done * batch_size, len(documents)), report_interval,
+    )
+
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    in_flight: Deque[Tuple[int, Future]] = deque()
+    next_batch_idx = num_batches_done
+    try:
+        while next_batch_idx < num_batches or len(in_flight) > 0:
+            while next_batch_idx < num_batches and len(in_flight) < num_workers + queue_size:
+                in_flight.append((next_batch_idx, executor.submit(embed_batch, next_batch_idx)))
+                next_batch_idx += 1
+
+            batch_idx, future = in_flight.popleft()
+            vectors = future.result()
+            batch_ids, batch_docs = get_batch(batch_idx)
+            _upsert_batch(vector_store, batch_ids, batch_docs, vectors)
+
+            _save_checkpoint(checkpoint_path, manifest.fingerprint, batch_size, batch_idx + 1)
+            progress.update(len(batch_docs))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    manifest.save(manifest_path)
+    os.remove(checkpoint_path)
+    print(f"[Chroma Bulk Build] {collection_name}: finished at {progress.docs_per_sec:.1f} docs/sec")
+    return vector_store
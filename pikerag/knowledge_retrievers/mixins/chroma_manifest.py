@@ -0,0 +1,228 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+
+
+MANIFEST_VERSION: int = 2
+
+# How the ids of the documents in the store are assigned: given by the caller, the content hashes (i.e. the manifest
+# keys), or random ones by Chroma. The content-hash diffs apply to the store only if its ids are not random.
+ID_SCHEMES = ("given", "content", "random")
+
+_FINGERPRINT_MODULUS: int = 1 << 128
+
+
+def hash_document(document: Document) -> str:
+    """The hash of the content and the metadata of the document."""
+    content = json.dumps([document.page_content, document.metadata or {}], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]
+
+
+def _hash_entry(key: str, doc_hash: str) -> int:
+    return int(hashlib.sha256(f"{key}\x00{doc_hash}".encode("utf-8")).hexdigest()[:32], 16)
+
+
+def get_manifest_path(persist_directory: str, collection_name: str) -> str:
+    return os.path.join(persist_directory, f"{collection_name}.manifest.jsonl")
+
+
+@dataclass
+class ManifestDiff:
+    added: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    changed: List[str] = field(default_factory=list)
+
+    @property
+    def is_empty(self) -> bool:
+        return len(self.added) == 0 and len(self.removed) == 0 and len(self.changed) == 0
+
+    def summary(self, max_keys: int = 5) -> str:
+        lines: List[str] = []
+        for name, keys in [("added", self.added), ("removed", self.removed), ("changed", self.changed)]:
+            if len(keys) > 0:
+                more = f", ... ({len(keys) - max_keys} more)" if len(keys) > max_keys else ""
+                lines.append(f"  {len(keys)} {name}: {', '.join(keys[:max_keys])}{more}")
+        return "\n".join(lines)
+
+
+class CollectionManifest(object):
+    """The content fingerprints of the documents in a vector store collection, persisted next to the collection.
+
+    Each document is recorded as a (key, hash) entry, where the hash covers the content and the metadata. The key is
+    the document id if the ids are given, otherwise the hash itself (suffixed for the duplicates), so the documents
+    without ids are still diffable by content. The collection fingerprint is the sum of the entry hashes modulo 2^128,
+    which is independent of the document order and is updated in O(1) when an entry is set or removed.
+
+    The manifest is saved as a jsonl file whose first line is the header with the fingerprint and the `id_scheme`, so
+    that checking a collection at startup reads one line only, and the entries are read to pinpoint the documents
+    changed only if the fingerprints differ. The manifests of different `id_scheme`s never match, since the keys are
+    the store ids only if the scheme is not "random".
+    """
+    def __init__(self, entries: Dict[str, str] = None, id_scheme: str = "given") -> None:
+        assert id_scheme in ID_SCHEMES, f"Unrecognized id_scheme: {id_scheme}, should be one of {ID_SCHEMES}."
+
+        self.id_scheme: str = id_scheme
+        self._entries: Dict[str, str] = {}
+        self._fingerprint: int = 0
+        for key, doc_hash in (entries or {}).items():
+            self.set(key, doc_hash)
+
+    @classmethod
+    def from_documents(
+        cls, documents: Iterable[Document], ids: Optional[List[str]] = None, id_scheme: Optional[str] = None,
+    ) -> "CollectionManifest":
+        """Keyed by the `ids` if given, otherwise by the content hashes. The `id_scheme` defaults to "given" if the
+        `ids` given, otherwise to "content".
+        """
+        doc_hashes: List[str] = [hash_document(doc) for doc in documents]
+        if ids is not None:
+            assert len(ids) == len(doc_hashes), f"{len(ids)} ids provided with {len(doc_hashes)} documents!"
+            return cls(dict(zip(ids, doc_hashes)), id_scheme or "given")
+
+        entries: Dict[str, str] = {}
+        for doc_hash in doc_hashes:
+            key, num_dup = doc_hash, 0
+            while key in entries:
+                num_dup += 1
+                key = f"{doc_hash}.{num_dup}"
+            entries[key] = doc_hash
+        return cls(entries, id_scheme or "content")
+
+    @staticmethod
+    def load_header(path: str) -> Optional[dict]:
+        """Load the header of the manifest file, i.e. the fingerprint and the number of documents, None if no valid
+        manifest exists.
+        """
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, "r", encoding="utf-8") as fin:
+                header: dict = json.loads(fin.readline())
+        except (OSError, ValueError):
+            return None
+
+        if header.get("version", None) != MANIFEST_VERSION:
+            return None
+        return header
+
+    @classmethod
+    def load(cls, path: str) -> Optional["CollectionManifest"]:
+        header = cls.load_header(path)
+        if header is None:
+            return None
+
+        entries: Dict[str, str] = {}
+        with open(path, "r", encoding="utf-8") as fin:
+            fin.readline()
+            for line in fin:
+                key, doc_hash = json.loads(line)
+                entries[key] = doc_hash
+        return cls(entries, header["id_scheme"])
+
+    def save(self, path: str) -> None:
+        dir_path = os.path.dirname(path)
+        if dir_path != "" and not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+
+        # Write to a temporary file and then replace, so that a crash never leaves a half-written manifest.
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fout:
+            header = {
+                "version": MANIFEST_VERSION,
+                "fingerprint": self.fingerprint,
+                "num_documents": self.num_documents,
+                "id_scheme": self.id_scheme,
+            }
+            fout.write(json.dumps(header) + "\n")
+            for key, doc_hash in self._entries.items():
+                fout.write(json.dumps([key, doc_hash], ensure_ascii=False) + "\n")
+        os.replace(tmp_path, path)
+        return
+
+    @staticmethod
+    def remove(path: str) -> None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    @property
+    def fingerprint(self) -> str:
+        return f"{self._fingerprint:032x}"
+
+    @property
+    def num_documents(self) -> int:
+        return len(self._entries)
+
+    @property
+    def entries(self) -> Dict[str, str]:
+        return self._entries
+
+    def set(self, key: str, doc_hash: str) -> None:
+        self.pop(key)
+        self._entries[key] = doc_hash
+        self._fingerprint = (self._fingerprint + _hash_entry(key, doc_hash)) % _FINGERPRINT_MODULUS
+        return
+
+    def pop(self, key: str) -> Optional[str]:
+        doc_hash = self._entries.pop(key, None)
+        if doc_hash is not None:
+            self._fingerprint = (self._fingerprint - _hash_entry(key, doc_hash)) % _FINGERPRINT_MODULUS
+        return doc_hash
+
+    def matches(self, header: Optional[dict]) -> bool:
+        return (
+            header is not None
+            and header["fingerprint"] == self.fingerprint
+            and header["num_documents"] == self.num_documents
+            and header["id_scheme"] == self.id_scheme
+        )
+
+    def diff(self, target: "CollectionManifest") -> ManifestDiff:
+        """The keys to add, remove and change to turn this manifest into the `target` one."""
+        diff = ManifestDiff()
+        for key, doc_hash in target.entries.items():
+            if key not in self._entries:
+                diff.added.append(key)
+            elif self._entries[key] != doc_hash:
+                diff.changed.append(key)
+        diff.removed = [key for key in self._entries if key not in target.entries]
+        return diff
+
+
+def load_manifest_from_store(
+    vector_store: Chroma, id_scheme: str, page_size: int = 10000,
+) -> Tuple[CollectionManifest, List[str]]:
+    """Build the manifest by reading all the documents in the vector store page by page, for the collections built
+    before the manifests were introduced. No embedding calls are made.
+
+    Returns:
+        CollectionManifest: the manifest of the documents in the store, keyed by the store ids unless the `id_scheme`
+            is "random", in which case keyed by the content hashes the same as `from_documents()`.
+        List[str]: the ids in the store, in the order of the manifest entries if the `id_scheme` is "random".
+    """
+    store_ids: List[str] = []
+    documents: List[Document] = []
+    offset = 0
+    while True:
+        results = vector_store.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+        if len(results["ids"]) == 0:
+            break
+        store_ids.extend(results["ids"])
+        documents.extend(
+            Document(page_content=content, metadata=metadata or {})
+            for content, metadata in zip(results["documents"], results["metadatas"])
+        )
+        offset += len(results["ids"])
+
+    with_ids = id_scheme != "random"
+    manifest = CollectionManifest.from_documents(documents, store_ids if with_ids else None, id_scheme)
+    return manifest, store_ids
@@ -3,16 +3,26 @@
 
 from typing import Dict, List, Optional, Tuple, Union
 
-import numpy as np
-
 from chromadb.api.models.Collection import GetResult
 from langchain_chroma import Chroma
 from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
 
+from pikerag.knowledge_retrievers.mixins.chroma_builder import build_vector_store
+from pikerag.knowledge_retrievers.mixins.chroma_manifest import (
+    CollectionManifest, get_manifest_path, load_manifest_from_store,
+)
+from pikerag.knowledge_retrievers.mixins.numpy_vector_store import NumpyVectorStore, load_numpy_vector_store
+from pikerag.llm_client.embedding_cache import MemoizedEmbeddings
+from pikerag.llm_client.embedding_compression import CompressedEmbeddings, get_compression_tag
+
 
 ChromaMetaType = Union[str, int, float, bool]
 
+SYNC_MODES: Tuple[str, ...] = ("rebuild", "incremental")
+
+VECTOR_STORE_BACKENDS: Tuple[str, ...] = ("chroma", "numpy")
+
 
 def _check_ids_and_documents(ids: Optional[List[str]], documents: List[Document]) -> Optional[List[str]]:
     if ids is None or len(ids) == 0:
@@ -22,51 +32,70 @@ def _check_ids_and_documents(ids: Optional[List[str]], documents: List[Document]
     return ids
 
 
-def _documents_match(docs: List[Document], ids: Optional[List[str]], vector_store: Chroma) -> bool:
-    if vector_store._collection.count() != len(docs):
-        print(
-            "[ChromaDB Loading Check] Document quantity not matched! "
-            f"{vector_store._collection.count()} in store but {len(docs)} provided."
-        )
-        return False
-
-    for idx in np.random.choice(len(docs), 3):
-        content_in_doc: str = docs[idx].page_content
-        meta_in_doc: dict = docs[idx].metadata
-        if ids is not None:
-            res = vector_store.get(ids=ids[idx])
-            if len(res) == 0 or len(res["documents"]) == 0:
-                print(f"[ChromaDB Loading Check] No data with id {ids[idx]} exist!")
-                return False
-            content_in_store = res["documents"][0]
-            meta_in_store =res["metadatas"][0]
-        else:
-            doc_in_store = vector_store.similarity_search(query=content_in_doc, k=1)[0]
-            content_in_store = doc_in_store.page_content
-            meta_in_store = doc_in_store.metadata
-
-        if content_in_store != content_in_doc:
-            print(
-                "[ChromaDB Loading Check] Document Content not matched:\n"
-                f"  In store: {content_in_store}\n"
-                f"  In Doc: {content_in_doc}"
-            )
-            return False
+def load_compression_config(compression_config: Optional[dict], path_prefix: str) -> Tuple[Optional[dict], str]:
+    """Load the `compression` config in the `vector_store` block into the args of `CompressedEmbeddings`.
 
-        for key, value in meta_in_doc.items():
-            if key not in meta_in_store:
-                print(f"[ChromaDB Loading Check] Metadata {key} in doc but not in store!")
-                return False
+    Args:
+        compression_config (Optional[dict]): the `compression` config, i.e. `dimensions`, `method` and `precision`.
+        path_prefix (str): the path prefix to save the PCA projection if `projection_path` not given.
 
-            if isinstance(value, float):
-                if abs(value - meta_in_store[key]) > 1e-9:
-                    print(f"[ChromaDB Loading Check] Metadata {key} not matched: {value} v.s. {meta_in_store[key]}")
-                    return False
-            elif meta_in_store[key] != value:
-                print(f"[ChromaDB Loading Check] Metadata {key} not matched: {value} v.s. {meta_in_store[key]}")
-                return False
+    Returns:
+        Optional[dict]: the args of `CompressedEmbeddings`, None if nothing to compress.
+        str: the tag of the compression setting, to suffix the collection names with so that the compressed
+            collections are kept aside from the full-precision ones. Empty if nothing to compress.
+    """
+    if compression_config is None:
+        return None, ""
 
-    return True
+    compression_config = dict(compression_config)
+    tag = get_compression_tag(
+        compression_config.get("dimensions", None),
+        compression_config.get("method", "truncate"),
+        compression_config.get("precision", "float32"),
+    )
+    if tag == "":
+        return None, ""
+
+    method = compression_config.get("method", "truncate")
+    if method == "pca" and compression_config.get("projection_path", None) is None:
+        compression_config["projection_path"] = f"{path_prefix}_{tag}_projection.npz"
+    return compression_config, tag
+
+
+def fit_compression_projection(embedding: Embeddings, documents: List[Document]) -> None:
+    """Fit the PCA projection of the `CompressedEmbeddings` wrapped in the `embedding` on a sample of the `documents`,
+    i.e. all the documents to be embedded with it, before any of them is embedded batch by batch. Nothing to do if no
+    PCA compression is configured or the projection is fitted already.
+    """
+    while embedding is not None and not isinstance(embedding, CompressedEmbeddings):
+        embedding = getattr(embedding, "embedding", None)
+
+    if embedding is not None and embedding.needs_fit:
+        embedding.fit([doc.page_content for doc in documents])
+    return
+
+
+def _sync_vector_store(
+    vector_store: Chroma,
+    documents: List[Document],
+    ids: List[str],
+    ids_to_delete: List[str],
+    ids_to_upsert: List[str],
+    batch_size: int,
+) -> None:
+    if len(ids_to_delete) > 0:
+        for i in range(0, len(ids_to_delete), batch_size):
+            vector_store.delete(ids=ids_to_delete[i:i + batch_size])
+        print(f"  {len(ids_to_delete)} documents deleted from {vector_store._collection.name}.")
+
+    if len(ids_to_upsert) > 0:
+        id_to_doc: Dict[str, Document] = {doc_id: doc for doc_id, doc in zip(ids, documents)}
+        for i in range(0, len(ids_to_upsert), batch_size):
+            batch_ids = ids_to_upsert[i:i + batch_size]
+            # Chroma add_documents() upserts by ids, so the changed documents are overwritten.
+            vector_store.add_documents(documents=[id_to_doc[doc_id] for doc_id in batch_ids], ids=batch_ids)
+        print(f"  {len(ids_to_upsert)} documents upserted into {vector_store._collection.name}.")
+    return
 
 
 def load_vector_store(
@@ -77,7 +106,36 @@ def load_vector_store(
     ids: List[str]=None,
     exist_ok: bool=True,
     metadata: dict=None,
-) -> Chroma:
+    sync_mode: str="rebuild",
+    upsert_batch_size: int=1000,
+    build_config: dict=None,
+    backend: str="chroma",
+    numpy_config: dict=None,
+) -> Union[Chroma, NumpyVectorStore]:
+    """Load the Chroma collection and make it consistent with the given `documents`.
+
+    The collection is checked against the manifest persisted next to it (see `CollectionManifest`). If any document
+    added, removed or changed:
+    - `sync_mode="rebuild"`: the collection is deleted and built up again from all the documents.
+    - `sync_mode="incremental"`: only the documents removed are deleted, and only the documents added or changed are
+        embedded and upserted. The documents without ids are given deterministic content-hash ids so that they are
+        diffable. The `id_scheme` is recorded in the manifest, so a collection built with random ids is rebuilt once
+        with the content-hash ids when switched to this mode.
+
+    The collection is built up by the resumable pipeline `build_vector_store()` with the args in `build_config` if
+    given, otherwise by `Chroma.from_documents()`.
+
+    With `backend="numpy"`, the in-process read-only `NumpyVectorStore` is loaded instead, with the args in
+    `numpy_config`, and it is rebuilt up whenever the documents changed.
+    """
+    assert backend in VECTOR_STORE_BACKENDS, f"Unrecognized backend: {backend}, should be in {VECTOR_STORE_BACKENDS}."
+    if backend == "numpy":
+        return load_numpy_vector_store(
+            collection_name, persist_directory, embedding, documents, ids, **(numpy_config or {}),
+        )
+
+    assert sync_mode in SYNC_MODES, f"Unrecognized sync_mode: {sync_mode}, should be one of {SYNC_MODES}."
+
     vector_store = Chroma(collection_name, embedding, persist_directory, collection_metadata=metadata)
 
     if documents is None or len(documents) == 0:
@@ -87,11 +145,74 @@ def load_vector_store(
 
     ids = _check_ids_and_documents(ids, documents)
 
-    if _documents_match(documents, ids, vector_store):
+    manifest_path = get_manifest_path(persist_directory, collection_name) if persist_directory is not None else None
+    header = CollectionManifest.load_header(manifest_path) if manifest_path is not None else None
+
+    # The documents without ids are given the content-hash ids if they are to be diffed by the incremental sync or
+    # upserted idempotently by the resumable builder, or if the collection is built with them already, otherwise
+    # Chroma gives them the random ones.
+    if ids is not None:
+        id_scheme = "given"
+    elif sync_mode == "incremental" or build_config is not None:
+        id_scheme = "content"
+    elif header is not None and header["id_scheme"] == "content":
+        id_scheme = "content"
+    else:
+        id_scheme = "random"
+
+    # Check the fingerprint recorded in the manifest first, it costs one line to read.
+    manifest = CollectionManifest.from_documents(documents, ids, id_scheme)
+    if id_scheme == "content":
+        # The manifest keys are the content hashes in the document order.
+        ids = list(manifest.entries.keys())
+    num_in_store = vector_store._collection.count()
+    if manifest.matches(header) and header["num_documents"] == num_in_store:
         print(f"Chroma DB: {collection_name} loaded.")
         return vector_store
 
+    if header is not None and header["id_scheme"] != id_scheme:
+        # The ids in the store cannot be diffed with the ones required, thus rebuild up once.
+        print(
+            f"[ChromaDB Loading Check] {collection_name} built with {header['id_scheme']} ids "
+            f"but {id_scheme} ids required."
+        )
+
+    else:
+        # Otherwise pinpoint the documents changed, with the collection read through if no manifest recorded.
+        if header is not None and header["num_documents"] == num_in_store:
+            stored_manifest = CollectionManifest.load(manifest_path)
+        else:
+            stored_manifest, _ = load_manifest_from_store(vector_store, id_scheme)
+        diff = stored_manifest.diff(manifest)
+        if diff.is_empty:
+            if manifest_path is not None:
+                manifest.save(manifest_path)
+            print(f"Chroma DB: {collection_name} loaded, manifest recorded.")
+            return vector_store
+
+        print(
+            f"[ChromaDB Loading Check] {collection_name} not matched with the documents provided:\n{diff.summary()}"
+        )
+
+        if sync_mode == "incremental":
+            _sync_vector_store(
+                vector_store, documents, ids, diff.removed, diff.added + diff.changed, upsert_batch_size,
+            )
+            if manifest_path is not None:
+                manifest.save(manifest_path)
+            print(f"Chroma DB: {collection_name} synced.")
+            return vector_store
+
+    if build_config is not None:
+        # Not to delete the collection here, the builder resumes the interrupted build from its checkpoint.
+        return build_vector_store(
+            collection_name, persist_directory, embedding, documents, ids if id_scheme == "given" else None, metadata,
+            **build_config,
+        )
+
     vector_store.delete_collection()
+    if manifest_path is not None:
+        CollectionManifest.remove(manifest_path)
 
     # Direct using of vector_store.add_documents() will raise InvalidCollectionException.
     print(f"Start to build up the Chroma DB: {collection_name}")
@@ -103,11 +224,16 @@ def load_vector_store(
         persist_directory=persist_directory,
         collection_metadata=metadata,
     )
+    if manifest_path is not None:
+        manifest.save(manifest_path)
     print(f"Chroma DB: {collection_name} Building-Up finished.")
     return vector_store
 
 
 class ChromaMixin:
+    """The retrieval methods on the vector stores loaded by `load_vector_store()`, i.e. the Chroma collections or the
+    `NumpyVectorStore`s which implement the same interface.
+    """
     def _init_chroma_mixin(self):
         self.retrieve_k: int = self._retriever_config.get("retrieve_k", 4)
         self.retrieve_score_threshold: float = self._retriever_config.get("retrieve_score_threshold", 0.5)
@@ -125,17 +251,75 @@ class ChromaMixin:
         if score_threshold is None:
             score_threshold = self.retrieve_score_threshold
 
-        infos: List[Tuple[Document, float]] = store.similarity_search_with_relevance_scores(
-            query=query,
-            k=retrieve_k,
-            score_threshold=score_threshold,
-        )
+        # Search by the query vector, which is memoized (see `MemoizedEmbeddings`) for the callers needing it later.
+        query_embedding: List[float] = store.embeddings.embed_query(query)
+        relevance_score_fn = self._get_scoring_func(store)
+        infos: List[Tuple[Document, float]] = [
+            (doc, relevance_score_fn(distance))
+            for doc, distance in store.similarity_search_by_vector_with_relevance_scores(
+                embedding=query_embedding,
+                k=retrieve_k,
+            )
+        ]
 
         filtered_docs = [(doc, score) for doc, score in infos if score >= score_threshold]
         sorted_docs = sorted(filtered_docs, key=lambda x: x[1], reverse=True)
 
         return sorted_docs
 
+    def _search_by_vectors(
+        self, store: Union[Chroma, NumpyVectorStore], query_embeddings: List[List[float]], retrieve_k: int,
+    ) -> List[List[Tuple[Document, float]]]:
+        """Search the `store` by all the query vectors in one call, returning the (document, distance) pairs."""
+        if isinstance(store, NumpyVectorStore):
+            return store.similarity_search_by_vectors_with_relevance_scores(embeddings=query_embeddings, k=retrieve_k)
+
+        results = store._collection.query(
+            query_embeddings=query_embeddings,
+            n_results=retrieve_k,
+            include=["documents", "metadatas", "distances"],
+        )
+        return [
+            [
+                (Document(page_content=content, metadata=metadata or {}), distance)
+                for content, metadata, distance in zip(contents, metadatas, distances)
+            ]
+            for contents, metadatas, distances in zip(results["documents"], results["metadatas"], results["distances"])
+        ]
+
+    def _get_docs_with_queries(
+        self, queries: List[str], store: Chroma, retrieve_k: int=None, score_threshold: float=None,
+    ) -> List[List[Tuple[Document, float]]]:
+        """Using each of the given `queries` to query documents from the given vector store `store`. The queries are
+        embedded in one batch and searched in one call, instead of one round-trip per query.
+
+        Returns:
+            List[List[Tuple[Document, float]]]: the (document, relevance score) pairs of each query, the same as the
+                ones returned by `_get_doc_with_query()`.
+        """
+        if len(queries) <= 1:
+            return [self._get_doc_with_query(query, store, retrieve_k, score_threshold) for query in queries]
+
+        if retrieve_k is None:
+            retrieve_k = self.retrieve_k
+        if score_threshold is None:
+            score_threshold = self.retrieve_score_threshold
+
+        # `MemoizedEmbeddings` embeds the queries missed in batch if possible, the others embed them one by one.
+        embed_queries = getattr(store.embeddings, "embed_queries", None)
+        if embed_queries is not None:
+            query_embeddings: List[List[float]] = embed_queries(queries)
+        else:
+            query_embeddings = [store.embeddings.embed_query(query) for query in queries]
+
+        relevance_score_fn = self._get_scoring_func(store)
+        docs_list: List[List[Tuple[Document, float]]] = []
+        for infos in self._search_by_vectors(store, query_embeddings, retrieve_k):
+            scored_docs = [(doc, relevance_score_fn(distance)) for doc, distance in infos]
+            filtered_docs = [(doc, score) for doc, score in scored_docs if score >= score_threshold]
+            docs_list.append(sorted(filtered_docs, key=lambda x: x[1], reverse=True))
+        return docs_list
+
     def _get_infos_with_given_meta(
         self, store: Chroma, meta_name: str, meta_value: Union[ChromaMetaType, List[ChromaMetaType]],
     ) -> Tuple[List[str], List[str], List[Dict[str, ChromaMetaType]]]:
@@ -155,5 +339,27 @@ class ChromaMixin:
         ids, chunks, metadatas = results["ids"], results["documents"], results["metadatas"]
         return ids, chunks, metadatas
 
+    def _prime_embedding_memo(
+        self, store: Chroma, meta_name: str, meta_value: Union[ChromaMetaType, List[ChromaMetaType]],
+    ) -> None:
+        """Put the stored vectors of the documents with metadata `meta_name` in given value / value list `meta_value`
+        into the query embedding memo of the `store`, so that they would not be embedded again. Only if the memo is
+        configured with `prime_from_store`, since the document embeddings differ from the query ones for the
+        asymmetric models.
+        """
+        if not isinstance(store.embeddings, MemoizedEmbeddings) or not store.embeddings.prime_from_store:
+            return
+
+        if isinstance(meta_value, list):
+            if len(meta_value) == 0:
+                return
+            filter = {meta_name: {"$in": meta_value}}
+        else:
+            filter = {meta_name: meta_value}
+
+        results: GetResult = store.get(where=filter, include=["documents", "embeddings"])
+        store.embeddings.prime(results["documents"], results["embeddings"])
+        return
+
     def _get_scoring_func(self, store: Chroma):
         return store._select_relevance_score_fn()
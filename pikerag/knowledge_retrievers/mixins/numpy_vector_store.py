@@ -0,0 +1,368 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import json
+import math
+import os
+import shutil
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from pikerag.knowledge_retrievers.mixins.chroma_manifest import CollectionManifest
+
+
+_META_FILENAME: str = "meta.json"
+_VECTORS_FILENAME: str = "vectors.f32"
+_RECORDS_FILENAME: str = "records.jsonl"
+_HNSW_FILENAME: str = "hnsw.bin"
+_CURRENT_FILENAME: str = "CURRENT"
+_VERSION_PREFIX: str = "v"
+
+INDEX_TYPES: Tuple[str, ...] = ("flat", "hnsw")
+
+
+def _euclidean_relevance_score(distance: float) -> float:
+    # The same as the default relevance score function of Chroma, so that the score thresholds keep their meaning.
+    return 1.0 - distance / math.sqrt(2)
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _get_current_directory(directory: str) -> str:
+    """The directory of the current version of the store, i.e. the one named in the pointer file, or the store
+    directory itself for the stores built before the versioning.
+    """
+    current_path = os.path.join(directory, _CURRENT_FILENAME)
+    if not os.path.exists(current_path):
+        return directory
+
+    with open(current_path, "r", encoding="utf-8") as fin:
+        return os.path.join(directory, fin.read().strip())
+
+
+class _Collection(object):
+    def __init__(self, store: "NumpyVectorStore") -> None:
+        self._store = store
+
+    @property
+    def name(self) -> str:
+        return self._store.name
+
+    def count(self) -> int:
+        return self._store.num_documents
+
+
+class NumpyVectorStore(object):
+    """An in-process read-only vector store, for the read-mostly evaluation corpora. It implements the part of the
+    `Chroma` interface used by `ChromaMixin` and the retrievers, so it can be used in place of a Chroma collection.
+
+    Each build of the store is written into a versioned sub-directory, and the `CURRENT` file in the store directory
+    names the version to load. The version directory consists of:
+    - `vectors.f32`: the pre-normalized float32 matrix, memory-mapped read-only so that the worker processes share the
+        same pages;
+    - `records.jsonl`: the id, the content and the metadata of each document, in the row order;
+    - `meta.json`: the dimension, the number of documents, the index type and the manifest fingerprint;
+    - `hnsw.bin`: the HNSW graph, only if the index type is "hnsw".
+
+    With the "flat" index, the exact top-k is computed with one matrix-vector product and `np.argpartition()`, which is
+    the fastest for up to around a million vectors. The "hnsw" index (by the optional `hnswlib`) gives the approximate
+    top-k in sub-linear time for the larger ones.
+
+    Same as Chroma, the search returns the squared L2 distances of the normalized vectors, i.e. `2 - 2 * cosine`, and
+    `_select_relevance_score_fn()` converts them to the same relevance scores as the default of Chroma.
+
+    Args:
+        directory (str): the directory of the store, the current version in it is loaded.
+        embedding (Embeddings): the embedding model to embed the queries.
+        ef_search (int): the size of the candidate list of the HNSW search. Defaults to 64.
+    """
+    def __init__(self, directory: str, embedding: Embeddings, ef_search: int = 64) -> None:
+        self._directory: str = directory
+        self._embedding: Embeddings = embedding
+        self._ef_search: int = ef_search
+
+        directory = _get_current_directory(directory)
+
+        with open(os.path.join(directory, _META_FILENAME), "r", encoding="utf-8") as fin:
+            self._meta: dict = json.load(fin)
+
+        self._ids: List[str] = []
+        self._documents: List[str] = []
+        self._metadatas: List[dict] = []
+        with open(os.path.join(directory, _RECORDS_FILENAME), "r", encoding="utf-8") as fin:
+            for line in fin:
+                doc_id, content, metadata = json.loads(line)
+                self._ids.append(doc_id)
+                self._documents.append(content)
+                self._metadatas.append(metadata)
+        self._id_to_row: Dict[str, int] = {doc_id: row for row, doc_id in enumerate(self._ids)}
+
+        if len(self._ids) > 0:
+            self._matrix: np.ndarray = np.memmap(
+                os.path.join(directory, _VECTORS_FILENAME), dtype=np.float32, mode="r",
+                shape=(len(self._ids), self._meta["dimension"]),
+            )
+        else:
+            self._matrix = np.zeros((0, self._meta["dimension"]), dtype=np.float32)
+
+        self._hnsw = None
+        if self._meta["index"] == "hnsw":
+            import hnswlib
+            self._hnsw = hnswlib.Index(space="ip", dim=self._meta["dimension"])
+            self._hnsw.load_index(os.path.join(directory, _HNSW_FILENAME), max_elements=len(self._ids))
+
+        # The inverted indices of the metadata, built lazily on the first filtering by each metadata name.
+        self._meta_indices: Dict[str, Dict[object, List[int]]] = {}
+
+        self._collection = _Collection(self)
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(os.path.normpath(self._directory))
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    @property
+    def num_documents(self) -> int:
+        return len(self._ids)
+
+    @property
+    def fingerprint(self) -> str:
+        return self._meta["fingerprint"]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        return _euclidean_relevance_score
+
+    def _get_meta_index(self, meta_name: str) -> Dict[object, List[int]]:
+        if meta_name not in self._meta_indices:
+            meta_index: Dict[object, List[int]] = {}
+            for row, metadata in enumerate(self._metadatas):
+                if meta_name in metadata:
+                    meta_index.setdefault(metadata[meta_name], []).append(row)
+            self._meta_indices[meta_name] = meta_index
+        return self._meta_indices[meta_name]
+
+    def _filter_rows(self, where: dict) -> List[int]:
+        """Support the filters `{name: value}` and `{name: {"$in": [values]}}` used by `ChromaMixin`."""
+        assert len(where) == 1, f"Only the filter on one metadata supported but got {where}!"
+        meta_name, condition = next(iter(where.items()))
+        meta_index = self._get_meta_index(meta_name)
+
+        if isinstance(condition, dict):
+            assert list(condition.keys()) == ["$in"], f"Only the $in operator supported but got {condition}!"
+            values = condition["$in"]
+        else:
+            values = [condition]
+
+        rows: List[int] = []
+        for value in values:
+            rows.extend(meta_index.get(value, []))
+        return sorted(set(rows))
+
+    def get(
+        self,
+        ids: Optional[List[str]] = None,
+        where: Optional[dict] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        include: Optional[List[str]] = None,
+    ) -> dict:
+        """Get the documents by `ids` and / or the metadata filter `where`, in the same format as `Chroma.get()`."""
+        if include is None:
+            include = ["documents", "metadatas"]
+
+        if ids is not None:
+            if isinstance(ids, str):
+                ids = [ids]
+            rows = [self._id_to_row[doc_id] for doc_id in ids if doc_id in self._id_to_row]
+        else:
+            rows = list(range(len(self._ids)))
+
+        if where is not None:
+            filtered_rows = set(self._filter_rows(where))
+            rows = [row for row in rows if row in filtered_rows]
+
+        start = offset or 0
+        rows = rows[start:start + limit] if limit is not None else rows[start:]
+
+        results: dict = {"ids": [self._ids[row] for row in rows]}
+        results["documents"] = [self._documents[row] for row in rows] if "documents" in include else None
+        results["metadatas"] = [self._metadatas[row] for row in rows] if "metadatas" in include else None
+        results["embeddings"] = self._matrix[rows] if "embeddings" in include else None
+        return results
+
+    def _search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the rows and the cosine similarities of the top-k, each in shape (num_queries, k)."""
+        k = min(k, len(self._ids))
+        if k == 0:
+            return np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+
+        if self._hnsw is not None:
+            self._hnsw.set_ef(max(self._ef_search, k))
+            rows, distances = self._hnsw.knn_query(queries, k=k)
+            return rows.astype(np.int64), 1 - distances
+
+        scores = queries @ self._matrix.T
+        if k < len(self._ids):
+            rows = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            rows = np.tile(np.arange(len(self._ids)), (len(queries), 1))
+        top_scores = np.take_along_axis(scores, rows, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(rows, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def similarity_search_by_vector_with_relevance_scores(
+        self, embedding: List[float], k: int = 4, **kwargs,
+    ) -> List[Tuple[Document, float]]:
+        """Search by the query vector, the squared L2 distances are returned the same as `Chroma`."""
+        return self.similarity_search_by_vectors_with_relevance_scores([embedding], k)[0]
+
+    def similarity_search_by_vectors_with_relevance_scores(
+        self, embeddings: List[List[float]], k: int = 4,
+    ) -> List[List[Tuple[Document, float]]]:
+        """Search by all the query vectors with one matrix product, the results of each query in the given order."""
+        queries = _normalize(np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1))
+        rows_list, similarities_list = self._search(queries, k)
+        return [
+            [
+                (Document(page_content=self._documents[row], metadata=self._metadatas[row]), float(2 - 2 * similarity))
+                for row, similarity in zip(rows, similarities)
+            ]
+            for rows, similarities in zip(rows_list, similarities_list)
+        ]
+
+
+def build_numpy_vector_store(
+    directory: str,
+    embedding: Embeddings,
+    documents: List[Document],
+    ids: List[str],
+    fingerprint: str,
+    index: str = "flat",
+    batch_size: int = 256,
+    hnsw_config: dict = None,
+) -> None:
+    """Embed the documents and write them into a new version of the store in `directory`, and then switch to it by
+    replacing the `CURRENT` pointer file atomically, so that the store is never missing while being rebuilt and a
+    crashed build leaves the old version in use.
+    """
+    os.makedirs(directory, exist_ok=True)
+    current_directory = _get_current_directory(directory)
+
+    # Clean up the versions left by the crashed builds.
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith(_VERSION_PREFIX) and os.path.isdir(path) and path != current_directory:
+            shutil.rmtree(path)
+
+    version = f"{_VERSION_PREFIX}{time.time_ns()}"
+    version_directory = os.path.join(directory, version)
+    os.makedirs(version_directory)
+
+    start_time = time.perf_counter()
+    dimension: Optional[int] = None
+    with open(os.path.join(version_directory, _VECTORS_FILENAME), "wb") as fvec:
+        for start in range(0, len(documents), batch_size):
+            batch_docs = documents[start:start + batch_size]
+            vectors = np.asarray(embedding.embed_documents([doc.page_content for doc in batch_docs]), dtype=np.float32)
+            dimension = vectors.shape[1]
+            fvec.write(np.ascontiguousarray(_normalize(vectors)).tobytes())
+        print(
+            f"[Numpy Vector Store] {len(documents)} documents embedded in {time.perf_counter() - start_time:.1f}s."
+        )
+
+    with open(os.path.join(version_directory, _RECORDS_FILENAME), "w", encoding="utf-8") as fout:
+        for doc_id, doc in zip(ids, documents):
+            fout.write(json.dumps([doc_id, doc.page_content, doc.metadata or {}], ensure_ascii=False) + "\n")
+
+    if index == "hnsw":
+        import hnswlib
+
+        hnsw_config = hnsw_config or {}
+        vectors_path = os.path.join(version_directory, _VECTORS_FILENAME)
+        matrix = np.fromfile(vectors_path, dtype=np.float32).reshape(-1, dimension)
+        hnsw = hnswlib.Index(space="ip", dim=dimension)
+        hnsw.init_index(
+            max_elements=len(matrix),
+            M=hnsw_config.get("M", 32),
+            ef_construction=hnsw_config.get("ef_construction", 200),
+        )
+        hnsw.add_items(matrix, np.arange(len(matrix)))
+        hnsw.save_index(os.path.join(version_directory, _HNSW_FILENAME))
+
+    # Write the meta last, a directory without it is an incomplete build.
+    with open(os.path.join(version_directory, _META_FILENAME), "w", encoding="utf-8") as fout:
+        json.dump(
+            {"dimension": dimension, "num_documents": len(documents), "index": index, "fingerprint": fingerprint},
+            fout,
+        )
+
+    current_path = os.path.join(directory, _CURRENT_FILENAME)
+    with open(f"{current_path}.tmp", "w", encoding="utf-8") as fout:
+        fout.write(version)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(f"{current_path}.tmp", current_path)
+
+    # The processes having mapped the old files keep reading them until they reopen the store.
+    if current_directory != directory:
+        shutil.rmtree(current_directory, ignore_errors=True)
+    else:
+        for filename in (_META_FILENAME, _VECTORS_FILENAME, _RECORDS_FILENAME, _HNSW_FILENAME):
+            if os.path.exists(os.path.join(directory, filename)):
+                os.remove(os.path.join(directory, filename))
+    return
+
+
+def load_numpy_vector_store(
+    collection_name: str,
+    persist_directory: str,
+    embedding: Embeddings,
+    documents: List[Document] = None,
+    ids: List[str] = None,
+    index: str = "flat",
+    ef_search: int = 64,
+    batch_size: int = 256,
+    hnsw_config: dict = None,
+) -> NumpyVectorStore:
+    """Load the `NumpyVectorStore` in `persist_directory/collection_name`, it is (re-)built up if its fingerprint does
+    not match the given `documents`. The documents without ids are given the content-hash ids.
+    """
+    assert index in INDEX_TYPES, f"Unrecognized index: {index}, should be one of {INDEX_TYPES}."
+
+    directory = os.path.join(persist_directory, collection_name)
+
+    if documents is not None and len(documents) > 0:
+        manifest = CollectionManifest.from_documents(documents, ids)
+        if ids is None:
+            ids = list(manifest.entries.keys())
+
+        meta: Optional[dict] = None
+        meta_path = os.path.join(_get_current_directory(directory), _META_FILENAME)
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as fin:
+                meta = json.load(fin)
+
+        if meta is None or meta["fingerprint"] != manifest.fingerprint or meta["index"] != index:
+            print(f"Start to build up the Numpy Vector Store: {collection_name}")
+            build_numpy_vector_store(
+                directory, embedding, documents, ids, manifest.fingerprint, index, batch_size, hnsw_config,
+            )
+            print(f"Numpy Vector Store: {collection_name} Building-Up finished.")
+
+    assert os.path.exists(os.path.join(_get_current_directory(directory), _META_FILENAME)), (
+        f"No Numpy Vector Store exists in {directory}!"
+    )
+    vector_store = NumpyVectorStore(directory, embedding, ef_search)
+    print(f"Numpy Vector Store: {collection_name} loaded.")
+    return vector_store
@@ -5,6 +5,10 @@ from pikerag.llm_client.azure_meta_llama_client import AzureMetaLlamaClient
 from pikerag.llm_client.azure_open_ai_client import AzureOpenAIClient
 from pikerag.llm_client.base import BaseLLMClient
 from pikerag.llm_client.hf_meta_llama_client import HFMetaLlamaClient
+from pikerag.llm_client.mock_client import MockLLMClient
+from pikerag.llm_client.pooled_client import PooledLLMClient
 
 
-__all__ = ["AzureMetaLlamaClient", "AzureOpenAIClient", "BaseLLMClient", "HFMetaLlamaClient"]
+__all__ = [
+    "AzureMetaLlamaClient", "AzureOpenAIClient", "BaseLLMClient", "HFMetaLlamaClient", "MockLLMClient", "PooledLLMClient",
+]
@@ -3,24 +3,32 @@
 
 import json
 import os
-import urllib.request
 from typing import List
 
 from pikerag.llm_client.base import BaseLLMClient
+from pikerag.llm_client.http_session import HttpSessionMixin
 from pikerag.utils.logger import Logger
 
 
-class AzureMetaLlamaClient(BaseLLMClient):
+class AzureMetaLlamaClient(BaseLLMClient, HttpSessionMixin):
     NAME = "AzureMetaLlamaClient"
 
     def __init__(
         self, location: str = None, auto_dump: bool = True, logger: Logger=None,
-        max_attempt: int = 5, exponential_backoff_factor: int = None, unit_wait_time: int = 60, **kwargs,
+        max_attempt: int = 5, exponential_backoff_factor: int = None, unit_wait_time: int = 60,
+        cache_backend: str = "sqlite", max_concurrency: int = 64, rate_limit_config: dict = None,
+        memory_cache_config: dict = None, stream_early_stop: bool = False, **kwargs,
     ) -> None:
-        super().__init__(location, auto_dump, logger, max_attempt, exponential_backoff_factor, unit_wait_time, **kwargs)
+        super().__init__(
+            location, auto_dump, logger, max_attempt, exponential_backoff_factor, unit_wait_time, cache_backend,
+            max_concurrency, rate_limit_config, memory_cache_config, stream_early_stop, **kwargs,
+        )
 
         self._init_agent(**kwargs)
 
+        # Keep-alive connections pooled per endpoint host, see `HttpSessionMixin` for the configurable fields.
+        self._init_http_session(**kwargs.get("http_config", {}))
+
     def _init_agent(self, **kwargs) -> None:
         llama_endpoint_name = kwargs.get("llama_endpoint_name", None)
         if llama_endpoint_name is None:
@@ -54,25 +62,10 @@ class AzureMetaLlamaClient(BaseLLMClient):
         return body
 
     def _get_response_with_messages(self, messages: List[dict], **llm_config) -> bytes:
-        response: bytes = None
-        num_attempt: int = 0
-        while num_attempt < self._max_attempt:
-            try:
-                header = self._wrap_header(**llm_config)
-                body = self._wrap_body(messages, **llm_config)
-                req = urllib.request.Request(self._endpoint, body, header)
-                response = urllib.request.urlopen(req).read()
-                break
-
-            except urllib.error.HTTPError as error:
-                self.warning(f"  Failed due to Exception: {str(error.code)}")
-                print(error.info())
-                print(error.read().decode("utf8", 'ignore'))
-                num_attempt += 1
-                self._wait(num_attempt)
-                self.warning(f"  Retrying...")
-
-        return response
+        return self._post_with_retry(messages, llm_config)
+
+    async def _aget_response_with_messages(self, messages: List[dict], **llm_config) -> bytes:
+        return await self._apost_with_retry(messages, llm_config)
 
     def _get_content_from_response(self, response: bytes, messages: List[dict] = None) -> str:
         try:
@@ -90,3 +83,11 @@ class AzureMetaLlamaClient(BaseLLMClient):
             content = ""
 
         return content
+
+    def close(self):
+        super().close()
+        self._close_http_session()
+
+    async def aclose(self):
+        await super().aclose()
+        await self._aclose_http_session()
@@ -4,17 +4,23 @@
 import json
 import os
 import re
+import threading
 import time
-from typing import Callable, List, Literal, Optional, Union
+from typing import Any, Awaitable, Callable, Dict, List, Literal, Optional, Tuple, Union
 
 import openai
 from langchain_core.embeddings import Embeddings
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI, AzureOpenAI
 from openai.types import CreateEmbeddingResponse
 from openai.types.chat.chat_completion import ChatCompletion
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
 from pickledb import PickleDB
 
-from pikerag.llm_client.base import BaseLLMClient
+from pikerag.llm_client.base import BaseLLMClient, LLMRequestFailedError
+from pikerag.llm_client.batching import TokenPackedBatcher
+from pikerag.llm_client.embedding_cache import MmapEmbeddingCache, infer_cache_backend
+from pikerag.llm_client.rate_limiter import RateLimiter, estimate_num_tokens, get_rate_limiter, parse_retry_after
+from pikerag.utils.completion_detector import BaseCompletionDetector
 from pikerag.utils.logger import Logger
 
 
@@ -28,6 +34,17 @@ def get_azure_active_directory_token_provider() -> Callable[[], str]:
 
 
 def parse_wait_time_from_error(error: openai.RateLimitError) -> Optional[int]:
+    # Prefer the retry-after headers if provided.
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers is not None:
+        for header_name in ["retry-after-ms", "retry-after"]:
+            header_value = headers.get(header_name, None)
+            if header_value is not None and header_name == "retry-after-ms":
+                header_value = f"{header_value}ms"
+            wait_time = parse_retry_after(header_value)
+            if wait_time is not None:
+                return wait_time
+
     try:
         info_str: str = error.args[0]
         info_dict_str: str = info_str[info_str.find("{"):]
@@ -40,12 +57,41 @@ def parse_wait_time_from_error(error: openai.RateLimitError) -> Optional[int]:
         return None
 
 
+def _get_total_tokens(response: Union[ChatCompletion, CreateEmbeddingResponse]) -> Optional[int]:
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+
+class StreamedChatCompletion(object):
+    """The content collected from a streaming chat completion, possibly terminated early."""
+    def __init__(self) -> None:
+        self.content: str = ""
+        self.finish_reason: Optional[str] = None
+        self.num_chunks: int = 0
+        self.terminated_early: bool = False
+
+    def update(self, chunk: ChatCompletionChunk, completion_detector: BaseCompletionDetector) -> bool:
+        """Feed the chunk to the detector, return True if the stream can be terminated."""
+        if len(chunk.choices) == 0:
+            return False
+
+        choice = chunk.choices[0]
+        if choice.finish_reason is not None:
+            self.finish_reason = choice.finish_reason
+        if choice.delta is not None and choice.delta.content:
+            self.num_chunks += 1
+            self.terminated_early = completion_detector.feed(choice.delta.content) and choice.finish_reason is None
+        return self.terminated_early
+
+
 class AzureOpenAIClient(BaseLLMClient):
     NAME = "AzureOpenAIClient"
 
     def __init__(
         self, location: str = None, auto_dump: bool = True, logger: Logger = None,
-        max_attempt: int = 5, exponential_backoff_factor: int = None, unit_wait_time: int = 60, **kwargs,
+        max_attempt: int = 5, exponential_backoff_factor: int = None, unit_wait_time: int = 60,
+        cache_backend: str = "sqlite", max_concurrency: int = 64, rate_limit_config: dict = None,
+        memory_cache_config: dict = None, stream_early_stop: bool = False, **kwargs,
     ) -> None:
         """LLM Communication Client for Azure OpenAI endpoints.
 
@@ -62,38 +108,64 @@ class AzureOpenAIClient(BaseLLMClient):
             unit_wait_time (int): `unit_wait_time` would be used only if the exponential backoff mode is disabled. Every
                 time the wait time would be `unit_wait_time * num_attempt`, with seconds (s) as the time unit. Defaults
                 to 60.
+            cache_backend (str): the backend of the communication cache, "sqlite" or "pickledb". Defaults to "sqlite".
+            max_concurrency (int): maximum number of in-flight requests in `agenerate_content_with_messages()`.
+                Defaults to 64.
+            rate_limit_config (dict): the config of the process-wide `RateLimiter` shared by the clients with the same
+                `name` (defaults to "default"), e.g. `requests_per_minute`, `tokens_per_minute`, `max_concurrency`.
+                Defaults to None, i.e. no quota but all the workers still back off together when throttled.
+            memory_cache_config (dict): the config of the in-memory LRU tier in front of the communication cache,
+                `max_bytes` (defaults to 64 MiB, set to 0 to disable) and `ttl` in seconds (defaults to None, i.e.
+                never expire). Defaults to None, i.e. the default config.
+            stream_early_stop (bool): stream the completions of the calls given a `completion_detector`, and terminate
+                the stream once the output is decodable, e.g. the answer json closed, to save the tokens of the
+                trailing text. Defaults to False.
         """
-        super().__init__(location, auto_dump, logger, max_attempt, exponential_backoff_factor, unit_wait_time, **kwargs)
+        super().__init__(
+            location, auto_dump, logger, max_attempt, exponential_backoff_factor, unit_wait_time, cache_backend,
+            max_concurrency, rate_limit_config, memory_cache_config, stream_early_stop, **kwargs,
+        )
 
         client_configs = kwargs.get("client_config", {})
         if client_configs.get("api_key", None) is None and os.environ.get("AZURE_OPENAI_API_KEY", None) is None:
             client_configs["azure_ad_token_provider"] = get_azure_active_directory_token_provider()
 
+        self._client_configs: dict = client_configs
         self._client = AzureOpenAI(**client_configs)
+        # The async client is created on its first use so that sync-only users pay nothing for it.
+        self._async_client: AsyncAzureOpenAI = None
 
-    def _get_response_with_messages(self, messages: List[dict], **llm_config) -> ChatCompletion:
-        response: ChatCompletion = None
+    def _call_with_retry(self, messages: List[dict], llm_config: dict, request_fn: Callable[[], Any]) -> Any:
+        response = None
         num_attempt: int = 0
         while num_attempt < self._max_attempt:
             try:
-                # TODO: handling the kwargs not passed issue for other Clients
-                response = self._client.chat.completions.create(messages=messages, **llm_config)
+                with self._rate_limiter.limit(
+                    estimate_num_tokens(messages, llm_config), openai.RateLimitError, parse_wait_time_from_error,
+                ) as ticket:
+                    response = request_fn()
+                    ticket.num_tokens_used = _get_total_tokens(response)
                 break
 
             except openai.RateLimitError as e:
-                self.warning("  Failed due to RateLimitError...")
                 # NOTE: mask the line below to keep trying if failed due to RateLimitError.
                 # num_attempt += 1
-                wait_time = parse_wait_time_from_error(e)
-                self._wait(num_attempt, wait_time=wait_time)
-                self.warning(f"  Retrying...")
+                # The shared rate limiter already makes all workers back off, no need to wait here.
+                self._record_retry(llm_config, type(e).__name__)
+                if self._fail_fast:
+                    raise LLMRequestFailedError(type(e).__name__, parse_wait_time_from_error(e)) from e
+                self.warning("  Failed due to RateLimitError, retrying after the shared back-off...")
 
             except openai.BadRequestError as e:
+                self._record_skip(llm_config, type(e).__name__)
                 self.warning(f"  Failed due to Exception: {e}")
                 self.warning(f"  Skip this request...")
                 break
 
             except Exception as e:
+                self._record_retry(llm_config, type(e).__name__)
+                if self._fail_fast:
+                    raise LLMRequestFailedError(type(e).__name__) from e
                 self.warning(f"  Failed due to Exception: {e}")
                 num_attempt += 1
                 self._wait(num_attempt)
@@ -101,7 +173,132 @@ class AzureOpenAIClient(BaseLLMClient):
 
         return response
 
-    def _get_content_from_response(self, response: ChatCompletion, messages: List[dict] = None) -> str:
+    async def _acall_with_retry(
+        self, messages: List[dict], llm_config: dict, request_fn: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        response = None
+        num_attempt: int = 0
+        while num_attempt < self._max_attempt:
+            try:
+                async with self._rate_limiter.alimit(
+                    estimate_num_tokens(messages, llm_config), openai.RateLimitError, parse_wait_time_from_error,
+                ) as ticket:
+                    response = await request_fn()
+                    ticket.num_tokens_used = _get_total_tokens(response)
+                break
+
+            except openai.RateLimitError as e:
+                # NOTE: keep trying if failed due to RateLimitError, same as the sync version.
+                self._record_retry(llm_config, type(e).__name__)
+                if self._fail_fast:
+                    raise LLMRequestFailedError(type(e).__name__, parse_wait_time_from_error(e)) from e
+                self.warning("  Failed due to RateLimitError, retrying after the shared back-off...")
+
+            except openai.BadRequestError as e:
+                self._record_skip(llm_config, type(e).__name__)
+                self.warning(f"  Failed due to Exception: {e}")
+                self.warning(f"  Skip this request...")
+                break
+
+            except Exception as e:
+                self._record_retry(llm_config, type(e).__name__)
+                if self._fail_fast:
+                    raise LLMRequestFailedError(type(e).__name__) from e
+                self.warning(f"  Failed due to Exception: {e}")
+                num_attempt += 1
+                await self._async_wait(num_attempt)
+                self.warning(f"  Retrying...")
+
+        return response
+
+    def _get_async_client(self) -> AsyncAzureOpenAI:
+        if self._async_client is None:
+            self._async_client = AsyncAzureOpenAI(**self._client_configs)
+        return self._async_client
+
+    def _get_response_with_messages(self, messages: List[dict], **llm_config) -> ChatCompletion:
+        # TODO: handling the kwargs not passed issue for other Clients
+        return self._call_with_retry(
+            messages, llm_config, lambda: self._client.chat.completions.create(messages=messages, **llm_config),
+        )
+
+    async def _aget_response_with_messages(self, messages: List[dict], **llm_config) -> ChatCompletion:
+        async_client = self._get_async_client()
+        return await self._acall_with_retry(
+            messages, llm_config, lambda: async_client.chat.completions.create(messages=messages, **llm_config),
+        )
+
+    def _stream_chat_completion(
+        self, messages: List[dict], completion_detector: BaseCompletionDetector, llm_config: dict,
+    ) -> StreamedChatCompletion:
+        # Start over in case the detector was fed by a failed attempt.
+        completion_detector.reset()
+        response = StreamedChatCompletion()
+        stream = self._client.chat.completions.create(messages=messages, stream=True, **llm_config)
+        try:
+            for chunk in stream:
+                if response.update(chunk, completion_detector):
+                    break
+        finally:
+            # Closing the connection makes the service stop generating the rest.
+            stream.close()
+        response.content = completion_detector.content
+        self._record_stream_end(llm_config, response)
+        return response
+
+    async def _astream_chat_completion(
+        self, messages: List[dict], completion_detector: BaseCompletionDetector, llm_config: dict,
+    ) -> StreamedChatCompletion:
+        completion_detector.reset()
+        response = StreamedChatCompletion()
+        stream = await self._get_async_client().chat.completions.create(messages=messages, stream=True, **llm_config)
+        try:
+            async for chunk in stream:
+                if response.update(chunk, completion_detector):
+                    break
+        finally:
+            await stream.close()
+        response.content = completion_detector.content
+        self._record_stream_end(llm_config, response)
+        return response
+
+    def _record_stream_end(self, llm_config: dict, response: StreamedChatCompletion) -> None:
+        if response.terminated_early:
+            self._telemetry.record_early_stop(self._get_model_name(llm_config))
+        return
+
+    def _get_streamed_response_with_messages(
+        self, messages: List[dict], completion_detector: BaseCompletionDetector, **llm_config,
+    ) -> StreamedChatCompletion:
+        return self._call_with_retry(
+            messages, llm_config, lambda: self._stream_chat_completion(messages, completion_detector, llm_config),
+        )
+
+    async def _aget_streamed_response_with_messages(
+        self, messages: List[dict], completion_detector: BaseCompletionDetector, **llm_config,
+    ) -> StreamedChatCompletion:
+        return await self._acall_with_retry(
+            messages, llm_config, lambda: self._astream_chat_completion(messages, completion_detector, llm_config),
+        )
+
+    def _get_token_usage(
+        self, response: Union[ChatCompletion, StreamedChatCompletion],
+    ) -> Tuple[Optional[int], Optional[int]]:
+        if isinstance(response, StreamedChatCompletion):
+            # Usage is not reported for the streams terminated early, every chunk is about one token.
+            return None, response.num_chunks
+
+        usage = getattr(response, "usage", None)
+        return getattr(usage, "prompt_tokens", None), getattr(usage, "completion_tokens", None)
+
+    def _get_content_from_response(
+        self, response: Union[ChatCompletion, StreamedChatCompletion], messages: List[dict] = None,
+    ) -> str:
+        if isinstance(response, StreamedChatCompletion):
+            if response.content == "":
+                self.warning(f"Non-Content returned due to {response.finish_reason}")
+            return response.content
+
         try:
             content = response.choices[0].message.content
             if content is None:
@@ -133,8 +330,17 @@ class AzureOpenAIClient(BaseLLMClient):
         super().close()
         self._client.close()
 
+    async def aclose(self):
+        await super().aclose()
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
+
 
 class AzureOpenAIEmbedding(Embeddings):
+    # The `cache_config` is handled by itself instead of wrapped by `load_embedding_func()`.
+    MANAGES_CACHE: bool = True
+
     def __init__(self, **kwargs) -> None:
         client_configs = kwargs.get("client_config", {})
         if client_configs.get("api_key", None) is None and os.environ.get("AZURE_OPENAI_API_KEY", None) is None:
@@ -144,57 +350,131 @@ class AzureOpenAIEmbedding(Embeddings):
 
         self._model = kwargs.get("model", "text-embedding-ada-002")
 
+        rate_limit_config = dict(kwargs.get("rate_limit_config", {}))
+        self._rate_limiter: RateLimiter = get_rate_limiter(rate_limit_config.pop("name", "default"), **rate_limit_config)
+
+        # The embeddings are cached in a memory-mapped matrix directory, or in a legacy PickleDB file. The backend is
+        # inferred from the location if not given, so that the existing PickleDB caches keep working. Run
+        # `python -m pikerag.llm_client.embedding_cache` to import them into an mmap cache.
         cache_config = kwargs.get("cache_config", {})
         cache_location = cache_config.get("location", None)
-        auto_dump = cache_config.get("auto_dump", True)
-        if cache_location is not None:
-            self._cache: PickleDB = PickleDB(location=cache_location)
-        else:
+        cache_backend = cache_config.get("backend", None)
+        if cache_backend is None and cache_location is not None:
+            cache_backend = infer_cache_backend(cache_location)
+        assert cache_backend in (None, "mmap", "pickledb"), f"Unrecognized embedding cache backend: {cache_backend}"
+        if cache_location is None:
             self._cache = None
+        elif cache_backend == "mmap":
+            self._cache: MmapEmbeddingCache = MmapEmbeddingCache(
+                location=cache_location,
+                dtype=cache_config.get("dtype", "float32"),
+                readonly=cache_config.get("readonly", False),
+                model_id=f"{self.__class__.__name__}:{self._model}",
+            )
+        else:
+            self._cache: PickleDB = PickleDB(location=cache_location)
+        self._cache_lock = threading.Lock()
+
+        # The transient errors are retried with the same back-off args as the `BaseLLMClient`.
+        self._max_attempt: int = kwargs.get("max_attempt", 5)
+        self._exponential_backoff_factor: Optional[int] = kwargs.get("exponential_backoff_factor", None)
+        self._unit_wait_time: int = kwargs.get("unit_wait_time", 60)
+
+        # Texts packed into batches by token count, see `TokenPackedBatcher` for the configurable fields.
+        self._batcher = TokenPackedBatcher(
+            self._embed_batch, throttle_errors=(openai.RateLimitError,), **kwargs.get("batch_config", {}),
+        )
 
     def _save_cache(self, query: str, embedding: List[float]) -> None:
         if self._cache is None:
             return
 
-        self._cache.set(query, embedding)
+        if isinstance(self._cache, MmapEmbeddingCache):
+            if not self._cache.readonly:
+                self._cache.set(query, embedding)
+            return
+
+        with self._cache_lock:
+            self._cache.set(query, embedding)
         return
 
     def _get_cache(self, query: str) -> Union[List[float], Literal[False]]:
+        return self._get_cache_many([query])[0]
+
+    def _get_cache_many(self, queries: List[str]) -> List[Union[List[float], Literal[False]]]:
         if self._cache is None:
-            return False
+            return [False] * len(queries)
 
-        return self._cache.get(query)
+        if isinstance(self._cache, MmapEmbeddingCache):
+            return [vector.tolist() if vector is not None else False for vector in self._cache.get_many(queries)]
 
-    def _get_response(self, texts: Union[str, List[str]]) -> CreateEmbeddingResponse:
+        with self._cache_lock:
+            embeddings = [self._cache.get(query) for query in queries]
+        return [embedding if embedding is not None else False for embedding in embeddings]
+
+    def _get_wait_time(self, num_attempt: int) -> float:
+        if self._exponential_backoff_factor is None:
+            return self._unit_wait_time * num_attempt
+        return self._exponential_backoff_factor ** num_attempt
+
+    def _create_embeddings(self, texts: Union[str, List[str]]) -> CreateEmbeddingResponse:
+        """Send one request under the rate limiter. The connection errors and the server errors are retried with the
+        back-off up to `max_attempt` times, the RateLimitError and the other errors are raised to the caller.
+        """
+        num_tokens = sum(len(text) for text in ([texts] if isinstance(texts, str) else texts)) // 4
+        num_attempt: int = 0
         while True:
             try:
-                response = self._client.embeddings.create(input=texts, model=self._model)
-                break
-
-            except openai.RateLimitError as e:
-                expected_wait = parse_wait_time_from_error(e)
-                if e is not None:
-                    print(f"Embedding failed due to RateLimitError, wait for {expected_wait} seconds")
-                    time.sleep(expected_wait)
-                else:
-                    print(f"Embedding failed due to RateLimitError, but failed parsing expected waiting time, wait for 30 seconds")
-                    time.sleep(30)
+                with self._rate_limiter.limit(num_tokens, openai.RateLimitError, parse_wait_time_from_error) as ticket:
+                    response = self._client.embeddings.create(input=texts, model=self._model)
+                    ticket.num_tokens_used = _get_total_tokens(response)
+                return response
 
-            except Exception as e:
-                print(f"Embedding failed due to exception {e}")
-                exit(0)
+            except (openai.APIConnectionError, openai.InternalServerError) as e:
+                num_attempt += 1
+                if num_attempt >= self._max_attempt:
+                    raise
+                print(f"Embedding failed due to {type(e).__name__}: {e}, retrying...")
+                time.sleep(self._get_wait_time(num_attempt))
 
-        return response
+    def _get_response(self, texts: Union[str, List[str]]) -> CreateEmbeddingResponse:
+        while True:
+            try:
+                return self._create_embeddings(texts)
 
-    def embed_documents(self, texts: List[str], batch_call: bool=False) -> List[List[float]]:
-        # NOTE: call self._get_response(texts) would cause RateLimitError, it may due to large batch size.
-        if batch_call is True:
-            response = self._get_response(texts)
-            embeddings = [res.embedding for res in response.data]
-        else:
-            embeddings = [self.embed_query(text) for text in texts]
+            except openai.RateLimitError as e:
+                # The shared rate limiter already makes all workers back off, no need to wait here.
+                print(f"Embedding failed due to RateLimitError, retrying after the shared back-off...")
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Embed the texts with one request, the RateLimitError is raised for the batcher to shrink the batches."""
+        response = self._create_embeddings(texts)
+        return [res.embedding for res in sorted(response.data, key=lambda res: res.index)]
+
+    def embed_documents(self, texts: List[str], batch_call: bool=True) -> List[List[float]]:
+        if batch_call is not True:
+            return [self.embed_query(text) for text in texts]
+
+        # Only the distinct texts missing in the cache are sent, packed into batches by token count.
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        missing_indices: Dict[str, List[int]] = {}
+        for idx, (text, embedding) in enumerate(zip(texts, self._get_cache_many(texts))):
+            if embedding is False:
+                missing_indices.setdefault(text, []).append(idx)
+            else:
+                embeddings[idx] = embedding
+
+        if len(missing_indices) > 0:
+            missing_texts = list(missing_indices.keys())
+            for text, embedding in zip(missing_texts, self._batcher.run(missing_texts, on_result=self._save_cache)):
+                for idx in missing_indices[text]:
+                    embeddings[idx] = embedding
         return embeddings
 
+    @property
+    def batch_stats(self) -> Dict[str, float]:
+        return self._batcher.stats
+
     def embed_query(self, text: str) -> List[float]:
         embedding =  self._get_cache(text)
         if embedding is False:
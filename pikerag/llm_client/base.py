@@ -2,14 +2,33 @@
 # Licensed under the MIT license.
 
 from abc import abstractmethod
-import json
+import asyncio
 import time
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Any, Dict, List, Literal, Optional, Union
+from typing import Any, Dict, Iterable, Iterator, List, Literal, Optional, Tuple, Union
+
+from pikerag.llm_client.batch import BatchRequestCollector
+from pikerag.llm_client.cache import BaseLLMCache, MemoryLRUCache, TieredCache, generate_cache_key, load_llm_cache
+from pikerag.llm_client.rate_limiter import RateLimiter, get_rate_limiter
+from pikerag.llm_client.single_flight import SingleFlight
+from pikerag.llm_client.telemetry import LLMTelemetry, get_llm_telemetry
+from pikerag.utils.completion_detector import BaseCompletionDetector
+from pikerag.utils.logger import Logger
 
-from pickledb import PickleDB
 
-from pikerag.utils.logger import Logger
+class LLMRequestFailedError(Exception):
+    """Raised by the clients in fail-fast mode, see `BaseLLMClient.set_fail_fast()`, instead of waiting and retrying on
+    the throttled, server-error or connection-failed requests, so that the caller can try another endpoint.
+
+    Args:
+        reason (str): the error type, e.g. "RateLimitError", "HTTP503".
+        retry_after (Optional[float]): the seconds the endpoint asked to wait before the next request, if given.
+    """
+    def __init__(self, reason: str, retry_after: Optional[float] = None) -> None:
+        super().__init__(reason)
+        self.reason: str = reason
+        self.retry_after: Optional[float] = retry_after
 
 
 class BaseLLMClient(object):
@@ -17,10 +36,20 @@ class BaseLLMClient(object):
 
     def __init__(
         self, location: str = None, auto_dump: bool = True, logger: Logger = None,
-        max_attempt: int = 5, exponential_backoff_factor: int = None, unit_wait_time: int = 60, **kwargs,
+        max_attempt: int = 5, exponential_backoff_factor: int = None, unit_wait_time: int = 60,
+        cache_backend: str = "sqlite", max_concurrency: int = 64, rate_limit_config: dict = None,
+        memory_cache_config: dict = None, stream_early_stop: bool = False, **kwargs,
     ) -> None:
         self._cache_auto_dump: bool = auto_dump
-        self._cache: PickleDB = None
+        self._cache_backend: str = cache_backend
+        self._cache: BaseLLMCache = None
+
+        # The memory tier lives across the cache locations, and is cleared on switching. Disabled if `max_bytes` is 0.
+        memory_cache_config = {} if memory_cache_config is None else memory_cache_config
+        self._memory_cache: Optional[MemoryLRUCache] = None
+        if memory_cache_config.get("max_bytes", None) != 0:
+            self._memory_cache = MemoryLRUCache(**memory_cache_config)
+
         if location is not None:
             self.update_cache_location(location)
 
@@ -40,6 +69,31 @@ class BaseLLMClient(object):
                 f"(but {exponential_backoff_factor} was given)!"
             )
 
+        # The asyncio semaphore is bound to the event loop it is first used in, thus created lazily.
+        self._max_concurrency: int = max_concurrency
+        assert max_concurrency >= 1, f"max_concurrency should be no less than 1 (but {max_concurrency} was given)!"
+        self._async_semaphore: asyncio.Semaphore = None
+        self._async_semaphore_loop: asyncio.AbstractEventLoop = None
+
+        # The rate limiter is shared process-wide by the clients (and embeddings) configured with the same name.
+        rate_limit_config = dict(rate_limit_config or {})
+        self._rate_limiter: RateLimiter = get_rate_limiter(rate_limit_config.pop("name", "default"), **rate_limit_config)
+
+        # Concurrent cache-missing requests with the same cache key would share one LLM call.
+        self._single_flight = SingleFlight()
+
+        # Stream the completions given a completion detector, and stop once the output is decodable.
+        self._stream_early_stop: bool = stream_early_stop
+
+        # Raise `LLMRequestFailedError` instead of waiting and retrying if set, see `set_fail_fast()`.
+        self._fail_fast: bool = False
+
+        # Set by `collect_batch_requests()` to collect the cache-missing requests instead of sending them.
+        self._batch_collector: Optional[BatchRequestCollector] = None
+
+        # The telemetry is shared process-wide, broken down by model and the tag set by `llm_call_tag()`.
+        self._telemetry: LLMTelemetry = get_llm_telemetry()
+
         self.logger = logger
 
     def warning(self, warning_message: str) -> None:
@@ -54,38 +108,61 @@ class BaseLLMClient(object):
             self.logger.debug(msg=debug_message)
         return
 
-    def _wait(self, num_attempt: int, wait_time: Optional[int] = None) -> None:
+    def set_fail_fast(self, fail_fast: bool = True) -> None:
+        """In fail-fast mode, the requests failed due to throttling, server errors or connection errors raise
+        `LLMRequestFailedError` right away instead of waiting and retrying, e.g. for `PooledLLMClient` to fail over to
+        another endpoint. Requests skipped due to bad request still return None.
+        """
+        self._fail_fast = fail_fast
+        return
+
+    def _get_wait_time(self, num_attempt: int, wait_time: Optional[int] = None) -> float:
         if wait_time is None:
             if self._exponential_backoff_factor is None:
                 wait_time = self._unit_wait_time * num_attempt
             else:
                 wait_time = self._exponential_backoff_factor ** num_attempt
+        return wait_time
+
+    def _wait(self, num_attempt: int, wait_time: Optional[int] = None) -> None:
+        time.sleep(self._get_wait_time(num_attempt, wait_time))
+        return
 
-        time.sleep(wait_time)
+    async def _async_wait(self, num_attempt: int, wait_time: Optional[int] = None) -> None:
+        await asyncio.sleep(self._get_wait_time(num_attempt, wait_time))
         return
 
+    def _get_async_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._async_semaphore is None or self._async_semaphore_loop is not loop:
+            self._async_semaphore = asyncio.Semaphore(self._max_concurrency)
+            self._async_semaphore_loop = loop
+        return self._async_semaphore
+
     def _generate_cache_key(self, messages: List[dict], llm_config: dict) -> str:
         assert isinstance(messages, List) and len(messages) > 0
 
         if isinstance(messages[0], Dict):
-            return json.dumps((messages, llm_config))
+            return generate_cache_key(messages, llm_config)
 
         else:
             raise ValueError(f"Messages with unsupported type: {type(messages[0])}")
 
-    def _save_cache(self, messages: List[dict], llm_config: dict, content: str) -> None:
+    def _save_cache(self, messages: List[dict], llm_config: dict, content: str, key: str = None) -> None:
         if self._cache is None:
             return
 
-        key = self._generate_cache_key(messages, llm_config)
+        if key is None:
+            key = self._generate_cache_key(messages, llm_config)
         self._cache.set(key, content)
         return
 
-    def _get_cache(self, messages: List[dict], llm_config: dict) -> Union[str, Literal[False]]:
+    def _get_cache(self, messages: List[dict], llm_config: dict, key: str = None) -> Union[str, Literal[False]]:
         if self._cache is None:
             return False
 
-        key = self._generate_cache_key(messages, llm_config)
+        if key is None:
+            key = self._generate_cache_key(messages, llm_config)
         value = self._cache.get(key)
         return value
 
@@ -97,53 +174,243 @@ class BaseLLMClient(object):
         self._cache.remove(key)
         return
 
-    def generate_content_with_messages(self, messages: List[dict], **llm_config) -> str:
+    def _on_request_start(self) -> float:
+        if self.logger is not None:
+            self.logger.debug(msg=f"{datetime.now()} create completion...", tag=self.NAME)
+        return time.time()
+
+    def _on_response(
+        self, messages: List[dict], llm_config: dict, response: Any, start_time: float, key: str = None,
+    ) -> str:
+        """Extract the content from the response and update the cache, shared by the sync and the async paths."""
+        time_used = time.time() - start_time
+        if self.logger is not None:
+            result = "receive response" if response is not None else "request failed"
+            self.logger.debug(msg=f"{datetime.now()} {result}, time spent: {time_used} s.", tag=self.NAME)
+
+        prompt_tokens, completion_tokens = self._get_token_usage(response) if response is not None else (None, None)
+        self._telemetry.record_request(
+            self._get_model_name(llm_config), time_used, response is not None, prompt_tokens, completion_tokens,
+        )
+
+        if response is None:
+            self.warning("None returned as response")
+            if messages is not None and len(messages) >= 1:
+                self.debug(f"  -- Last message: {messages[-1]}")
+            content = ""
+        else:
+            content = self._get_content_from_response(response, messages=messages)
+
+        # Empty content is regarded as a cache miss anyway, no need to save it.
+        if content != "":
+            self._save_cache(messages, llm_config, content, key)
+        return content
+
+    def _is_cache_miss(self, content: Union[str, Literal[False], None]) -> bool:
+        return content is False or content is None or content == ""
+
+    def _request_content(
+        self, messages: List[dict], llm_config: dict, key: str = None,
+        completion_detector: BaseCompletionDetector = None,
+    ) -> str:
+        # Check the cache again in case it was filled by a leader finished just before this one started.
+        content = self._get_cache(messages, llm_config, key)
+        if self._is_cache_miss(content):
+            start_time = self._on_request_start()
+            if self._stream_early_stop and completion_detector is not None:
+                response = self._get_streamed_response_with_messages(messages, completion_detector, **llm_config)
+            else:
+                response = self._get_response_with_messages(messages, **llm_config)
+            content = self._on_response(messages, llm_config, response, start_time, key)
+        return content
+
+    async def _arequest_content(
+        self, messages: List[dict], llm_config: dict, key: str = None,
+        completion_detector: BaseCompletionDetector = None,
+    ) -> str:
+        content = self._get_cache(messages, llm_config, key)
+        if self._is_cache_miss(content):
+            async with self._get_async_semaphore():
+                start_time = self._on_request_start()
+                if self._stream_early_stop and completion_detector is not None:
+                    response = await self._aget_streamed_response_with_messages(
+                        messages, completion_detector, **llm_config,
+                    )
+                else:
+                    response = await self._aget_response_with_messages(messages, **llm_config)
+            content = self._on_response(messages, llm_config, response, start_time, key)
+        return content
+
+    def generate_content_with_messages(
+        self, messages: List[dict], completion_detector: BaseCompletionDetector = None, **llm_config,
+    ) -> str:
+        """Get the response content from the cache, or request the LLM if not cached.
+
+        Args:
+            messages (List[dict]): the chat messages.
+            completion_detector (BaseCompletionDetector): the detector created by the protocol that would decode the
+                output, e.g. `protocol.completion_detector()`. If given and `stream_early_stop` enabled, the completion
+                is streamed and terminated as soon as the output is decodable, the truncated content is returned and
+                cached. Defaults to None.
+            llm_config: the parameters of the LLM request, e.g. `model`, `temperature`.
+        """
         # TODO: utilize self.llm_config if None provided in call.
         # TODO: add functions to get tokens, logprobs.
-        content = self._get_cache(messages, llm_config)
+        # The key is generated once and shared by all the cache lookups and updates of this call.
+        key = self._generate_cache_key(messages, llm_config)
+        content = self._get_cache(messages, llm_config, key)
+        self._telemetry.record_cache_lookup(self._get_model_name(llm_config), not self._is_cache_miss(content))
 
-        if content is False or content is None or content == "":
-            if self.logger is not None:
-                self.logger.debug(msg=f"{datetime.now()} create completion...", tag=self.NAME)
-                start_time = time.time()
+        if self._is_cache_miss(content) and self._batch_collector is not None:
+            self._batch_collector.add(key, messages, llm_config)
+            return ""
 
-            response = self._get_response_with_messages(messages, **llm_config)
+        if self._is_cache_miss(content):
+            content, _ = self._single_flight.do(
+                key, lambda: self._request_content(messages, llm_config, key, completion_detector),
+            )
 
-            if self.logger is not None:
-                time_used = time.time() - start_time
-                result = "receive response" if response is not None else "request failed"
-                self.logger.debug(msg=f"{datetime.now()} {result}, time spent: {time_used} s.", tag=self.NAME)
+        return content
 
-            if response is None:
-                self.warning("None returned as response")
-                if messages is not None and len(messages) >= 1:
-                    self.debug(f"  -- Last message: {messages[-1]}")
-                content = ""
-            else:
-                content = self._get_content_from_response(response, messages=messages)
+    async def agenerate_content_with_messages(
+        self, messages: List[dict], completion_detector: BaseCompletionDetector = None, **llm_config,
+    ) -> str:
+        """The asyncio version of `generate_content_with_messages()`, with the same cache and retry semantics. At most
+        `max_concurrency` requests of this client would be in flight at the same time in one event loop.
+        """
+        key = self._generate_cache_key(messages, llm_config)
+        content = self._get_cache(messages, llm_config, key)
+        self._telemetry.record_cache_lookup(self._get_model_name(llm_config), not self._is_cache_miss(content))
+
+        if self._is_cache_miss(content) and self._batch_collector is not None:
+            self._batch_collector.add(key, messages, llm_config)
+            return ""
 
-            self._save_cache(messages, llm_config, content)
+        if self._is_cache_miss(content):
+            content, _ = await self._single_flight.ado(
+                key, lambda: self._arequest_content(messages, llm_config, key, completion_detector),
+            )
 
         return content
 
+    @contextmanager
+    def collect_batch_requests(self) -> Iterator[BatchRequestCollector]:
+        """Inside the context, the cache-missing calls of this client (from any thread) are collected into the yielded
+        `BatchRequestCollector` and return "" immediately instead of requesting the LLM. The requests can then be sent
+        by the Batch API and the results put into the cache by `save_batch_results()`.
+        """
+        collector = BatchRequestCollector()
+        self._batch_collector = collector
+        try:
+            yield collector
+        finally:
+            self._batch_collector = None
+
+    def save_batch_results(self, results: Iterable[Tuple[str, str]]) -> int:
+        """Save the (cache key, content) pairs of the batch results into the cache. Return the number saved."""
+        assert self._cache is not None, "A cache location must be set to save the batch results!"
+        num_saved: int = 0
+        for key, content in results:
+            if content != "":
+                self._cache.set(key, content)
+                num_saved += 1
+        return num_saved
+
+    @property
+    def single_flight_stats(self) -> Dict[str, float]:
+        """The counters of the de-duplicated in-flight requests: `num_executed` requests actually sent (or tried to be
+        sent) to the LLM, `num_coalesced` requests shared the result of an identical in-flight one, and the
+        `coalescing_ratio` of them.
+        """
+        return self._single_flight.stats
+
+    @property
+    def cache_stats(self) -> Dict[str, Dict[str, float]]:
+        """The lookup counters of the two cache tiers, to help sizing the memory one: `memory` hits / misses /
+        evictions / expirations and the bytes taken, and `persistent` hits / misses of the lookups missed in memory,
+        counted since the last cache location update. The `memory` one is empty if disabled.
+        """
+        if isinstance(self._cache, TieredCache):
+            return self._cache.stats
+        return {
+            "memory": self._memory_cache.stats if self._memory_cache is not None else {},
+            "persistent": {},
+        }
+
+    @property
+    def cache_location(self) -> Optional[str]:
+        """The location of the current cache, None if not set."""
+        return self._cache.location if self._cache is not None else None
+
+    @property
+    def telemetry(self) -> LLMTelemetry:
+        """The live per-model, per-tag call metrics, see `LLMTelemetry`. Shared by all the clients in this process."""
+        return self._telemetry
+
+    def _get_model_name(self, llm_config: dict) -> str:
+        return llm_config.get("model", None) or self.NAME
+
+    def _record_retry(self, llm_config: dict, error_type: str) -> None:
+        self._telemetry.record_retry(self._get_model_name(llm_config), error_type)
+        return
+
+    def _record_skip(self, llm_config: dict, error_type: str) -> None:
+        self._telemetry.record_skip(self._get_model_name(llm_config), error_type)
+        return
+
+    def _get_token_usage(self, response: Any) -> Tuple[Optional[int], Optional[int]]:
+        """Return the (prompt tokens, completion tokens) used by the response, None if unknown."""
+        return None, None
+
     @abstractmethod
     def _get_response_with_messages(self, messages: List[dict], **llm_config) -> Any:
         raise NotImplementedError
 
+    async def _aget_response_with_messages(self, messages: List[dict], **llm_config) -> Any:
+        """Request the LLM without blocking the event loop. Override it with a native asyncio implementation if the
+        client supports, the default one runs the sync version in a worker thread.
+        """
+        return await asyncio.to_thread(self._get_response_with_messages, messages, **llm_config)
+
+    def _get_streamed_response_with_messages(
+        self, messages: List[dict], completion_detector: BaseCompletionDetector, **llm_config,
+    ) -> Any:
+        """Stream the completion and terminate it once `completion_detector` finds the output complete. Override it if
+        the client supports streaming, the default one requests the full completion instead.
+        """
+        return self._get_response_with_messages(messages, **llm_config)
+
+    async def _aget_streamed_response_with_messages(
+        self, messages: List[dict], completion_detector: BaseCompletionDetector, **llm_config,
+    ) -> Any:
+        return await self._aget_response_with_messages(messages, **llm_config)
+
     @abstractmethod
     def _get_content_from_response(self, response: Any, messages: List[dict] = None) -> str:
         raise NotImplementedError
 
     def update_cache_location(self, new_location: str) -> None:
         if self._cache is not None:
-            self._cache.save()
+            self._cache.close()
 
         assert new_location is not None, f"A valid cache location must be provided"
 
         self._cache_location = new_location
-        self._cache = PickleDB(location=self._cache_location)
+        self._cache = load_llm_cache(
+            location=self._cache_location,
+            backend=self._cache_backend,
+            auto_dump=self._cache_auto_dump,
+        )
+        if self._memory_cache is not None:
+            self._memory_cache.clear()
+            self._cache = TieredCache(self._cache, self._memory_cache)
 
     def close(self):
         """Close the active memory, connections, ...
         The client would not be usable after this operation."""
-        self._cache.save()
+        if self._cache is not None:
+            self._cache.close()
+
+    async def aclose(self):
+        """Close the asyncio resources together with the ones `close()` releases."""
+        self.close()
@@ -0,0 +1,253 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from pikerag.utils.logger import Logger
+
+
+class BatchRequestCollector(object):
+    """Collect the cache-missing requests of a `BaseLLMClient` instead of sending them, see
+    `BaseLLMClient.collect_batch_requests()`. Requests with the same cache key are collected once. Thread-safe.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._requests: Dict[str, Tuple[List[dict], dict]] = {}
+
+    def add(self, key: str, messages: List[dict], llm_config: dict) -> None:
+        with self._lock:
+            if key not in self._requests:
+                self._requests[key] = (messages, dict(llm_config))
+        return
+
+    @property
+    def requests(self) -> Dict[str, Tuple[List[dict], dict]]:
+        """The collected requests, (messages, llm_config) by the cache key."""
+        with self._lock:
+            return dict(self._requests)
+
+    def __len__(self) -> int:
+        return len(self._requests)
+
+
+def write_batch_requests(
+    requests: Dict[str, Tuple[List[dict], dict]], path: str, url: str = "/v1/chat/completions",
+) -> int:
+    """Write the requests into a Batch API input file, one json line per request with the cache key as `custom_id`,
+    so that the results can be put into the cache without re-generating the keys.
+
+    Returns:
+        int: the number of requests written.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as fout:
+        for key, (messages, llm_config) in requests.items():
+            line = {"custom_id": key, "method": "POST", "url": url, "body": {**llm_config, "messages": messages}}
+            fout.write(json.dumps(line, ensure_ascii=False) + "\n")
+    return len(requests)
+
+
+def iter_batch_results(path: str) -> Iterator[Tuple[str, Optional[str], Optional[str]]]:
+    """Iterate over a Batch API output file, yield (custom_id, content, error) for each line. The content is None if
+    the request failed, with the error message given.
+    """
+    with open(path, "r", encoding="utf-8") as fin:
+        for line in fin:
+            if line.strip() == "":
+                continue
+            record = json.loads(line)
+            custom_id = record["custom_id"]
+            response = record.get("response", None) or {}
+            if record.get("error", None) is not None or response.get("status_code", 200) != 200:
+                error = record.get("error", None) or response.get("body", {}).get("error", None)
+                yield custom_id, None, json.dumps(error, ensure_ascii=False)
+                continue
+
+            try:
+                content = response["body"]["choices"][0]["message"]["content"]
+            except (KeyError, IndexError, TypeError):
+                content = None
+            if content is None:
+                yield custom_id, None, "no content in response body"
+            else:
+                yield custom_id, content, None
+
+
+class OpenAIBatchRunner(object):
+    """Submit the Batch API input files, poll until done and download the output files, through an OpenAI-compatible
+    endpoint: Azure OpenAI, OpenAI, or the local stand-in `pikerag.llm_client.batch_server` for testing.
+
+    Args:
+        client_type (str): "azure" to use `AzureOpenAI`, or "openai" to use `OpenAI`. Defaults to "azure".
+        client_config (dict): the kwargs to initialize the client, e.g. `base_url` and `api_key` of the local stand-in
+            server. Defaults to None, i.e. configured by the environment variables like `AzureOpenAIClient`.
+        endpoint (str): the endpoint of the requests. Defaults to None, i.e. "/chat/completions" for Azure and
+            "/v1/chat/completions" for OpenAI.
+        completion_window (str): the time frame within which the batch should be processed. Defaults to "24h".
+        poll_interval (float): seconds between two status polls. Defaults to 30.
+        timeout (float): seconds to wait for the batches before giving up, None to wait until they end. Defaults to
+            None.
+        logger (Logger): the logger to report the progress. Defaults to None, i.e. print out.
+    """
+    FINAL_STATUSES: Tuple[str, ...] = ("completed", "failed", "expired", "cancelled")
+
+    def __init__(
+        self, client_type: str = "azure", client_config: dict = None, endpoint: str = None,
+        completion_window: str = "24h", poll_interval: float = 30, timeout: float = None, logger: Logger = None,
+        **kwargs,
+    ) -> None:
+        # Imported here so that the clients collecting the requests do not depend on the `openai` package.
+        from openai import AzureOpenAI, OpenAI
+
+        client_config = dict(client_config or {})
+        if client_type == "azure":
+            if client_config.get("api_key", None) is None and os.environ.get("AZURE_OPENAI_API_KEY", None) is None:
+                from pikerag.llm_client.azure_open_ai_client import get_azure_active_directory_token_provider
+                client_config["azure_ad_token_provider"] = get_azure_active_directory_token_provider()
+            self._client = AzureOpenAI(**client_config)
+            default_endpoint = "/chat/completions"
+        elif client_type == "openai":
+            self._client = OpenAI(**client_config)
+            default_endpoint = "/v1/chat/completions"
+        else:
+            raise ValueError(f"Unrecognized client_type: {client_type}, should be 'azure' or 'openai'.")
+
+        self._endpoint: str = endpoint if endpoint is not None else default_endpoint
+        self._completion_window: str = completion_window
+        self._poll_interval: float = poll_interval
+        self._timeout: Optional[float] = timeout
+        self._logger: Logger = logger
+
+    @property
+    def endpoint(self) -> str:
+        return self._endpoint
+
+    def _info(self, msg: str) -> None:
+        if self._logger is not None:
+            self._logger.info(msg, tag="OpenAIBatchRunner")
+        else:
+            print(f"[OpenAIBatchRunner] {msg}")
+        return
+
+    def submit(self, input_path: str) -> str:
+        """Upload the input file and create a batch on it, return the batch id."""
+        with open(input_path, "rb") as fin:
+            input_file = self._client.files.create(file=fin, purpose="batch")
+        batch = self._client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=self._endpoint,
+            completion_window=self._completion_window,
+        )
+        self._info(f"Batch {batch.id} created for {input_path}.")
+        return batch.id
+
+    def wait(self, batch_ids: List[str], on_poll: Callable[[Dict[str, object]], None] = None) -> Dict[str, object]:
+        """Poll the batches until all of them end or the timeout is reached, return the latest batch objects by id."""
+        start_time = time.time()
+        batches: Dict[str, object] = {}
+        pending: List[str] = list(batch_ids)
+        while True:
+            for batch_id in pending:
+                batches[batch_id] = self._client.batches.retrieve(batch_id)
+            pending = [batch_id for batch_id in pending if batches[batch_id].status not in self.FINAL_STATUSES]
+
+            if on_poll is not None:
+                on_poll(batches)
+            if len(pending) == 0:
+                break
+            if self._timeout is not None and time.time() - start_time > self._timeout:
+                self._info(f"Timeout waiting for the batches: {pending}.")
+                break
+            time.sleep(self._poll_interval)
+        return batches
+
+    def download(self, batch: object, output_path: str) -> bool:
+        """Download the output file, with the error file appended if any, of an ended batch. Return False if nothing
+        to download.
+        """
+        file_ids = [
+            file_id for file_id in (getattr(batch, "output_file_id", None), getattr(batch, "error_file_id", None))
+            if file_id is not None
+        ]
+        if len(file_ids) == 0:
+            self._info(f"Batch {batch.id} ended with status {batch.status}, no output to download.")
+            return False
+
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        with open(output_path, "w", encoding="utf-8") as fout:
+            for file_id in file_ids:
+                text = self._client.files.content(file_id).text
+                fout.write(text if text.endswith("\n") or text == "" else text + "\n")
+        return True
+
+    def run(
+        self, requests: Dict[str, Tuple[List[dict], dict]], work_dir: str, name: str, max_requests_per_file: int = 50000,
+    ) -> List[str]:
+        """Write the requests into input file(s) under `work_dir`, submit them, wait, and download the outputs. Parts
+        already downloaded by a previous run are skipped.
+
+        Returns:
+            List[str]: the paths of the output files downloaded.
+        """
+        items = list(requests.items())
+        parts = [
+            dict(items[start:start + max_requests_per_file])
+            for start in range(0, len(items), max_requests_per_file)
+        ]
+
+        output_paths: List[str] = []
+        submitted: Dict[str, str] = {}
+        for part_idx, part in enumerate(parts):
+            input_path = os.path.join(work_dir, f"{name}_part{part_idx}_input.jsonl")
+            output_path = os.path.join(work_dir, f"{name}_part{part_idx}_output.jsonl")
+            if os.path.exists(output_path):
+                output_paths.append(output_path)
+                continue
+            write_batch_requests(part, input_path, url=self._endpoint)
+            submitted[self.submit(input_path)] = output_path
+
+        if len(submitted) == 0:
+            return output_paths
+
+        def report(batches: Dict[str, object]) -> None:
+            for batch in batches.values():
+                counts = getattr(batch, "request_counts", None)
+                progress = f" ({counts.completed + counts.failed}/{counts.total})" if counts is not None else ""
+                self._info(f"Batch {batch.id}: {batch.status}{progress}")
+            return
+
+        batches = self.wait(list(submitted.keys()), on_poll=report)
+        for batch_id, output_path in submitted.items():
+            batch = batches[batch_id]
+            if batch.status == "completed" and self.download(batch, output_path):
+                output_paths.append(output_path)
+            else:
+                self._info(f"Batch {batch_id} ended with status {batch.status}, its requests would be sent online.")
+        return output_paths
+
+
+def load_batch_results(
+    output_paths: Iterable[str], save_fn: Callable[[Iterable[Tuple[str, str]]], int], keys: Iterable[str] = None,
+) -> Tuple[int, int]:
+    """Save the contents in the Batch API output files by `save_fn`, e.g. `BaseLLMClient.save_batch_results()`. Results
+    of the keys not in `keys` (if given) are skipped.
+
+    Returns:
+        Tuple[int, int]: the number of results saved, and the number of failed ones.
+    """
+    valid_keys = set(keys) if keys is not None else None
+    results: List[Tuple[str, str]] = []
+    num_failed: int = 0
+    for output_path in output_paths:
+        for key, content, error in iter_batch_results(output_path):
+            if valid_keys is not None and key not in valid_keys:
+                continue
+            if content is None or content == "":
+                num_failed += 1
+                continue
+            results.append((key, content))
+    return save_fn(results), num_failed
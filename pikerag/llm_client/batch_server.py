@@ -0,0 +1,244 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""A local stand-in of the OpenAI Batch API for testing the batch mode without the batch quota:
+
+    python -m pikerag.llm_client.batch_server --port 8765 [--upstream-url URL] [--processing-delay SECONDS]
+
+It serves `POST /v1/files`, `GET /v1/files/{id}/content`, `POST /v1/batches` and `GET /v1/batches/{id}` (the Azure
+style paths prefixed with `/openai` are accepted too) with all the states kept in memory. The requests of a batch are
+forwarded one by one to the OpenAI-compatible chat completions `--upstream-url` if given, otherwise answered with a
+deterministic echo of the last message. Point the batch runner to it with:
+
+    client_type: openai
+    client_config:
+      base_url: http://127.0.0.1:8765/v1
+      api_key: local
+"""
+
+import argparse
+import email.parser
+import email.policy
+import json
+import threading
+import time
+import urllib.request
+import uuid
+from http.server import ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+from pikerag.llm_client.http_server import JsonRequestHandler, create_json_server
+
+
+class _BatchStore(object):
+    def __init__(self, upstream_url: Optional[str], upstream_api_key: Optional[str], processing_delay: float) -> None:
+        self._lock = threading.Lock()
+        self.files: Dict[str, Tuple[dict, bytes]] = {}
+        self.batches: Dict[str, dict] = {}
+        self._upstream_url: Optional[str] = upstream_url
+        self._upstream_api_key: Optional[str] = upstream_api_key
+        self._processing_delay: float = processing_delay
+
+    def add_file(self, filename: str, purpose: str, data: bytes) -> dict:
+        file_obj = {
+            "id": f"file-{uuid.uuid4().hex}",
+            "object": "file",
+            "bytes": len(data),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        with self._lock:
+            self.files[file_obj["id"]] = (file_obj, data)
+        return file_obj
+
+    def create_batch(self, input_file_id: str, endpoint: str, completion_window: str, metadata: dict = None) -> dict:
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": endpoint,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": int(time.time()),
+            "in_progress_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": metadata,
+            "errors": None,
+        }
+        with self._lock:
+            self.batches[batch["id"]] = batch
+        threading.Thread(target=self._process, args=(batch["id"],), daemon=True).start()
+        return batch
+
+    def get_batch(self, batch_id: str) -> Optional[dict]:
+        with self._lock:
+            batch = self.batches.get(batch_id, None)
+            return json.loads(json.dumps(batch)) if batch is not None else None
+
+    def _complete(self, body: dict) -> dict:
+        if self._upstream_url is not None:
+            headers = {"Content-Type": "application/json"}
+            if self._upstream_api_key is not None:
+                headers["Authorization"] = f"Bearer {self._upstream_api_key}"
+                headers["api-key"] = self._upstream_api_key
+            request = urllib.request.Request(
+                self._upstream_url, data=json.dumps(body).encode("utf-8"), headers=headers, method="POST",
+            )
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())
+
+        messages = body.get("messages", [])
+        content = messages[-1].get("content", "") if len(messages) > 0 else ""
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stand-in"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": f"[echo] {content}"},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+    def _process(self, batch_id: str) -> None:
+        with self._lock:
+            batch = self.batches[batch_id]
+            _, data = self.files[batch["input_file_id"]]
+            lines = [json.loads(line) for line in data.decode("utf-8").splitlines() if line.strip() != ""]
+            batch["status"] = "in_progress"
+            batch["in_progress_at"] = int(time.time())
+            batch["request_counts"]["total"] = len(lines)
+
+        time.sleep(self._processing_delay)
+
+        outputs, errors = [], []
+        for line in lines:
+            record = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": line["custom_id"]}
+            try:
+                body = self._complete(line["body"])
+                record.update({"response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": body}})
+                record["error"] = None
+                outputs.append(record)
+                counter = "completed"
+            except Exception as e:
+                record.update({"response": None, "error": {"code": type(e).__name__, "message": str(e)}})
+                errors.append(record)
+                counter = "failed"
+            with self._lock:
+                batch["request_counts"][counter] += 1
+
+        def to_bytes(records) -> bytes:
+            return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+
+        output_file = self.add_file(f"{batch_id}_output.jsonl", "batch_output", to_bytes(outputs))
+        error_file = self.add_file(f"{batch_id}_error.jsonl", "batch_output", to_bytes(errors)) if errors else None
+        with self._lock:
+            batch["output_file_id"] = output_file["id"]
+            batch["error_file_id"] = error_file["id"] if error_file is not None else None
+            batch["status"] = "completed"
+            batch["completed_at"] = int(time.time())
+        return
+
+
+class _BatchRequestHandler(JsonRequestHandler):
+    store: _BatchStore = None
+
+    def _path_parts(self):
+        path = self.path.split("?", 1)[0].strip("/")
+        parts = path.split("/")
+        if len(parts) > 0 and parts[0] == "openai":
+            parts = parts[1:]
+        if len(parts) > 0 and parts[0] == "v1":
+            parts = parts[1:]
+        return parts
+
+    def _send_not_found(self) -> None:
+        self._send_json({"error": {"message": f"{self.path} not found", "type": "invalid_request_error"}}, 404)
+        return
+
+    def do_POST(self) -> None:
+        parts = self._path_parts()
+        if parts == ["files"]:
+            # Parse the multipart form by the email parser, the `cgi` module is deprecated.
+            header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8")
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(header + self._read_body())
+            fields: Dict[str, Tuple[Optional[str], bytes]] = {}
+            for part in message.iter_parts():
+                fields[part.get_param("name", header="content-disposition")] = (
+                    part.get_filename(), part.get_payload(decode=True),
+                )
+            filename, data = fields["file"]
+            purpose = fields.get("purpose", (None, b"batch"))[1].decode("utf-8")
+            self._send_json(self.store.add_file(filename or "input.jsonl", purpose, data))
+
+        elif parts == ["batches"]:
+            request = json.loads(self._read_body())
+            self._send_json(self.store.create_batch(
+                request["input_file_id"], request["endpoint"], request.get("completion_window", "24h"),
+                request.get("metadata", None),
+            ))
+
+        else:
+            self._read_body()
+            self._send_not_found()
+        return
+
+    def do_GET(self) -> None:
+        parts = self._path_parts()
+        if len(parts) == 2 and parts[0] == "batches":
+            batch = self.store.get_batch(parts[1])
+            if batch is None:
+                return self._send_not_found()
+            self._send_json(batch)
+
+        elif len(parts) == 3 and parts[0] == "files" and parts[2] == "content":
+            if parts[1] not in self.store.files:
+                return self._send_not_found()
+            _, data = self.store.files[parts[1]]
+            self._send_bytes(data, "application/octet-stream")
+
+        else:
+            self._send_not_found()
+        return
+
+
+def create_batch_server(
+    host: str = "127.0.0.1", port: int = 8765, upstream_url: str = None, upstream_api_key: str = None,
+    processing_delay: float = 0,
+) -> ThreadingHTTPServer:
+    """Create the stand-in batch server, call `serve_forever()` on it (e.g. in a daemon thread) to start serving and
+    `shutdown()` to stop. Use port 0 to pick a free one, see `server.server_address`.
+    """
+    return create_json_server(
+        _BatchRequestHandler, host, port, store=_BatchStore(upstream_url, upstream_api_key, processing_delay),
+    )
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="A local stand-in of the OpenAI Batch API.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="the host to bind")
+    parser.add_argument("--port", type=int, default=8765, help="the port to listen on")
+    parser.add_argument("--upstream-url", type=str, default=None, help="the chat completions url to forward to")
+    parser.add_argument("--upstream-api-key", type=str, default=None, help="the api key of the upstream url")
+    parser.add_argument("--processing-delay", type=float, default=0, help="seconds to wait before processing")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    server = create_batch_server(
+        args.host, args.port, args.upstream_url, args.upstream_api_key, args.processing_delay,
+    )
+    print(f"[Batch Server] Serving on http://{args.host}:{server.server_address[1]}/v1 ...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
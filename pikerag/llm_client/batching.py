@@ -0,0 +1,243 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Tuple, Type
+
+
+class _PendingRequest(object):
+    def __init__(self, item: Any) -> None:
+        self.item: Any = item
+        self.arrive_time: float = time.monotonic()
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: BaseException = None
+
+
+class DynamicBatcher(object):
+    """Collect the requests submitted by multiple worker threads into batches and process them with one call.
+
+    Requests are grouped by `group_key` so that every batch is homogeneous. A group is dispatched once it has
+    `max_batch_size` requests, or its oldest request has been waiting for `max_wait_time` seconds. Groups are served
+    in the order of their oldest request, by one background thread.
+
+    Args:
+        batch_fn (Callable[[Hashable, List[Any]], List[Any]]): the function processes a batch of items with the same
+            group key, returning the results in the same order. The exception raised would be passed to every caller
+            in this batch.
+        max_batch_size (int): the maximum number of items in one batch. Defaults to 8.
+        max_wait_time (float): the seconds to wait for more requests to join the batch. Defaults to 0.02.
+    """
+    def __init__(
+        self, batch_fn: Callable[[Hashable, List[Any]], List[Any]], max_batch_size: int = 8, max_wait_time: float = 0.02,
+    ) -> None:
+        assert max_batch_size >= 1, f"max_batch_size should be no less than 1 (but {max_batch_size} was given)!"
+
+        self._batch_fn = batch_fn
+        self._max_batch_size: int = max_batch_size
+        self._max_wait_time: float = max_wait_time
+
+        self._condition = threading.Condition()
+        self._pending: Dict[Hashable, List[_PendingRequest]] = OrderedDict()
+        self._closed: bool = False
+
+        self.num_batches: int = 0
+        self.num_items: int = 0
+
+        self._worker = threading.Thread(target=self._run, name="DynamicBatcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, group_key: Hashable, item: Any) -> Any:
+        """Submit an item and block until its result is ready."""
+        request = _PendingRequest(item)
+        with self._condition:
+            assert not self._closed, "DynamicBatcher is already closed!"
+            self._pending.setdefault(group_key, []).append(request)
+            self._condition.notify()
+
+        request.event.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _next_batch(self):
+        """Wait for and pop the next batch to process, return None if closed and nothing pending."""
+        with self._condition:
+            while True:
+                if len(self._pending) == 0:
+                    if self._closed:
+                        return None
+                    self._condition.wait()
+                    continue
+
+                # Serve the group with the oldest request first.
+                group_key, requests = min(self._pending.items(), key=lambda kv: kv[1][0].arrive_time)
+                wait_time = requests[0].arrive_time + self._max_wait_time - time.monotonic()
+                if len(requests) >= self._max_batch_size or wait_time <= 0 or self._closed:
+                    batch = requests[:self._max_batch_size]
+                    if len(requests) > self._max_batch_size:
+                        self._pending[group_key] = requests[self._max_batch_size:]
+                    else:
+                        self._pending.pop(group_key)
+                    return group_key, batch
+
+                self._condition.wait(timeout=wait_time)
+
+    def _run(self) -> None:
+        while True:
+            next_batch = self._next_batch()
+            if next_batch is None:
+                return
+
+            group_key, batch = next_batch
+            try:
+                results = self._batch_fn(group_key, [request.item for request in batch])
+                assert len(results) == len(batch), f"{len(results)} results returned for {len(batch)} items!"
+                for request, result in zip(batch, results):
+                    request.result = result
+            except BaseException as e:
+                for request in batch:
+                    request.error = e
+
+            self.num_batches += 1
+            self.num_items += len(batch)
+            for request in batch:
+                request.event.set()
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        return {
+            "num_batches": self.num_batches,
+            "num_items": self.num_items,
+            "avg_batch_size": self.num_items / self.num_batches if self.num_batches > 0 else 0.0,
+        }
+
+    def close(self) -> None:
+        """Process the pending requests and stop the background thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._worker.join()
+
+
+def estimate_text_tokens(text: str) -> int:
+    """Roughly estimate the tokens of a text, ~4 characters per token."""
+    return len(text) // 4 + 1
+
+
+class TokenPackedBatcher(object):
+    """Process a list of texts in batches packed by their token counts, with several batches in flight concurrently.
+
+    Each batch takes the pending texts in order until the batch token limit or `max_batch_size` is reached, a text
+    larger than the limit goes alone. The batch token limit adapts to throttling: it is halved whenever a batch fails
+    with one of `throttle_errors` (the failed texts are put back to be retried in smaller batches), and grows back by
+    1/8 of `max_batch_tokens` for every successful batch.
+
+    Args:
+        batch_fn (Callable[[List[str]], List[Any]]): the function processes a batch of texts, returning the results in
+            the same order. It is called from `num_workers` threads concurrently, use a shared rate limiter inside if
+            needed.
+        max_batch_tokens (int): the upper bound of the tokens in one batch, e.g. the per-request limit of the endpoint.
+            Defaults to 8191.
+        max_batch_size (int): the maximum number of texts in one batch. Defaults to 256.
+        num_workers (int): the number of batches in flight. Defaults to 4.
+        throttle_errors (Tuple[Type[BaseException], ...]): the exceptions regarded as throttling. Defaults to ().
+        count_tokens (Callable[[str], int]): the token counter. Defaults to None, i.e. `estimate_text_tokens()`.
+    """
+    def __init__(
+        self, batch_fn: Callable[[List[str]], List[Any]], max_batch_tokens: int = 8191, max_batch_size: int = 256,
+        num_workers: int = 4, throttle_errors: Tuple[Type[BaseException], ...] = (),
+        count_tokens: Callable[[str], int] = None,
+    ) -> None:
+        assert max_batch_tokens >= 1, f"max_batch_tokens should be no less than 1 (but {max_batch_tokens} was given)!"
+        assert max_batch_size >= 1, f"max_batch_size should be no less than 1 (but {max_batch_size} was given)!"
+
+        self._batch_fn = batch_fn
+        self._max_batch_tokens: int = max_batch_tokens
+        self._max_batch_size: int = max_batch_size
+        self._num_workers: int = max(1, num_workers)
+        self._throttle_errors: Tuple[Type[BaseException], ...] = throttle_errors
+        self._count_tokens: Callable[[str], int] = count_tokens or estimate_text_tokens
+
+        self._lock = threading.Lock()
+        self._batch_tokens: float = max_batch_tokens
+
+        self.num_batches: int = 0
+        self.num_items: int = 0
+        self.num_throttled: int = 0
+
+    def _pop_batch(self, pending: Deque[Tuple[int, str, int]]) -> List[Tuple[int, str, int]]:
+        with self._lock:
+            batch: List[Tuple[int, str, int]] = []
+            num_tokens: int = 0
+            while len(pending) > 0 and len(batch) < self._max_batch_size:
+                num_text_tokens = pending[0][2]
+                if len(batch) > 0 and num_tokens + num_text_tokens > self._batch_tokens:
+                    break
+                batch.append(pending.popleft())
+                num_tokens += num_text_tokens
+            return batch
+
+    def _on_batch_done(self, batch_size: int) -> None:
+        with self._lock:
+            self.num_batches += 1
+            self.num_items += batch_size
+            self._batch_tokens = min(self._max_batch_tokens, self._batch_tokens + self._max_batch_tokens / 8)
+        return
+
+    def _on_batch_throttled(self, batch: List[Tuple[int, str, int]], pending: Deque[Tuple[int, str, int]]) -> None:
+        with self._lock:
+            self.num_throttled += 1
+            self._batch_tokens = max(1, self._batch_tokens / 2)
+            # Put back to the front, to be retried first.
+            pending.extendleft(reversed(batch))
+        return
+
+    def run(self, texts: List[str], on_result: Optional[Callable[[str, Any], None]] = None) -> List[Any]:
+        """Process the texts and return the results in the same order. `on_result(text, result)`, if given, is called
+        for every text once its batch is done, e.g. to update the cache incrementally.
+        """
+        results: List[Any] = [None] * len(texts)
+        pending: Deque[Tuple[int, str, int]] = deque(
+            (idx, text, self._count_tokens(text)) for idx, text in enumerate(texts)
+        )
+
+        def work() -> None:
+            while True:
+                batch = self._pop_batch(pending)
+                if len(batch) == 0:
+                    return
+
+                try:
+                    batch_results = self._batch_fn([text for _, text, _ in batch])
+                except self._throttle_errors:
+                    # The rate limiter inside `batch_fn` takes care of the back-off, only the batch is shrunk here.
+                    self._on_batch_throttled(batch, pending)
+                    continue
+
+                assert len(batch_results) == len(batch), f"{len(batch_results)} results returned for {len(batch)} texts!"
+                for (idx, text, _), result in zip(batch, batch_results):
+                    results[idx] = result
+                    if on_result is not None:
+                        on_result(text, result)
+                self._on_batch_done(len(batch))
+
+        with ThreadPoolExecutor(max_workers=self._num_workers) as executor:
+            futures = [executor.submit(work) for _ in range(min(self._num_workers, max(1, len(texts))))]
+            for future in futures:
+                future.result()
+        return results
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "num_batches": self.num_batches,
+                "num_items": self.num_items,
+                "num_throttled": self.num_throttled,
+                "avg_batch_size": self.num_items / self.num_batches if self.num_batches > 0 else 0.0,
+                "batch_tokens": self._batch_tokens,
+            }
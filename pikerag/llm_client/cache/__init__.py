@@ -0,0 +1,16 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+from pikerag.llm_client.cache.base import BaseLLMCache, canonicalize_request, generate_cache_key
+from pikerag.llm_client.cache.memory_cache import MemoryLRUCache
+from pikerag.llm_client.cache.pickledb_cache import PickleDBCache
+from pikerag.llm_client.cache.sqlite_cache import SQLiteCache
+from pikerag.llm_client.cache.tiered_cache import TieredCache
+from pikerag.llm_client.cache.utils import get_cache_class, infer_cache_backend, load_llm_cache
+
+
+__all__ = [
+    "BaseLLMCache", "MemoryLRUCache", "PickleDBCache", "SQLiteCache", "TieredCache",
+    "canonicalize_request", "generate_cache_key", "get_cache_class", "infer_cache_backend",
+    "load_llm_cache",
+]
@@ -0,0 +1,69 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import hashlib
+import json
+from abc import abstractmethod
+from typing import Iterator, List, Literal, Tuple, Union
+
+
+def canonicalize_request(messages: List[dict], llm_config: dict) -> str:
+    """Serialize the messages and the LLM config into a canonical json string. Dict keys are sorted and separators are
+    fixed so that semantically identical requests always map to the same string.
+    """
+    return json.dumps((messages, llm_config), sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+
+def generate_cache_key(messages: List[dict], llm_config: dict) -> str:
+    """Generate a fixed-size (64 hex chars) cache key from the sha256 of the canonicalized request."""
+    return hashlib.sha256(canonicalize_request(messages, llm_config).encode("utf-8")).hexdigest()
+
+
+class BaseLLMCache(object):
+    """The persistent key-value storage used by `BaseLLMClient` to cache the LLM responses.
+
+    Args:
+        location (str): the file location of the cache.
+        auto_dump (bool): persist every update to disk immediately (as far as the backend supports) or not. Defaults to
+            True.
+    """
+    NAME: str = "BaseLLMCache"
+    EXTENSION: str = ""
+
+    def __init__(self, location: str, auto_dump: bool = True) -> None:
+        self._location: str = location
+        self._auto_dump: bool = auto_dump
+
+    @property
+    def location(self) -> str:
+        return self._location
+
+    @abstractmethod
+    def get(self, key: str) -> Union[str, Literal[False]]:
+        """Return the cached value of the given key, False if not cached."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def set(self, key: str, value: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove(self, key: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def items(self) -> Iterator[Tuple[str, str]]:
+        """Iterate over all the (key, value) pairs in this cache."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def save(self) -> None:
+        """Flush the pending updates to disk."""
+        return
+
+    def close(self) -> None:
+        """Save and release the resources. The cache would not be usable after this operation."""
+        self.save()
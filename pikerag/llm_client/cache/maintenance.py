@@ -0,0 +1,309 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""Maintenance tools of the LLM caches, also available as a CLI:
+
+    python -m pikerag.llm_client.cache.maintenance {info,merge,clean,prune-experiments,export,import} ...
+
+Run with `-h` for the arguments of each command.
+"""
+
+import argparse
+import gzip
+import os
+import struct
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from pikerag.llm_client.cache.base import BaseLLMCache
+from pikerag.llm_client.cache.migration import HASHED_KEY_PATTERN, convert_legacy_key
+from pikerag.llm_client.cache.sqlite_cache import SQLiteCache
+from pikerag.llm_client.cache.utils import CACHE_BACKENDS, infer_cache_backend, load_llm_cache
+
+
+ARCHIVE_MAGIC: bytes = b"PIKELLMCACHE\x01"
+ARCHIVE_EXTENSION: str = ".llmcache.gz"
+# sha256 digest of the key, created_at, length of the utf-8 encoded value.
+_RECORD_HEADER = struct.Struct("<32sdI")
+
+_CACHE_EXTENSIONS: Tuple[str, ...] = tuple(cache_class.EXTENSION for cache_class in CACHE_BACKENDS.values())
+
+
+def open_cache(location: str, backend: str = None, auto_dump: bool = False) -> BaseLLMCache:
+    """Open an existing cache, with the backend inferred from the file extension if not given."""
+    assert os.path.exists(location), f"Cache {location} does not exist!"
+    if backend is None:
+        backend = infer_cache_backend(location)
+    return load_llm_cache(location, backend=backend, auto_dump=auto_dump)
+
+
+def iter_entries(cache: BaseLLMCache) -> Iterator[Tuple[str, str, float]]:
+    """Iterate over the (hashed key, value, created_at) entries of the given cache. The legacy keys are converted into
+    the hashed ones, and the creation time is the current time for the backends that do not record it.
+    """
+    if isinstance(cache, SQLiteCache):
+        entries = cache.entries()
+    else:
+        now = time.time()
+        entries = ((key, value, now) for key, value in cache.items())
+
+    for key, value, created_at in entries:
+        try:
+            key = convert_legacy_key(key)
+        except Exception as e:
+            print(f"[Cache Maintenance] Skip un-parsable key in {cache.location}: {e}")
+            continue
+        yield key, value, created_at
+
+
+def _write_entries(dst: BaseLLMCache, entries: Iterable[Tuple[str, str, float]], batch_size: int = 1000) -> int:
+    num_written: int = 0
+    batch: List[Tuple[str, str, float]] = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            num_written += _write_batch(dst, batch)
+            batch = []
+    num_written += _write_batch(dst, batch)
+    return num_written
+
+
+def _write_batch(dst: BaseLLMCache, batch: List[Tuple[str, str, float]]) -> int:
+    if isinstance(dst, SQLiteCache):
+        dst.set_entries(batch)
+    else:
+        for key, value, _ in batch:
+            dst.set(key, value)
+    return len(batch)
+
+
+def get_cache_info(location: str, backend: str = None) -> Dict[str, float]:
+    cache = open_cache(location, backend)
+    num_entries: int = 0
+    num_empty: int = 0
+    num_legacy_keys: int = 0
+    for key, value in cache.items():
+        num_entries += 1
+        num_empty += int(value == "")
+        num_legacy_keys += int(HASHED_KEY_PATTERN.match(key) is None)
+    cache.close()
+
+    return {
+        "num_entries": num_entries,
+        "num_empty": num_empty,
+        "num_legacy_keys": num_legacy_keys,
+        "file_size": os.path.getsize(location),
+    }
+
+
+def merge_caches(
+    src_locations: List[str], dst_location: str, dst_backend: str = "sqlite", drop_empty: bool = True,
+    batch_size: int = 1000,
+) -> int:
+    """Merge the caches into a (new or existing) one, de-duplicated by the hashed key. The later source wins if the
+    same key exists in multiple sources, the empty responses are skipped if `drop_empty`.
+
+    Returns:
+        int: the number of entries written.
+    """
+    dst = load_llm_cache(dst_location, backend=dst_backend, auto_dump=False)
+
+    num_written: int = 0
+    for src_location in src_locations:
+        src = open_cache(src_location)
+        entries = iter_entries(src)
+        if drop_empty:
+            entries = (entry for entry in entries if entry[1] != "")
+        num_written += _write_entries(dst, entries, batch_size)
+        src.close()
+        print(f"[Cache Maintenance] {src_location} merged.")
+
+    if isinstance(dst, SQLiteCache):
+        dst.compact()
+    dst.close()
+    return num_written
+
+
+def clean_cache(
+    location: str, drop_empty: bool = True, older_than: Optional[float] = None, compact: bool = True,
+) -> int:
+    """Remove the empty responses and / or the entries created more than `older_than` seconds ago in place.
+
+    Returns:
+        int: the number of entries removed.
+    """
+    cache = open_cache(location)
+    created_before = time.time() - older_than if older_than is not None else None
+
+    if isinstance(cache, SQLiteCache):
+        num_removed = cache.prune(drop_empty=drop_empty, created_before=created_before)
+        if compact:
+            cache.compact()
+    else:
+        assert created_before is None, f"{cache.NAME} does not record the creation time, cannot prune by age!"
+        keys = [key for key, value in cache.items() if drop_empty and value == ""]
+        for key in keys:
+            cache.remove(key)
+        num_removed = len(keys)
+
+    cache.close()
+    return num_removed
+
+
+def find_cache_files(log_root_dir: str, experiments: List[str] = None) -> Dict[str, List[str]]:
+    """Find the cache files under `log_root_dir`, grouped by experiment, i.e. the name of the folder they are in.
+
+    Returns:
+        Dict[str, List[str]]: the experiment name to its cache file paths, only the given `experiments` if not None.
+    """
+    experiment_to_files: Dict[str, List[str]] = {}
+    for dirpath, _, filenames in os.walk(log_root_dir):
+        experiment = os.path.basename(dirpath)
+        if experiments is not None and experiment not in experiments:
+            continue
+        for filename in sorted(filenames):
+            if filename.endswith(_CACHE_EXTENSIONS):
+                experiment_to_files.setdefault(experiment, []).append(os.path.join(dirpath, filename))
+    return experiment_to_files
+
+
+def prune_experiments(log_root_dir: str, experiments: List[str], dry_run: bool = True) -> List[str]:
+    """Delete the cache files of the given experiments under `log_root_dir`, together with the SQLite WAL files.
+
+    Returns:
+        List[str]: the cache files deleted, or to be deleted if `dry_run`.
+    """
+    locations = [
+        location
+        for locations in find_cache_files(log_root_dir, experiments).values()
+        for location in locations
+    ]
+    if not dry_run:
+        for location in locations:
+            for path in (location, f"{location}-wal", f"{location}-shm"):
+                if os.path.exists(path):
+                    os.remove(path)
+    return locations
+
+
+def export_caches(src_locations: List[str], archive_path: str, drop_empty: bool = True) -> int:
+    """Export the caches into one gzip-compressed binary archive, each entry stored as the 32-byte key digest, the
+    creation time and the utf-8 encoded value.
+
+    Returns:
+        int: the number of entries exported.
+    """
+    num_exported: int = 0
+    with gzip.open(archive_path, "wb") as fout:
+        fout.write(ARCHIVE_MAGIC)
+        for src_location in src_locations:
+            src = open_cache(src_location)
+            for key, value, created_at in iter_entries(src):
+                if drop_empty and value == "":
+                    continue
+                value_bytes = value.encode("utf-8")
+                fout.write(_RECORD_HEADER.pack(bytes.fromhex(key), created_at, len(value_bytes)))
+                fout.write(value_bytes)
+                num_exported += 1
+            src.close()
+    return num_exported
+
+
+def iter_archive(archive_path: str) -> Iterator[Tuple[str, str, float]]:
+    """Iterate over the (hashed key, value, created_at) entries in the archive written by `export_caches()`."""
+    with gzip.open(archive_path, "rb") as fin:
+        magic = fin.read(len(ARCHIVE_MAGIC))
+        assert magic == ARCHIVE_MAGIC, f"{archive_path} is not an LLM cache archive!"
+        while True:
+            header = fin.read(_RECORD_HEADER.size)
+            if len(header) == 0:
+                return
+            assert len(header) == _RECORD_HEADER.size, f"{archive_path} is truncated!"
+            digest, created_at, value_length = _RECORD_HEADER.unpack(header)
+            value = fin.read(value_length).decode("utf-8")
+            yield digest.hex(), value, created_at
+
+
+def import_archive(archive_path: str, dst_location: str, dst_backend: str = "sqlite", batch_size: int = 1000) -> int:
+    """Import the entries in the archive into a (new or existing) cache, overwriting the existing ones.
+
+    Returns:
+        int: the number of entries imported.
+    """
+    dst = load_llm_cache(dst_location, backend=dst_backend, auto_dump=False)
+    num_imported = _write_entries(dst, iter_archive(archive_path), batch_size)
+    dst.close()
+    return num_imported
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Maintenance tools of the LLM caches.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    info_parser = subparsers.add_parser("info", help="print the statistics of the caches")
+    info_parser.add_argument("caches", type=str, nargs="+", help="the cache file(s)")
+
+    merge_parser = subparsers.add_parser("merge", help="merge and de-duplicate caches into one")
+    merge_parser.add_argument("caches", type=str, nargs="+", help="the cache file(s) to merge, later ones win")
+    merge_parser.add_argument("-o", "--output", type=str, required=True, help="the location of the merged cache")
+    merge_parser.add_argument("--backend", type=str, default="sqlite", help="the backend of the merged cache")
+    merge_parser.add_argument("--keep-empty", action="store_true", help="keep the empty responses")
+
+    clean_parser = subparsers.add_parser("clean", help="remove the empty or outdated entries in place")
+    clean_parser.add_argument("caches", type=str, nargs="+", help="the cache file(s) to clean")
+    clean_parser.add_argument("--keep-empty", action="store_true", help="keep the empty responses")
+    clean_parser.add_argument("--older-than", type=float, default=None, help="remove entries older than N days")
+    clean_parser.add_argument("--no-compact", action="store_true", help="skip reclaiming the disk space")
+
+    prune_parser = subparsers.add_parser("prune-experiments", help="delete the cache files of the experiments")
+    prune_parser.add_argument("log_root_dir", type=str, help="the log_root_dir of the experiments")
+    prune_parser.add_argument("-e", "--experiments", type=str, nargs="+", required=True, help="the experiment names")
+    prune_parser.add_argument("--delete", action="store_true", help="delete the files instead of listing them")
+
+    export_parser = subparsers.add_parser("export", help="export caches into a compact binary archive")
+    export_parser.add_argument("caches", type=str, nargs="+", help="the cache file(s) to export, later ones win")
+    export_parser.add_argument(
+        "-o", "--output", type=str, required=True, help=f"the archive path, e.g. xxx{ARCHIVE_EXTENSION}",
+    )
+    export_parser.add_argument("--keep-empty", action="store_true", help="keep the empty responses")
+
+    import_parser = subparsers.add_parser("import", help="import a binary archive into a cache")
+    import_parser.add_argument("archive", type=str, help="the archive path")
+    import_parser.add_argument("-o", "--output", type=str, required=True, help="the location of the cache")
+    import_parser.add_argument("--backend", type=str, default="sqlite", help="the backend of the cache")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+
+    if args.command == "info":
+        for location in args.caches:
+            print(f"{location}: {get_cache_info(location)}")
+
+    elif args.command == "merge":
+        num_written = merge_caches(args.caches, args.output, args.backend, drop_empty=not args.keep_empty)
+        print(f"[Cache Maintenance] {num_written} entries written into {args.output}.")
+
+    elif args.command == "clean":
+        older_than = args.older_than * 24 * 3600 if args.older_than is not None else None
+        for location in args.caches:
+            num_removed = clean_cache(
+                location, drop_empty=not args.keep_empty, older_than=older_than, compact=not args.no_compact,
+            )
+            print(f"[Cache Maintenance] {num_removed} entries removed from {location}.")
+
+    elif args.command == "prune-experiments":
+        locations = prune_experiments(args.log_root_dir, args.experiments, dry_run=not args.delete)
+        action = "Deleted" if args.delete else "To delete (re-run with --delete to confirm)"
+        for location in locations:
+            print(f"[Cache Maintenance] {action}: {location}")
+
+    elif args.command == "export":
+        num_exported = export_caches(args.caches, args.output, drop_empty=not args.keep_empty)
+        print(f"[Cache Maintenance] {num_exported} entries exported into {args.output}.")
+
+    elif args.command == "import":
+        num_imported = import_archive(args.archive, args.output, args.backend)
+        print(f"[Cache Maintenance] {num_imported} entries imported into {args.output}.")
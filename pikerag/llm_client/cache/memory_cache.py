@@ -0,0 +1,109 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Literal, Optional, Tuple, Union
+
+
+class MemoryLRUCache(object):
+    """A thread-safe in-process LRU cache bounded by the memory its entries take instead of the number of entries.
+
+    Args:
+        max_bytes (int): the memory budget in bytes of the keys and values. The least recently used entries would be
+            evicted once exceeded. An entry larger than the budget is never kept. Defaults to 64 MiB.
+        ttl (Optional[float]): the seconds an entry stays valid after being set. Never expire if None. Defaults to None.
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: Optional[float] = None) -> None:
+        assert max_bytes >= 0, f"max_bytes should be non-negative (but {max_bytes} was given)!"
+        assert ttl is None or ttl > 0, f"ttl should be positive or None (but {ttl} was given)!"
+
+        self._max_bytes: int = max_bytes
+        self._ttl: Optional[float] = ttl
+
+        self._lock = threading.Lock()
+        # key -> (value, size in bytes, expire time)
+        self._entries: "OrderedDict[str, Tuple[str, int, float]]" = OrderedDict()
+        self._num_bytes: int = 0
+
+        self.num_hits: int = 0
+        self.num_misses: int = 0
+        self.num_evictions: int = 0
+        self.num_expirations: int = 0
+
+    @staticmethod
+    def _sizeof(key: str, value: str) -> int:
+        return sys.getsizeof(key) + sys.getsizeof(value)
+
+    def _pop_entry(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._num_bytes -= size
+
+    def get(self, key: str) -> Union[str, Literal[False]]:
+        """Return the cached value of the given key, False if not cached or expired."""
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                self.num_misses += 1
+                return False
+
+            value, _, expire_time = entry
+            if expire_time < time.monotonic():
+                self._pop_entry(key)
+                self.num_expirations += 1
+                self.num_misses += 1
+                return False
+
+            self._entries.move_to_end(key)
+            self.num_hits += 1
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        size = self._sizeof(key, value)
+        expire_time = time.monotonic() + self._ttl if self._ttl is not None else float("inf")
+        with self._lock:
+            if key in self._entries:
+                self._pop_entry(key)
+            if size > self._max_bytes:
+                return
+
+            self._entries[key] = (value, size, expire_time)
+            self._num_bytes += size
+            while self._num_bytes > self._max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._pop_entry(oldest_key)
+                self.num_evictions += 1
+        return
+
+    def remove(self, key: str) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._pop_entry(key)
+        return
+
+    def clear(self) -> None:
+        """Drop all the entries, the counters are kept."""
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+        return
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            num_lookups = self.num_hits + self.num_misses
+            return {
+                "num_hits": self.num_hits,
+                "num_misses": self.num_misses,
+                "hit_ratio": self.num_hits / num_lookups if num_lookups > 0 else 0.0,
+                "num_evictions": self.num_evictions,
+                "num_expirations": self.num_expirations,
+                "num_entries": len(self._entries),
+                "num_bytes": self._num_bytes,
+                "max_bytes": self._max_bytes,
+            }
@@ -0,0 +1,83 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import argparse
+import json
+import re
+from typing import Iterator, List, Tuple
+
+from pikerag.llm_client.cache.base import BaseLLMCache, generate_cache_key
+from pikerag.llm_client.cache.pickledb_cache import PickleDBCache
+from pikerag.llm_client.cache.sqlite_cache import SQLiteCache
+from pikerag.llm_client.cache.utils import load_llm_cache
+
+
+HASHED_KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def convert_legacy_key(key: str) -> str:
+    """Convert a legacy cache key, i.e. `json.dumps((messages, llm_config))`, into the fixed-size hashed key. Keys that
+    are already hashed are returned as is.
+    """
+    if HASHED_KEY_PATTERN.match(key):
+        return key
+
+    messages, llm_config = json.loads(key)
+    return generate_cache_key(messages, llm_config)
+
+
+def iter_converted_items(src: BaseLLMCache) -> Iterator[Tuple[str, str]]:
+    for key, value in src.items():
+        try:
+            new_key = convert_legacy_key(key)
+        except Exception as e:
+            print(f"[Cache Migration] Skip un-parsable key in {src.location}: {e}")
+            continue
+        yield new_key, value
+
+
+def migrate_pickledb_cache(
+    src_locations: List[str], dst_location: str, dst_backend: str = "sqlite", batch_size: int = 1000,
+) -> int:
+    """Import the existing PickleDB caches into a (new or existing) cache of `dst_backend`, with the keys converted to
+    the hashed ones. The later source wins if the same key exists in multiple sources.
+
+    Returns:
+        int: the number of entries imported.
+    """
+    dst: BaseLLMCache = load_llm_cache(dst_location, backend=dst_backend, auto_dump=False)
+
+    num_imported: int = 0
+    for src_location in src_locations:
+        src = PickleDBCache(location=src_location)
+        batch: List[Tuple[str, str]] = []
+        for key, value in iter_converted_items(src):
+            batch.append((key, value))
+            if len(batch) >= batch_size:
+                num_imported += _write_batch(dst, batch)
+                batch = []
+        num_imported += _write_batch(dst, batch)
+        print(f"[Cache Migration] {src_location} imported.")
+
+    dst.close()
+    return num_imported
+
+
+def _write_batch(dst: BaseLLMCache, batch: List[Tuple[str, str]]) -> int:
+    if isinstance(dst, SQLiteCache):
+        dst.set_many(batch)
+    else:
+        for key, value in batch:
+            dst.set(key, value)
+    return len(batch)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import existing PickleDB LLM caches into a hashed-key cache.")
+    parser.add_argument("sources", type=str, nargs="+", help="the PickleDB cache file(s) to import")
+    parser.add_argument("-o", "--output", type=str, required=True, help="the location of the destination cache")
+    parser.add_argument("--backend", type=str, default="sqlite", help="the backend of the destination cache")
+    args = parser.parse_args()
+
+    num_imported = migrate_pickledb_cache(args.sources, args.output, dst_backend=args.backend)
+    print(f"[Cache Migration] {num_imported} entries imported into {args.output}.")
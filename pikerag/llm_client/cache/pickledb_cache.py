@@ -0,0 +1,46 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+from typing import Iterator, Literal, Tuple, Union
+
+from pickledb import PickleDB
+
+from pikerag.llm_client.cache.base import BaseLLMCache
+
+
+class PickleDBCache(BaseLLMCache):
+    """The legacy in-memory cache backend. The whole store is loaded into memory on opening and rewritten on `save()`,
+    use `SQLiteCache` instead for large caches or multi-process sharing.
+    """
+    NAME: str = "PickleDBCache"
+    EXTENSION: str = ".db"
+
+    def __init__(self, location: str, auto_dump: bool = True) -> None:
+        super().__init__(location, auto_dump)
+
+        self._db: PickleDB = PickleDB(location=location)
+
+    def get(self, key: str) -> Union[str, Literal[False]]:
+        value = self._db.get(key)
+        if value is None:
+            return False
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        self._db.set(key, value)
+        return
+
+    def remove(self, key: str) -> None:
+        self._db.remove(key)
+        return
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        for key in self._db.all():
+            yield key, self._db.get(key)
+
+    def __len__(self) -> int:
+        return len(self._db.all())
+
+    def save(self) -> None:
+        self._db.save()
+        return
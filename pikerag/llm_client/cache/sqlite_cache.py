@@ -0,0 +1,153 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator, List, Literal, Tuple, Union
+
+from pikerag.llm_client.cache.base import BaseLLMCache
+
+
+class SQLiteCache(BaseLLMCache):
+    """An append-friendly cache backend on SQLite in WAL mode.
+
+    Each thread gets its own connection so that reads never block each other, and every `set()` is committed right
+    away as an append to the write-ahead log instead of a rewrite of the whole store. Multiple processes can share one
+    cache file, concurrent writers wait on each other for at most `timeout` seconds.
+
+    Args:
+        location (str): the file location of the SQLite database.
+        auto_dump (bool): fsync the write-ahead log on every commit if True (`synchronous=FULL`), otherwise only at the
+            WAL checkpoints (`synchronous=NORMAL`), which is faster and still never corrupts the database, but may lose
+            the entries committed since the last checkpoint on an OS crash or power failure. Defaults to True.
+        timeout (float): seconds to wait for the database lock held by other writers. Defaults to 30.
+    """
+    NAME: str = "SQLiteCache"
+    EXTENSION: str = ".sqlite"
+
+    _CREATE_TABLE_SQL: str = (
+        "CREATE TABLE IF NOT EXISTS llm_cache ("
+        "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL"
+        ") WITHOUT ROWID"
+    )
+
+    def __init__(self, location: str, auto_dump: bool = True, timeout: float = 30) -> None:
+        super().__init__(location, auto_dump)
+
+        self._timeout: float = timeout
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+
+        dirname = os.path.dirname(os.path.abspath(location))
+        os.makedirs(dirname, exist_ok=True)
+
+        conn = self._get_connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(self._CREATE_TABLE_SQL)
+
+    def _get_connection(self) -> sqlite3.Connection:
+        conn: sqlite3.Connection = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode: each statement is an individual transaction appended to the WAL.
+            conn = sqlite3.connect(
+                self._location, timeout=self._timeout, isolation_level=None, check_same_thread=False,
+            )
+            # In WAL mode, FULL fsyncs the log on every commit. NORMAL fsyncs it at the checkpoints only, which keeps
+            # the database consistent but may lose the latest commits on an OS crash or power failure.
+            conn.execute(f"PRAGMA synchronous={'FULL' if self._auto_dump else 'NORMAL'}")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def get(self, key: str) -> Union[str, Literal[False]]:
+        row = self._get_connection().execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False
+        return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        self.set_many([(key, value)])
+        return
+
+    def set_many(self, items: Iterable[Tuple[str, str]], created_at: float = None) -> None:
+        """Insert or replace the given (key, value) pairs in one transaction."""
+        if created_at is None:
+            created_at = time.time()
+        self.set_entries((key, value, created_at) for key, value in items)
+        return
+
+    def set_entries(self, entries: Iterable[Tuple[str, str, float]]) -> None:
+        """Insert or replace the given (key, value, created_at) entries in one transaction."""
+        conn = self._get_connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT OR REPLACE INTO llm_cache (key, value, created_at) VALUES (?, ?, ?)", entries)
+        return
+
+    def remove(self, key: str) -> None:
+        self._get_connection().execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+        return
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        cursor = self._get_connection().execute("SELECT key, value FROM llm_cache")
+        for key, value in cursor:
+            yield key, value
+
+    def entries(self) -> Iterator[Tuple[str, str, float]]:
+        """Iterate over all the (key, value, created_at) entries in this cache."""
+        cursor = self._get_connection().execute("SELECT key, value, created_at FROM llm_cache")
+        for key, value, created_at in cursor:
+            yield key, value, created_at
+
+    def prune(self, drop_empty: bool = False, created_before: float = None) -> int:
+        """Remove the entries with empty value if `drop_empty`, and the ones created before the `created_before`
+        timestamp if given.
+
+        Returns:
+            int: the number of entries removed.
+        """
+        conditions: List[str] = []
+        params: List[float] = []
+        if drop_empty:
+            conditions.append("value = ''")
+        if created_before is not None:
+            conditions.append("created_at < ?")
+            params.append(created_before)
+        if len(conditions) == 0:
+            return 0
+
+        cursor = self._get_connection().execute(f"DELETE FROM llm_cache WHERE {' OR '.join(conditions)}", params)
+        return cursor.rowcount
+
+    def compact(self) -> None:
+        """Merge the write-ahead log into the database file and rebuild it to reclaim the space of removed entries."""
+        conn = self._get_connection()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("VACUUM")
+        return
+
+    def __len__(self) -> int:
+        return self._get_connection().execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+    def save(self) -> None:
+        # Move the WAL content back to the main database file without blocking readers or writers.
+        self._get_connection().execute("PRAGMA wal_checkpoint(PASSIVE)")
+        return
+
+    def close(self) -> None:
+        super().close()
+        try:
+            # Empty the write-ahead log so that the next opening does not need to scan it.
+            self._get_connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.OperationalError:
+            pass
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+        return
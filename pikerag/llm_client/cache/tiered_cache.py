@@ -0,0 +1,85 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+from typing import Dict, Iterator, Literal, Tuple, Union
+
+from pikerag.llm_client.cache.base import BaseLLMCache
+from pikerag.llm_client.cache.memory_cache import MemoryLRUCache
+
+
+class TieredCache(BaseLLMCache):
+    """Put a `MemoryLRUCache` in front of a persistent cache backend.
+
+    Lookups are served from the memory tier first, and the persistent hits are promoted into it. Updates are written
+    through to both tiers, so the persistent one stays the source of truth and the memory one can be dropped anytime.
+
+    Args:
+        persistent (BaseLLMCache): the persistent cache backend.
+        memory (MemoryLRUCache): the in-memory tier, it can be shared across the persistent caches if cleared on switch.
+    """
+    NAME: str = "TieredCache"
+
+    def __init__(self, persistent: BaseLLMCache, memory: MemoryLRUCache) -> None:
+        super().__init__(persistent.location, persistent._auto_dump)
+        self._persistent: BaseLLMCache = persistent
+        self._memory: MemoryLRUCache = memory
+
+        self.num_persistent_hits: int = 0
+        self.num_persistent_misses: int = 0
+
+    @property
+    def persistent(self) -> BaseLLMCache:
+        return self._persistent
+
+    @property
+    def memory(self) -> MemoryLRUCache:
+        return self._memory
+
+    def get(self, key: str) -> Union[str, Literal[False]]:
+        value = self._memory.get(key)
+        if value is not False:
+            return value
+
+        value = self._persistent.get(key)
+        if value is False:
+            self.num_persistent_misses += 1
+        else:
+            self.num_persistent_hits += 1
+            self._memory.set(key, value)
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        self._persistent.set(key, value)
+        self._memory.set(key, value)
+        return
+
+    def remove(self, key: str) -> None:
+        self._memory.remove(key)
+        self._persistent.remove(key)
+        return
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        return self._persistent.items()
+
+    def __len__(self) -> int:
+        return len(self._persistent)
+
+    def save(self) -> None:
+        self._persistent.save()
+        return
+
+    def close(self) -> None:
+        self._persistent.close()
+        return
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        num_lookups = self.num_persistent_hits + self.num_persistent_misses
+        return {
+            "memory": self._memory.stats,
+            "persistent": {
+                "num_hits": self.num_persistent_hits,
+                "num_misses": self.num_persistent_misses,
+                "hit_ratio": self.num_persistent_hits / num_lookups if num_lookups > 0 else 0.0,
+            },
+        }
@@ -0,0 +1,32 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+from typing import Dict, Type
+
+from pikerag.llm_client.cache.base import BaseLLMCache
+from pikerag.llm_client.cache.pickledb_cache import PickleDBCache
+from pikerag.llm_client.cache.sqlite_cache import SQLiteCache
+
+
+CACHE_BACKENDS: Dict[str, Type[BaseLLMCache]] = {
+    "pickledb": PickleDBCache,
+    "sqlite": SQLiteCache,
+}
+
+
+def get_cache_class(backend: str) -> Type[BaseLLMCache]:
+    backend = backend.strip().lower()
+    assert backend in CACHE_BACKENDS, f"Unrecognized cache backend: {backend}, choose from {list(CACHE_BACKENDS)}"
+    return CACHE_BACKENDS[backend]
+
+
+def infer_cache_backend(location: str) -> str:
+    """Infer the backend of an existing cache file from its extension."""
+    for backend, cache_class in CACHE_BACKENDS.items():
+        if location.endswith(cache_class.EXTENSION):
+            return backend
+    raise ValueError(f"Cannot infer the cache backend of {location}, choose from {list(CACHE_BACKENDS)} explicitly.")
+
+
+def load_llm_cache(location: str, backend: str = "sqlite", auto_dump: bool = True) -> BaseLLMCache:
+    return get_cache_class(backend)(location=location, auto_dump=auto_dump)
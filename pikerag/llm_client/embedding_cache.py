@@ -0,0 +1,523 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import argparse
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+_META_FILENAME: str = "meta.json"
+_INDEX_FILENAME: str = "index.u64"
+_VECTORS_FILENAME: str = "vectors.bin"
+
+# The recent appended rows are kept in a dict and merged into the sorted index once the dict grows this large.
+_MAX_RECENT_ROWS: int = 4096
+
+_QUERY_KEY_PREFIX: str = "\x00query\x00"
+
+
+def hash_text(text: str) -> int:
+    """The 64-bit key of the text in the embedding cache."""
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def infer_cache_backend(location: str) -> str:
+    """The legacy PickleDB caches are single files (named *.db by default), while the mmap caches are directories."""
+    if os.path.isfile(location) or location.endswith(".db"):
+        return "pickledb"
+    return "mmap"
+
+
+class MmapEmbeddingCache(object):
+    """An append-only embedding cache storing the vectors in a memory-mapped binary matrix.
+
+    The cache is a directory of three files:
+    - `vectors.bin`: the raw row-major matrix of float32 (or float16) vectors, one row per cached text;
+    - `index.u64`: the 64-bit hash of the text of each row, in row order;
+    - `meta.json`: the dimension and the dtype of the vectors, and the identity of the model embedding them.
+
+    The hash->row index is kept as a sorted uint64 array (plus a small dict of the recent appends), i.e. 16 bytes per
+    entry instead of a Python list of boxed floats per entry. The vectors returned by `get()` and `get_many()` are
+    zero-copy views of the memory-mapped matrix, so the cache can be opened `readonly` by many worker processes sharing
+    the same pages while one process appends to it. Call `refresh()` in a reader to see the rows appended by the writer
+    afterwards.
+
+    The texts are keyed by their hashes only, so a cache is bound to the model recorded in `meta.json` and opening it
+    with another `model_id` fails, instead of returning the vectors of another model silently.
+
+    Args:
+        location (str): the directory of the cache.
+        dtype (str): "float32" or "float16", the dtype to store the vectors. Only used when creating a new cache.
+            Defaults to "float32".
+        readonly (bool): open the cache read-only. Defaults to False.
+        model_id (str): the identity of the model embedding the texts, e.g. its name and args. Not checked if None.
+            Defaults to None.
+    """
+    def __init__(
+        self, location: str, dtype: str = "float32", readonly: bool = False, model_id: Optional[str] = None,
+    ) -> None:
+        assert dtype in ("float32", "float16"), f"Unrecognized dtype: {dtype}, should be 'float32' or 'float16'."
+
+        self._location: str = location
+        self._readonly: bool = readonly
+        self._lock = threading.RLock()
+
+        self._meta_path = os.path.join(location, _META_FILENAME)
+        self._index_path = os.path.join(location, _INDEX_FILENAME)
+        self._vectors_path = os.path.join(location, _VECTORS_FILENAME)
+
+        self._dim: Optional[int] = None
+        self._dtype: np.dtype = np.dtype(dtype)
+        self._model_id: Optional[str] = model_id
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, "r") as fin:
+                meta = json.load(fin)
+            self._dim = meta["dim"]
+            self._dtype = np.dtype(meta["dtype"])
+            self._check_model_id(meta)
+        else:
+            assert not readonly, f"Embedding cache {location} does not exist!"
+            os.makedirs(location, exist_ok=True)
+
+        self._num_rows: int = 0
+        self._sorted_hashes: np.ndarray = np.zeros(0, dtype=np.uint64)
+        self._sorted_rows: np.ndarray = np.zeros(0, dtype=np.int64)
+        self._recent_rows: Dict[int, int] = {}
+        self._matrix: Optional[np.ndarray] = None
+
+        self._index_file = None
+        self._vectors_file = None
+        self.refresh()
+
+    def _check_model_id(self, meta: dict) -> None:
+        cached_model_id: Optional[str] = meta.get("model", None)
+        if self._model_id is None:
+            self._model_id = cached_model_id
+            return
+
+        assert cached_model_id is None or cached_model_id == self._model_id, (
+            f"Embedding cache {self._location} is built by model {cached_model_id} but opened for {self._model_id}! "
+            f"Use another location for this model."
+        )
+        if cached_model_id is None and not self._readonly:
+            # The caches created before the model identity was recorded are bound to the first model opening them.
+            print(f"[Embedding Cache] {self._location}: bound to model {self._model_id}.")
+            self._write_meta()
+        return
+
+    def _write_meta(self) -> None:
+        tmp_path = f"{self._meta_path}.tmp"
+        with open(tmp_path, "w") as fout:
+            json.dump({"dim": self._dim, "dtype": self._dtype.name, "model": self._model_id}, fout)
+        os.replace(tmp_path, self._meta_path)
+        return
+
+    @property
+    def location(self) -> str:
+        return self._location
+
+    @property
+    def dim(self) -> Optional[int]:
+        return self._dim
+
+    @property
+    def readonly(self) -> bool:
+        return self._readonly
+
+    def __len__(self) -> int:
+        return self._num_rows
+
+    def __contains__(self, text: str) -> bool:
+        return self._lookup_row(hash_text(text)) >= 0
+
+    def refresh(self) -> None:
+        """Load the index and re-map the matrix, to see the rows appended by other processes."""
+        with self._lock:
+            if self._dim is None and os.path.exists(self._meta_path):
+                with open(self._meta_path, "r") as fin:
+                    meta = json.load(fin)
+                self._dim, self._dtype = meta["dim"], np.dtype(meta["dtype"])
+                self._check_model_id(meta)
+            if self._dim is None:
+                return
+
+            hashes = np.fromfile(self._index_path, dtype=np.uint64) if os.path.exists(self._index_path) else None
+            if hashes is None or len(hashes) == 0:
+                return
+
+            # The vector is written before its hash, rows without a complete vector are not committed.
+            num_vectors = os.path.getsize(self._vectors_path) // (self._dim * self._dtype.itemsize)
+            num_rows = min(len(hashes), num_vectors)
+            hashes = hashes[:num_rows]
+
+            order = np.argsort(hashes, kind="stable")
+            self._sorted_hashes = hashes[order]
+            self._sorted_rows = order.astype(np.int64)
+            self._recent_rows = {}
+            self._num_rows = num_rows
+            self._remap()
+        return
+
+    def _remap(self) -> None:
+        if self._num_rows == 0:
+            self._matrix = None
+            return
+        self._matrix = np.memmap(self._vectors_path, dtype=self._dtype, mode="r", shape=(self._num_rows, self._dim))
+        return
+
+    def _merge_recent_rows(self) -> None:
+        if len(self._recent_rows) == 0:
+            return
+        hashes = np.concatenate([self._sorted_hashes, np.fromiter(self._recent_rows.keys(), dtype=np.uint64)])
+        rows = np.concatenate([self._sorted_rows, np.fromiter(self._recent_rows.values(), dtype=np.int64)])
+        order = np.argsort(hashes, kind="stable")
+        self._sorted_hashes, self._sorted_rows = hashes[order], rows[order]
+        self._recent_rows = {}
+        return
+
+    def _lookup_row(self, key: int) -> int:
+        with self._lock:
+            row = self._recent_rows.get(key, None)
+            if row is not None:
+                return row
+            pos = int(np.searchsorted(self._sorted_hashes, np.uint64(key)))
+            if pos < len(self._sorted_hashes) and int(self._sorted_hashes[pos]) == key:
+                return int(self._sorted_rows[pos])
+            return -1
+
+    def lookup_rows(self, texts: Sequence[str]) -> np.ndarray:
+        """Return the rows of the texts in the matrix, -1 for the ones not cached."""
+        keys = np.array([hash_text(text) for text in texts], dtype=np.uint64)
+        rows = np.full(len(texts), -1, dtype=np.int64)
+        with self._lock:
+            if len(self._sorted_hashes) > 0:
+                positions = np.minimum(np.searchsorted(self._sorted_hashes, keys), len(self._sorted_hashes) - 1)
+                found = self._sorted_hashes[positions] == keys
+                rows[found] = self._sorted_rows[positions[found]]
+            if len(self._recent_rows) > 0:
+                for idx in np.flatnonzero(rows < 0).tolist():
+                    rows[idx] = self._recent_rows.get(int(keys[idx]), -1)
+        return rows
+
+    @property
+    def matrix(self) -> Optional[np.ndarray]:
+        """The read-only memory-mapped matrix of all the cached vectors, None if empty."""
+        with self._lock:
+            if self._matrix is None or len(self._matrix) < self._num_rows:
+                self._remap()
+            return self._matrix
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        """Return the zero-copy view of the cached vector, None if not cached."""
+        row = self._lookup_row(hash_text(text))
+        if row < 0:
+            return None
+        return self.matrix[row]
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Return the zero-copy views of the cached vectors, None for the ones not cached."""
+        rows = self.lookup_rows(texts)
+        matrix = self.matrix
+        return [matrix[row] if row >= 0 else None for row in rows.tolist()]
+
+    def _open_for_append(self, dim: int) -> None:
+        if self._dim is None:
+            self._dim = dim
+            self._write_meta()
+        assert dim == self._dim, f"Vector of dim {dim} cannot be saved into the cache of dim {self._dim}!"
+
+        if self._vectors_file is None:
+            # Truncate the uncommitted tails left by a crashed writer, so that the rows stay aligned.
+            with open(self._vectors_path, "ab") as fout:
+                fout.truncate(self._num_rows * self._dim * self._dtype.itemsize)
+            with open(self._index_path, "ab") as fout:
+                fout.truncate(self._num_rows * 8)
+            self._vectors_file = open(self._vectors_path, "ab")
+            self._index_file = open(self._index_path, "ab")
+        return
+
+    def set(self, text: str, vector: Sequence[float]) -> None:
+        self.set_many([text], [vector])
+        return
+
+    def set_many(self, texts: Sequence[str], vectors: Sequence[Sequence[float]]) -> None:
+        """Append the vectors of the texts not cached yet."""
+        assert not self._readonly, f"Embedding cache {self._location} is opened read-only!"
+        assert len(texts) == len(vectors), f"{len(vectors)} vectors given for {len(texts)} texts!"
+        if len(texts) == 0:
+            return
+
+        with self._lock:
+            keys: List[int] = []
+            new_vectors: List[Sequence[float]] = []
+            seen_keys = set()
+            for text, vector, row in zip(texts, vectors, self.lookup_rows(texts).tolist()):
+                key = hash_text(text)
+                if row >= 0 or key in seen_keys:
+                    continue
+                seen_keys.add(key)
+                keys.append(key)
+                new_vectors.append(vector)
+            if len(keys) == 0:
+                return
+
+            matrix = np.asarray(new_vectors, dtype=self._dtype)
+            self._open_for_append(matrix.shape[1])
+
+            self._vectors_file.write(matrix.tobytes())
+            self._vectors_file.flush()
+            self._index_file.write(np.array(keys, dtype=np.uint64).tobytes())
+            self._index_file.flush()
+
+            for key in keys:
+                self._recent_rows[key] = self._num_rows
+                self._num_rows += 1
+            if len(self._recent_rows) >= _MAX_RECENT_ROWS:
+                self._merge_recent_rows()
+        return
+
+    def save(self) -> None:
+        """Flush the appended rows to disk."""
+        with self._lock:
+            for file in (self._vectors_file, self._index_file):
+                if file is not None:
+                    file.flush()
+                    os.fsync(file.fileno())
+        return
+
+    def close(self) -> None:
+        with self._lock:
+            self.save()
+            for file in (self._vectors_file, self._index_file):
+                if file is not None:
+                    file.close()
+            self._vectors_file, self._index_file = None, None
+            self._matrix = None
+        return
+
+
+def import_pickledb_embeddings(
+    src_locations: List[str],
+    dst_location: str,
+    dtype: str = "float32",
+    model_id: Optional[str] = None,
+    batch_size: int = 1000,
+) -> int:
+    """Import the existing PickleDB embedding caches, i.e. text -> vector, into a (new or existing) mmap cache. The
+    texts already in the destination are kept.
+
+    Returns:
+        int: the number of entries read from the sources.
+    """
+    from pickledb import PickleDB
+
+    dst = MmapEmbeddingCache(dst_location, dtype=dtype, model_id=model_id)
+
+    num_imported: int = 0
+    for src_location in src_locations:
+        src = PickleDB(location=src_location)
+        texts: List[str] = []
+        vectors: List[List[float]] = []
+        for text in src.all():
+            texts.append(text)
+            vectors.append(src.get(text))
+            if len(texts) >= batch_size:
+                dst.set_many(texts, vectors)
+                num_imported += len(texts)
+                texts, vectors = [], []
+        dst.set_many(texts, vectors)
+        num_imported += len(texts)
+        print(f"[Embedding Cache Migration] {src_location} imported.")
+
+    dst.close()
+    return num_imported
+
+
+class CachedEmbeddings(Embeddings):
+    """Wrap an embedding model with the `MmapEmbeddingCache`, so that only the texts missing in the cache are embedded.
+
+    Args:
+        embedding (Embeddings): the embedding model to wrap, e.g. the HuggingFaceEmbeddings.
+        location (str): the directory of the cache.
+        dtype (str): "float32" or "float16", the dtype to store the vectors. Defaults to "float32".
+        readonly (bool): open the cache read-only, the new embeddings would not be saved. Defaults to False.
+        model_id (str): the identity of the wrapped model, checked against the one recorded in the cache. Defaults to
+            None.
+    """
+    def __init__(
+        self,
+        embedding: Embeddings,
+        location: str,
+        dtype: str = "float32",
+        readonly: bool = False,
+        model_id: Optional[str] = None,
+    ) -> None:
+        self._embedding: Embeddings = embedding
+        self._cache = MmapEmbeddingCache(location, dtype=dtype, readonly=readonly, model_id=model_id)
+        self._readonly: bool = readonly
+
+    @property
+    def cache(self) -> MmapEmbeddingCache:
+        return self._cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        cached = self._cache.get_many(texts)
+        missing_texts: List[str] = list(dict.fromkeys(text for text, vector in zip(texts, cached) if vector is None))
+
+        new_embeddings: Dict[str, List[float]] = {}
+        if len(missing_texts) > 0:
+            embeddings = self._embedding.embed_documents(missing_texts)
+            new_embeddings = dict(zip(missing_texts, embeddings))
+            if not self._readonly:
+                self._cache.set_many(missing_texts, embeddings)
+
+        return [
+            vector.tolist() if vector is not None else list(new_embeddings[text])
+            for text, vector in zip(texts, cached)
+        ]
+
+    def embed_query(self, text: str) -> List[float]:
+        # Some models embed the queries differently (e.g. with an instruction prefix), thus cached separately.
+        key = _QUERY_KEY_PREFIX + text
+        vector = self._cache.get(key)
+        if vector is not None:
+            return vector.tolist()
+
+        embedding = self._embedding.embed_query(text)
+        if not self._readonly:
+            self._cache.set(key, embedding)
+        return embedding
+
+
+class MemoizedEmbeddings(Embeddings):
+    """Wrap an embedding model with a bounded in-memory LRU memo of the query embeddings, so that the same query is
+    embedded once no matter how many retrievers or workflow steps use it. The bulk `embed_documents()` calls pass
+    through without being memoized.
+
+    The stored vectors are the document embeddings, which differ from the query ones for the asymmetric models (e.g.
+    E5 or BGE with a query instruction). Only if `prime_from_store` is set, i.e. the model is known to be symmetric
+    like the OpenAI ones, the memo is primed with the vectors already stored in a vector store (e.g. the atoms fetched
+    with their embeddings) so that they are not embedded again as queries, and the queries missed are embedded in one
+    `embed_documents()` batch.
+
+    Args:
+        embedding (Embeddings): the embedding model to wrap.
+        max_entries (int): the maximum number of query embeddings kept. Defaults to 4096.
+        prime_from_store (bool): whether the document embeddings can be used as the query ones. Defaults to False.
+    """
+    def __init__(self, embedding: Embeddings, max_entries: int = 4096, prime_from_store: bool = False) -> None:
+        assert max_entries > 0, f"max_entries should be positive (but {max_entries} was given)!"
+
+        self._embedding: Embeddings = embedding
+        self._max_entries: int = max_entries
+        self._prime_from_store: bool = prime_from_store
+
+        self._lock = threading.Lock()
+        self._memo: "OrderedDict[str, List[float]]" = OrderedDict()
+
+        self.num_hits: int = 0
+        self.num_misses: int = 0
+        self.num_primed: int = 0
+
+    @property
+    def embedding(self) -> Embeddings:
+        return self._embedding
+
+    @property
+    def prime_from_store(self) -> bool:
+        return self._prime_from_store
+
+    def _set(self, text: str, vector: List[float]) -> None:
+        self._memo[text] = vector
+        self._memo.move_to_end(text)
+        while len(self._memo) > self._max_entries:
+            self._memo.popitem(last=False)
+        return
+
+    def prime(self, texts: Sequence[str], vectors: Sequence[Sequence[float]]) -> None:
+        """Put the known (text, vector) pairs into the memo."""
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                if text not in self._memo:
+                    self._set(text, [float(value) for value in vector])
+                    self.num_primed += 1
+        return
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embedding.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with self._lock:
+            vector = self._memo.get(text, None)
+            if vector is not None:
+                self._memo.move_to_end(text)
+                self.num_hits += 1
+                return vector
+            self.num_misses += 1
+
+        vector = self._embedding.embed_query(text)
+        with self._lock:
+            self._set(text, vector)
+        return vector
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embed the queries with the memo. The ones missed are embedded in one batch by the `embed_documents()` of the
+        wrapped model if `prime_from_store` is set, otherwise by its `embed_queries()` if it has one, otherwise one by
+        one by its `embed_query()`.
+        """
+        vectors: List[Optional[List[float]]] = []
+        with self._lock:
+            for text in texts:
+                vector = self._memo.get(text, None)
+                if vector is not None:
+                    self._memo.move_to_end(text)
+                    self.num_hits += 1
+                vectors.append(vector)
+
+        missed_texts: List[str] = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if len(missed_texts) > 0:
+            if self._prime_from_store:
+                embeddings = self._embedding.embed_documents(missed_texts)
+            elif hasattr(self._embedding, "embed_queries"):
+                embeddings = self._embedding.embed_queries(missed_texts)
+            else:
+                embeddings = [self._embedding.embed_query(text) for text in missed_texts]
+            missed_vectors: Dict[str, List[float]] = dict(zip(missed_texts, embeddings))
+            with self._lock:
+                self.num_misses += len(missed_texts)
+                for text, vector in missed_vectors.items():
+                    self._set(text, vector)
+            vectors = [vector if vector is not None else missed_vectors[text] for text, vector in zip(texts, vectors)]
+        return vectors
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "num_entries": len(self._memo),
+                "num_hits": self.num_hits,
+                "num_misses": self.num_misses,
+                "num_primed": self.num_primed,
+            }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import existing PickleDB embedding caches into an mmap cache.")
+    parser.add_argument("sources", type=str, nargs="+", help="the PickleDB cache file(s) to import")
+    parser.add_argument("-o", "--output", type=str, required=True, help="the directory of the destination mmap cache")
+    parser.add_argument("--dtype", type=str, default="float32", help="the dtype of the destination cache")
+    parser.add_argument(
+        "--model-id", type=str, default=None,
+        help="the model the vectors come from, e.g. AzureOpenAIEmbedding:text-embedding-ada-002",
+    )
+    args = parser.parse_args()
+
+    num_imported = import_pickledb_embeddings(args.sources, args.output, args.dtype, args.model_id)
+    print(f"[Embedding Cache Migration] {num_imported} entries imported into {args.output}.")
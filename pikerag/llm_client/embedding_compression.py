@@ -0,0 +1,345 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""Store the vectors at a reduced dimensionality and / or precision.
+
+The compression is applied by wrapping the embedding model with `CompressedEmbeddings`, so the documents and the
+queries are always projected the same way. It is configured by `compression` in the `vector_store` block of the Chroma
+retrievers:
+
+    vector_store:
+      compression:
+        # "truncate" keeps the leading dimensions (Matryoshka-style), "pca" projects with a PCA fitted on the documents.
+        method: pca
+        dimensions: 256
+        # "float32", "float16" or "int8".
+        precision: float16
+
+Run this module to compare the recall@k of several settings against the full-precision vectors of a built collection
+before picking one, e.g.:
+
+    python -m pikerag.llm_client.embedding_compression data/vector_stores/hotpotqa hotpotqa_atom \
+        -s truncate:256 pca:256 pca:128:int8
+"""
+
+import argparse
+import os
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+COMPRESSION_METHODS: Tuple[str, ...] = ("truncate", "pca")
+COMPRESSION_PRECISIONS: Tuple[str, ...] = ("float32", "float16", "int8")
+
+
+def get_compression_tag(dimensions: Optional[int] = None, method: str = "truncate", precision: str = "float32") -> str:
+    """The short tag of the compression setting, e.g. "pca256-int8", empty if nothing is compressed."""
+    parts: List[str] = []
+    if dimensions is not None:
+        parts.append(f"{method}{dimensions}")
+    if precision != "float32":
+        parts.append(precision)
+    return "-".join(parts)
+
+
+def fit_pca_projection(
+    vectors: np.ndarray, dimensions: int, max_samples: int = 20000, seed: int = 0,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Fit a PCA projection on the given vectors.
+
+    Returns:
+        np.ndarray: the mean vector, in shape (dim,).
+        np.ndarray: the principal components, in shape (dimensions, dim).
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    assert vectors.ndim == 2, f"A matrix of vectors expected but got shape {vectors.shape}!"
+    assert dimensions <= vectors.shape[1], f"Cannot project {vectors.shape[1]}-d vectors to {dimensions}-d!"
+    assert len(vectors) >= dimensions, f"At least {dimensions} vectors needed to fit the PCA but got {len(vectors)}!"
+
+    if len(vectors) > max_samples:
+        rng = np.random.default_rng(seed)
+        vectors = vectors[rng.choice(len(vectors), max_samples, replace=False)]
+
+    mean = vectors.mean(axis=0)
+    _, _, components = np.linalg.svd(vectors - mean, full_matrices=False)
+    return mean, components[:dimensions]
+
+
+def quantize_vectors(vectors: np.ndarray, precision: str) -> np.ndarray:
+    """Round the vectors to the values representable in the given precision, returned in float32.
+
+    The int8 quantization is symmetric with a scale per vector.
+    """
+    assert precision in COMPRESSION_PRECISIONS, f"Unrecognized precision: {precision}!"
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if precision == "float16":
+        return vectors.astype(np.float16).astype(np.float32)
+
+    if precision == "int8":
+        scales = np.abs(vectors).max(axis=-1, keepdims=True) / 127
+        scales[scales == 0] = 1
+        return (np.clip(np.round(vectors / scales), -127, 127) * scales).astype(np.float32)
+
+    return vectors
+
+
+def compress_vectors(
+    vectors: np.ndarray,
+    dimensions: Optional[int] = None,
+    method: str = "truncate",
+    precision: str = "float32",
+    projection: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+    normalize: bool = True,
+) -> np.ndarray:
+    """Reduce the dimensionality and / or the precision of the vectors, the `projection` is needed for "pca"."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+
+    if dimensions is not None:
+        if method == "pca":
+            assert projection is not None, "The PCA projection is needed to compress the vectors by pca!"
+            mean, components = projection
+            vectors = (vectors - mean) @ components.T
+        else:
+            vectors = vectors[..., :dimensions]
+
+    if normalize:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        vectors = vectors / norms
+
+    return quantize_vectors(vectors, precision)
+
+
+class CompressedEmbeddings(Embeddings):
+    """Wrap an embedding model to return the vectors at a reduced dimensionality and / or precision, for both the
+    documents and the queries.
+
+    - `method="truncate"` keeps the leading `dimensions` of the vectors, which works best with the models trained with
+        the Matryoshka loss (e.g. OpenAI text-embedding-3).
+    - `method="pca"` projects the vectors with a PCA fitted by `fit()` on a sample of the whole corpus before any
+        document is embedded, and saved to `projection_path` to be reused afterwards. It is never fitted lazily on the
+        batches passed to `embed_documents()`, which are arbitrary slices of the corpus.
+
+    The vectors are re-normalized after the reduction so that the relevance scores and the thresholds keep their
+    ranges. Note that Chroma persists the vectors in float32, so the `precision` reduces the information kept but not
+    the size of a Chroma collection, while the `dimensions` reduce both.
+
+    Args:
+        embedding (Embeddings): the embedding model to wrap.
+        dimensions (int): the dimensionality to keep. None to keep all of them. Defaults to None.
+        method (str): "truncate" or "pca". Defaults to "truncate".
+        precision (str): "float32", "float16" or "int8". Defaults to "float32".
+        projection_path (str): the .npz file to save / load the PCA projection. Required for "pca".
+        normalize (bool): re-normalize the reduced vectors. Defaults to True.
+        max_fit_samples (int): the maximum number of vectors sampled to fit the PCA. Defaults to 20000.
+    """
+    def __init__(
+        self,
+        embedding: Embeddings,
+        dimensions: Optional[int] = None,
+        method: str = "truncate",
+        precision: str = "float32",
+        projection_path: Optional[str] = None,
+        normalize: bool = True,
+        max_fit_samples: int = 20000,
+    ) -> None:
+        assert method in COMPRESSION_METHODS, f"Unrecognized method: {method}, should be one of {COMPRESSION_METHODS}."
+        assert precision in COMPRESSION_PRECISIONS, (
+            f"Unrecognized precision: {precision}, should be one of {COMPRESSION_PRECISIONS}."
+        )
+        assert method != "pca" or dimensions is not None, "dimensions must be given to compress by pca!"
+        assert method != "pca" or projection_path is not None, "projection_path must be given to compress by pca!"
+
+        self._embedding: Embeddings = embedding
+        self._dimensions: Optional[int] = dimensions
+        self._method: str = method
+        self._precision: str = precision
+        self._projection_path: Optional[str] = projection_path
+        self._normalize: bool = normalize
+        self._max_fit_samples: int = max_fit_samples
+
+        self._lock = threading.Lock()
+        self._projection: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        if method == "pca" and os.path.exists(projection_path):
+            with np.load(projection_path) as data:
+                self._projection = (data["mean"], data["components"])
+            assert len(self._projection[1]) == dimensions, (
+                f"The projection in {projection_path} is {len(self._projection[1])}-d but {dimensions}-d expected!"
+            )
+
+    @property
+    def embedding(self) -> Embeddings:
+        return self._embedding
+
+    @property
+    def tag(self) -> str:
+        return get_compression_tag(self._dimensions, self._method, self._precision)
+
+    @property
+    def needs_fit(self) -> bool:
+        return self._method == "pca" and self._projection is None
+
+    def fit(self, texts: Sequence[str], batch_size: int = 256, seed: int = 0) -> None:
+        """Fit the PCA projection on a random sample of at most `max_fit_samples` of the `texts`, i.e. the corpus of
+        the collections to build, and save it to `projection_path`. Nothing to do if no projection is needed or it is
+        fitted already.
+        """
+        if not self.needs_fit:
+            return
+
+        texts = list(texts)
+        if len(texts) > self._max_fit_samples:
+            rng = np.random.default_rng(seed)
+            texts = [texts[i] for i in sorted(rng.choice(len(texts), self._max_fit_samples, replace=False))]
+
+        print(f"[Vector Compression] fitting the PCA projection on {len(texts)} documents.")
+        vectors = np.concatenate([
+            np.asarray(self._embedding.embed_documents(texts[start:start + batch_size]), dtype=np.float32)
+            for start in range(0, len(texts), batch_size)
+        ])
+        self.fit_projection(vectors)
+        return
+
+    def fit_projection(self, vectors: np.ndarray) -> None:
+        """Fit the PCA projection on the given full-dimensional vectors and save it to `projection_path`."""
+        with self._lock:
+            if self._projection is not None:
+                return
+
+            mean, components = fit_pca_projection(vectors, self._dimensions, self._max_fit_samples)
+            dir_path = os.path.dirname(self._projection_path)
+            if dir_path != "" and not os.path.exists(dir_path):
+                os.makedirs(dir_path)
+            np.savez(self._projection_path, mean=mean, components=components)
+            self._projection = (mean, components)
+        return
+
+    def _compress(self, vectors: np.ndarray) -> np.ndarray:
+        return compress_vectors(
+            vectors, self._dimensions, self._method, self._precision, self._projection, self._normalize,
+        )
+
+    def _check_fitted(self) -> None:
+        assert not self.needs_fit, (
+            f"No PCA projection found in {self._projection_path}, call fit() on the corpus before embedding."
+        )
+        return
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self._check_fitted()
+        vectors = np.asarray(self._embedding.embed_documents(texts), dtype=np.float32)
+        return self._compress(vectors).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        self._check_fitted()
+        vector = np.asarray(self._embedding.embed_query(text), dtype=np.float32)
+        return self._compress(vector).tolist()
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embed the queries in one batch if the wrapped model has `embed_queries()`, otherwise one by one."""
+        self._check_fitted()
+        if hasattr(self._embedding, "embed_queries"):
+            vectors = np.asarray(self._embedding.embed_queries(texts), dtype=np.float32)
+        else:
+            vectors = np.asarray([self._embedding.embed_query(text) for text in texts], dtype=np.float32)
+        return self._compress(vectors).tolist()
+
+
+def compute_recall_at_k(
+    vectors: np.ndarray,
+    settings: Sequence[dict],
+    k: int = 10,
+    num_queries: int = 1000,
+    seed: int = 0,
+) -> Dict[str, float]:
+    """Compute the recall@k of the compression settings against the full-precision vectors.
+
+    A random sample of the vectors is used as the queries, each one excluded from its own results. The exact top-k by
+    cosine similarity of the full-precision vectors is taken as the ground truth, and the recall@k of each setting is
+    the fraction of it found in the exact top-k of the compressed vectors.
+
+    Args:
+        vectors (np.ndarray): the full-precision vectors of a collection, in shape (N, dim).
+        settings (Sequence[dict]): the args of `compress_vectors()` to compare, the PCA projections are fitted on the
+            `vectors` if not given.
+        k (int): the number of the nearest neighbors to compare. Defaults to 10.
+        num_queries (int): the number of the vectors sampled as queries. Defaults to 1000.
+        seed (int): the random seed of the sampling. Defaults to 0.
+
+    Returns:
+        Dict[str, float]: the recall@k of each setting, keyed by its tag.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    assert len(vectors) > k, f"More than {k} vectors needed to compute recall@{k} but got {len(vectors)}!"
+
+    rng = np.random.default_rng(seed)
+    query_rows = rng.choice(len(vectors), min(num_queries, len(vectors)), replace=False)
+
+    def top_k(matrix: np.ndarray) -> np.ndarray:
+        scores = matrix[query_rows] @ matrix.T
+        scores[np.arange(len(query_rows)), query_rows] = -np.inf
+        return np.argpartition(-scores, k, axis=1)[:, :k]
+
+    ground_truth = top_k(compress_vectors(vectors))
+
+    recalls: Dict[str, float] = {}
+    for setting in settings:
+        setting = dict(setting)
+        if setting.get("method", "truncate") == "pca" and setting.get("projection", None) is None:
+            setting["projection"] = fit_pca_projection(vectors, setting["dimensions"])
+
+        candidates = top_k(compress_vectors(vectors, **setting))
+        num_found = sum(
+            len(np.intersect1d(truth_row, candidate_row)) for truth_row, candidate_row in zip(ground_truth, candidates)
+        )
+        tag = get_compression_tag(
+            setting.get("dimensions", None), setting.get("method", "truncate"), setting.get("precision", "float32"),
+        )
+        recalls[tag if tag != "" else "float32"] = num_found / ground_truth.size
+    return recalls
+
+
+def _parse_setting(setting_str: str) -> dict:
+    """Parse the setting like "pca:256:int8", "truncate:512" or "float16" into the args of `compress_vectors()`."""
+    setting: dict = {}
+    for part in setting_str.split(":"):
+        if part in COMPRESSION_METHODS:
+            setting["method"] = part
+        elif part in COMPRESSION_PRECISIONS:
+            setting["precision"] = part
+        else:
+            setting["dimensions"] = int(part)
+    return setting
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compare the recall@k of the vector compression settings.")
+    parser.add_argument("persist_directory", type=str, help="the persist directory of the Chroma collection")
+    parser.add_argument("collection_name", type=str, help="the name of the full-precision Chroma collection")
+    parser.add_argument(
+        "-s", "--settings", type=str, nargs="+", required=True, help="the settings to compare, e.g. pca:256:int8",
+    )
+    parser.add_argument("-k", type=int, default=10, help="the k of recall@k")
+    parser.add_argument("-n", "--num-queries", type=int, default=1000, help="the number of the sampled queries")
+    parser.add_argument("--seed", type=int, default=0, help="the random seed of the sampling")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import chromadb
+
+    args = _parse_args()
+
+    collection = chromadb.PersistentClient(path=args.persist_directory).get_collection(args.collection_name)
+    vectors = np.asarray(collection.get(include=["embeddings"])["embeddings"], dtype=np.float32)
+    print(f"[Vector Compression] {len(vectors)} {vectors.shape[1]}-d vectors loaded from {args.collection_name}.")
+
+    recalls = compute_recall_at_k(
+        vectors, [_parse_setting(setting) for setting in args.settings], args.k, args.num_queries, args.seed,
+    )
+    for tag, recall in recalls.items():
+        print(f"  {tag}: recall@{args.k} = {recall:.4f}")
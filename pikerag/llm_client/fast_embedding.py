@@ -0,0 +1,310 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import multiprocessing
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+_DEFAULT_ONNX_CACHE_DIR: str = os.path.join(os.path.expanduser("~"), ".cache", "pikerag", "onnx")
+
+
+class _LocalEncoder(object):
+    """The tokenizer and the model of `FastCPUEmbedding`, created in each encode process. The model is loaded lazily so
+    that the main process only holds the tokenizer if the encoding is done by the process pool.
+    """
+    def __init__(
+        self, model_name: str, backend: str, quantize_int8: bool, pooling: str, normalize: bool, max_length: int,
+        num_threads: Optional[int], onnx_dir: Optional[str],
+    ) -> None:
+        from transformers import AutoTokenizer
+
+        self.model_name: str = model_name
+        self.backend: str = backend
+        self.quantize_int8: bool = quantize_int8
+        self.pooling: str = pooling
+        self.normalize: bool = normalize
+        self.max_length: int = max_length
+        self.num_threads: Optional[int] = num_threads
+        self.onnx_dir: str = onnx_dir or os.path.join(_DEFAULT_ONNX_CACHE_DIR, model_name.replace("/", "__"))
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self._model = None
+        self._lock = threading.Lock()
+
+    def count_tokens(self, texts: List[str]) -> List[int]:
+        encoded = self.tokenizer(texts, truncation=True, max_length=self.max_length)
+        return [len(input_ids) for input_ids in encoded["input_ids"]]
+
+    def _load_onnx_model(self):
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+
+        file_name = "model_quantized.onnx" if self.quantize_int8 else "model.onnx"
+        if not os.path.exists(os.path.join(self.onnx_dir, "model.onnx")):
+            print(f"[FastCPUEmbedding] Exporting {self.model_name} to ONNX: {self.onnx_dir}")
+            model = ORTModelForFeatureExtraction.from_pretrained(self.model_name, export=True)
+            model.save_pretrained(self.onnx_dir)
+
+        if self.quantize_int8 and not os.path.exists(os.path.join(self.onnx_dir, file_name)):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            print(f"[FastCPUEmbedding] Quantizing the ONNX model weights to int8: {self.onnx_dir}")
+            quantize_dynamic(
+                os.path.join(self.onnx_dir, "model.onnx"),
+                os.path.join(self.onnx_dir, file_name),
+                weight_type=QuantType.QInt8,
+                use_external_data_format=True,
+            )
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.num_threads is not None:
+            session_options.intra_op_num_threads = self.num_threads
+        return ORTModelForFeatureExtraction.from_pretrained(
+            self.onnx_dir, file_name=file_name, provider="CPUExecutionProvider", session_options=session_options,
+        )
+
+    def _load_torch_model(self):
+        import torch
+        from transformers import AutoModel
+
+        model = AutoModel.from_pretrained(self.model_name).eval()
+        if self.quantize_int8:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    @property
+    def model(self):
+        with self._lock:
+            if self._model is None:
+                import torch
+
+                if self.num_threads is not None:
+                    torch.set_num_threads(self.num_threads)
+                self._model = self._load_onnx_model() if self.backend == "onnx" else self._load_torch_model()
+        return self._model
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        import torch
+
+        inputs = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="pt")
+        with torch.inference_mode():
+            hidden = self.model(**inputs)[0]
+
+        if self.pooling == "cls":
+            embeddings = hidden[:, 0]
+        else:
+            mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            embeddings = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+
+        if self.normalize:
+            embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+        return embeddings.float().cpu().numpy()
+
+
+# The encoder of each worker process in the encode pool.
+_worker_encoder: Optional[_LocalEncoder] = None
+
+
+def _init_worker(encoder_kwargs: dict) -> None:
+    global _worker_encoder
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _worker_encoder = _LocalEncoder(**encoder_kwargs)
+    return
+
+
+def _encode_in_worker(texts: List[str]) -> np.ndarray:
+    return _worker_encoder.encode(texts)
+
+
+class FastCPUEmbedding(Embeddings):
+    """A CPU-optimized local embedding model, a faster stand-in of the default `HuggingFaceEmbeddings`:
+
+    - the model runs on ONNX Runtime (exported once and cached in `onnx_dir`), or on PyTorch, with the weights
+        optionally quantized to int8;
+    - the texts are sorted by token length and batched with similar lengths, so that few pad tokens are computed;
+    - the bulk `embed_documents()` calls are encoded by a pool of `num_processes` worker processes.
+
+    Select it in the `embedding_setting` of the vector store, e.g.:
+
+        embedding_setting:
+          module_path: pikerag.llm_client.fast_embedding
+          class_name: FastCPUEmbedding
+          args:
+            model_name: BAAI/bge-m3
+            backend: onnx
+            quantize_int8: true
+            num_processes: 4
+            num_threads: 4
+
+    Use `compare_with_reference()` to check the embeddings against the reference model, and `stats` for the
+    throughput.
+
+    Args:
+        model_name (str): the HuggingFace model name or path. Defaults to "BAAI/bge-m3".
+        backend (str): "onnx" for ONNX Runtime (requires `optimum[onnxruntime]`), or "torch". Defaults to "onnx".
+        quantize_int8 (bool): quantize the weights of the linear layers to int8. Defaults to False.
+        pooling (str): "cls" or "mean", how to pool the token embeddings. Defaults to "cls", as BGE models do.
+        normalize (bool): L2-normalize the embeddings. Defaults to True.
+        max_length (int): the maximum number of tokens per text, longer ones are truncated. Defaults to 8192.
+        batch_size (int): the maximum number of texts in one batch. Defaults to 32.
+        max_batch_tokens (int): the maximum of padded tokens (batch size x longest length) in one batch. Defaults to
+            16384.
+        num_processes (int): the number of worker processes for the bulk encoding. Defaults to 1, i.e. encode in the
+            current process.
+        min_pool_texts (int): the `embed_documents()` calls with fewer texts are encoded in the current process.
+            Defaults to 256.
+        num_threads (int): the number of threads of each encoding process. Defaults to None, i.e. the library default.
+        onnx_dir (str): the directory to cache the exported ONNX model. Defaults to None, i.e.
+            "~/.cache/pikerag/onnx/<model_name>".
+    """
+    def __init__(
+        self, model_name: str = "BAAI/bge-m3", backend: str = "onnx", quantize_int8: bool = False,
+        pooling: str = "cls", normalize: bool = True, max_length: int = 8192, batch_size: int = 32,
+        max_batch_tokens: int = 16384, num_processes: int = 1, min_pool_texts: int = 256, num_threads: int = None,
+        onnx_dir: str = None,
+    ) -> None:
+        assert backend in ("onnx", "torch"), f"Unrecognized backend: {backend}, should be 'onnx' or 'torch'."
+        assert pooling in ("cls", "mean"), f"Unrecognized pooling: {pooling}, should be 'cls' or 'mean'."
+
+        self._encoder_kwargs: dict = {
+            "model_name": model_name,
+            "backend": backend,
+            "quantize_int8": quantize_int8,
+            "pooling": pooling,
+            "normalize": normalize,
+            "max_length": max_length,
+            "num_threads": num_threads,
+            "onnx_dir": onnx_dir,
+        }
+        self._encoder = _LocalEncoder(**self._encoder_kwargs)
+
+        self._batch_size: int = batch_size
+        self._max_batch_tokens: int = max_batch_tokens
+        self._num_processes: int = num_processes
+        self._min_pool_texts: int = min_pool_texts
+        self._pool = None
+
+        self._stats_lock = threading.Lock()
+        self._num_texts: int = 0
+        self._num_batches: int = 0
+        self._num_tokens: int = 0
+        self._num_padded_tokens: int = 0
+        self._encode_time: float = 0
+
+    def _bucket(self, lengths: List[int]) -> List[List[int]]:
+        """Group the text indices into batches of similar token lengths."""
+        batches: List[List[int]] = []
+        batch: List[int] = []
+        for idx in sorted(range(len(lengths)), key=lambda idx: lengths[idx]):
+            # Sorted ascending, thus the current text is the longest one if added.
+            if len(batch) > 0 and (
+                len(batch) >= self._batch_size or (len(batch) + 1) * lengths[idx] > self._max_batch_tokens
+            ):
+                batches.append(batch)
+                batch = []
+            batch.append(idx)
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def _get_pool(self):
+        if self._pool is None:
+            # Spawned instead of forked, the threads of the tokenizers and the runtimes are not fork-safe.
+            self._pool = multiprocessing.get_context("spawn").Pool(
+                self._num_processes, initializer=_init_worker, initargs=(self._encoder_kwargs,),
+            )
+        return self._pool
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        start_time = time.perf_counter()
+        lengths = self._encoder.count_tokens(texts)
+        batches = self._bucket(lengths)
+        batch_texts = [[texts[idx] for idx in batch] for batch in batches]
+
+        if self._num_processes > 1 and len(texts) >= self._min_pool_texts:
+            batch_embeddings = self._get_pool().imap(_encode_in_worker, batch_texts)
+        else:
+            batch_embeddings = (self._encoder.encode(texts) for texts in batch_texts)
+
+        embeddings: Optional[np.ndarray] = None
+        for batch, batch_embedding in zip(batches, batch_embeddings):
+            if embeddings is None:
+                embeddings = np.empty((len(texts), batch_embedding.shape[1]), dtype=np.float32)
+            embeddings[batch] = batch_embedding
+
+        with self._stats_lock:
+            self._num_texts += len(texts)
+            self._num_batches += len(batches)
+            self._num_tokens += sum(lengths)
+            self._num_padded_tokens += sum(len(batch) * max(lengths[idx] for idx in batch) for batch in batches)
+            self._encode_time += time.perf_counter() - start_time
+        return embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if len(texts) == 0:
+            return []
+
+        start_time = time.perf_counter()
+        embeddings = self._encode(texts)
+        if len(texts) >= self._min_pool_texts:
+            time_used = time.perf_counter() - start_time
+            print(
+                f"[FastCPUEmbedding] {len(texts)} texts embedded in {time_used:.2f} s, "
+                f"{len(texts) / max(time_used, 1e-9):.1f} texts/sec."
+            )
+        return embeddings.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0].tolist()
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        """The throughput of the encoding so far, `padding_ratio` is the pad tokens over all the computed tokens."""
+        with self._stats_lock:
+            return {
+                "num_texts": self._num_texts,
+                "num_batches": self._num_batches,
+                "encode_time": self._encode_time,
+                "texts_per_sec": self._num_texts / self._encode_time if self._encode_time > 0 else 0.0,
+                "tokens_per_sec": self._num_tokens / self._encode_time if self._encode_time > 0 else 0.0,
+                "padding_ratio": (
+                    1 - self._num_tokens / self._num_padded_tokens if self._num_padded_tokens > 0 else 0.0
+                ),
+            }
+
+    def compare_with_reference(self, texts: List[str], reference: Embeddings = None) -> Dict[str, float]:
+        """Compare the embeddings of the texts with the reference model, by default the `HuggingFaceEmbeddings` of the
+        same model as `load_embedding_func()` returns.
+
+        Returns:
+            Dict[str, float]: the min and mean cosine similarity, and the max absolute difference of the elements.
+        """
+        if reference is None:
+            from langchain_huggingface import HuggingFaceEmbeddings
+            reference = HuggingFaceEmbeddings(model_name=self._encoder_kwargs["model_name"])
+
+        embeddings = np.asarray(self.embed_documents(texts), dtype=np.float64)
+        reference_embeddings = np.asarray(reference.embed_documents(texts), dtype=np.float64)
+
+        norms = np.linalg.norm(embeddings, axis=1) * np.linalg.norm(reference_embeddings, axis=1)
+        cosine = (embeddings * reference_embeddings).sum(axis=1) / np.maximum(norms, 1e-12)
+        return {
+            "min_cosine": float(cosine.min()),
+            "mean_cosine": float(cosine.mean()),
+            "max_abs_diff": float(np.abs(embeddings - reference_embeddings).max()),
+        }
+
+    def close(self) -> None:
+        """Terminate the worker processes of the encode pool."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        return
@@ -1,15 +1,31 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
-from typing import List
+import copy
+import glob
+import json
+import mmap
+import os
+import resource
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
 
 from pikerag.llm_client.base import BaseLLMClient
+from pikerag.llm_client.batching import DynamicBatcher
 from pikerag.utils.logger import Logger
 
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM
 import torch
 
 
+_SAFETENSORS_DTYPES: Dict[str, torch.dtype] = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+
 def get_torch_dtype(type_str: str) -> torch.dtype:
     type_str = type_str.strip().lower()
     if type_str.startswith("torch."):
@@ -21,28 +37,300 @@ def get_torch_dtype(type_str: str) -> torch.dtype:
         raise ValueError(f"Unrecognized torch.dtype: {type_str}")
 
 
+def load_mmap_state_dict(model_dir: str) -> Tuple[Dict[str, torch.Tensor], List[mmap.mmap]]:
+    """Load the *.safetensors weights in `model_dir` as tensors backed by the memory-mapped files, without copying.
+
+    The files are mapped copy-on-write, so the pages of the weights are shared through the page cache by all the
+    processes mapping the same files, as long as the weights are not written, which is the case for inference.
+
+    Returns:
+        Dict[str, torch.Tensor]: the state dict.
+        List[mmap.mmap]: the memory maps, to be kept alive as long as the tensors are used.
+    """
+    paths = sorted(glob.glob(os.path.join(model_dir, "*.safetensors")))
+    assert len(paths) > 0, f"No safetensors weights found in {model_dir}!"
+
+    state_dict: Dict[str, torch.Tensor] = {}
+    mmaps: List[mmap.mmap] = []
+    for path in paths:
+        with open(path, "rb") as fin:
+            # The layout: the 8-byte little-endian header size, the json header, and then the raw tensor data.
+            header_size = struct.unpack("<Q", fin.read(8))[0]
+            header: dict = json.loads(fin.read(header_size))
+            buffer = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_COPY)
+        mmaps.append(buffer)
+
+        data_start = 8 + header_size
+        for name, info in header.items():
+            if name == "__metadata__":
+                continue
+            dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+            begin, end = info["data_offsets"]
+            num_elements = (end - begin) // torch.empty(0, dtype=dtype).element_size()
+            if num_elements == 0:
+                state_dict[name] = torch.empty(info["shape"], dtype=dtype)
+                continue
+            tensor = torch.frombuffer(buffer, dtype=dtype, count=num_elements, offset=data_start + begin)
+            state_dict[name] = tensor.reshape(info["shape"])
+    return state_dict, mmaps
+
+
 class HFMetaLlamaClient(BaseLLMClient):
     NAME = "HuggingFaceMetaLlamaClient"
 
     def __init__(
         self, location: str = None, auto_dump: bool = True, logger: Logger=None, llm_config: dict = None,
-        max_attempt: int = 5, exponential_backoff_factor: int = None, unit_wait_time: int = 60, **kwargs,
+        max_attempt: int = 5, exponential_backoff_factor: int = None, unit_wait_time: int = 60,
+        cache_backend: str = "sqlite", max_concurrency: int = 64, rate_limit_config: dict = None,
+        memory_cache_config: dict = None, stream_early_stop: bool = False, batch_config: dict = None,
+        cpu_config: dict = None, **kwargs,
     ) -> None:
-        super().__init__(location, auto_dump, logger, max_attempt, exponential_backoff_factor, unit_wait_time, **kwargs)
+        """LLM Communication Client for the local HuggingFace Llama models.
+
+        Args:
+            batch_config (dict): set to enable the dynamic batching, the concurrent requests from worker threads would
+                be collected and generated with one `generate` call. Available keys: `max_batch_size` (defaults to 8)
+                and `max_wait_time` in seconds (defaults to 0.02). Defaults to None, i.e. disabled.
+            cpu_config (dict): set to enable the CPU inference profile. Available keys:
+                - `num_threads` / `num_interop_threads` (int): passed to `torch.set_num_threads()` /
+                    `torch.set_num_interop_threads()` before loading the model.
+                - `quantize_int8` (bool): apply dynamic int8 quantization to the linear layers. Defaults to False.
+                - `mmap_weights` (bool): assign the memory-mapped safetensors weights to the parameters without
+                    copying, so that the worker processes loading the same model share one copy of the weights in the
+                    page cache. Only for the local / downloaded safetensors in the `torch_dtype` of the files, and not
+                    combined with `quantize_int8` since the quantized weights are new tensors in each process; it
+                    falls back to the normal loading with a warning otherwise. Defaults to False.
+                - `kv_cache_reuse` (bool): reuse the KV cache of the longest common prompt prefix with the previous
+                    request, e.g. the history turns of a conversation or a shared system prompt. Only works for the
+                    un-batched requests. Defaults to False.
+                Defaults to None, i.e. disabled.
+            kwargs: the other arguments would be passed to `AutoModelForCausalLM.from_pretrained()`.
+        """
+        super().__init__(
+            location, auto_dump, logger, max_attempt, exponential_backoff_factor, unit_wait_time, cache_backend,
+            max_concurrency, rate_limit_config, memory_cache_config, stream_early_stop, **kwargs,
+        )
 
         assert "model" in llm_config, "`model` should be provided in `llm_config` to initialize `HFMetaLlamaClient`!"
         self._model_id: str = llm_config["model"]
+        self._cpu_config: Optional[dict] = cpu_config
         self._init_agent(**kwargs)
+        self._init_batcher(batch_config)
+        self._init_performance_stats()
 
     def _init_agent(self, **kwargs) -> None:
         self._tokenizer = AutoTokenizer.from_pretrained(self._model_id)
 
         if "torch_dtype" in kwargs:
             kwargs["torch_dtype"] = get_torch_dtype(kwargs["torch_dtype"])
-        self._client = AutoModelForCausalLM.from_pretrained(self._model_id, **kwargs)
 
+        cpu_config: dict = self._cpu_config or {}
+        if self._cpu_config is not None:
+            self._configure_cpu_threads(cpu_config)
+
+        self._weight_mmaps: List[mmap.mmap] = []
+        if cpu_config.get("mmap_weights", False) and self._can_mmap_weights(cpu_config, **kwargs):
+            self._client = self._load_mmap_model(kwargs.get("torch_dtype", None))
+        else:
+            self._client = AutoModelForCausalLM.from_pretrained(self._model_id, **kwargs)
+
+        if cpu_config.get("quantize_int8", False):
+            self._client = torch.ao.quantization.quantize_dynamic(self._client, {torch.nn.Linear}, dtype=torch.qint8)
+            self.debug(f"Linear layers of {self._model_id} dynamically quantized to int8.")
+
+        self._kv_cache_reuse: bool = cpu_config.get("kv_cache_reuse", False)
+        self._prefix_cache: Optional[Tuple[torch.Tensor, object]] = None
+        self._prefix_cache_lock = threading.Lock()
+
+        return
+
+    def _can_mmap_weights(self, cpu_config: dict, **kwargs) -> bool:
+        if cpu_config.get("quantize_int8", False):
+            self.warning("mmap_weights ignored: the int8 quantized weights cannot be shared across processes.")
+            return False
+
+        unsupported_args = [key for key in kwargs if key != "torch_dtype"]
+        if len(unsupported_args) > 0:
+            self.warning(f"mmap_weights ignored: not supported with the loading args {unsupported_args}.")
+            return False
+        return True
+
+    def _load_mmap_model(self, torch_dtype: Optional[torch.dtype]):
+        if os.path.isdir(self._model_id):
+            model_dir = self._model_id
+        else:
+            from huggingface_hub import snapshot_download
+            model_dir = snapshot_download(self._model_id, allow_patterns=["*.json", "*.safetensors"])
+
+        state_dict, self._weight_mmaps = load_mmap_state_dict(model_dir)
+        dtypes = set(tensor.dtype for tensor in state_dict.values() if tensor.is_floating_point())
+        if torch_dtype is None and len(dtypes) == 1:
+            torch_dtype = dtypes.pop()
+        elif torch_dtype is not None and dtypes != {torch_dtype}:
+            # Casting creates a private copy of every weight in each process.
+            self.warning(f"mmap_weights: the weights are {dtypes} but {torch_dtype} required, copied when casting.")
+            state_dict = {
+                name: tensor.to(torch_dtype) if tensor.is_floating_point() else tensor
+                for name, tensor in state_dict.items()
+            }
+
+        # The parameters are left uninitialized (i.e. not resident) and then replaced by the mmap-backed tensors.
+        from transformers.modeling_utils import no_init_weights
+        config = AutoConfig.from_pretrained(model_dir)
+        with no_init_weights():
+            model = AutoModelForCausalLM.from_config(config, torch_dtype=torch_dtype)
+        missing_keys, _ = model.load_state_dict(state_dict, strict=False, assign=True)
+        model.tie_weights()
+        tied_keys = set(getattr(model, "_tied_weights_keys", None) or [])
+        missing_keys = [key for key in missing_keys if key not in tied_keys]
+        assert len(missing_keys) == 0, f"Weights missing in {model_dir}: {missing_keys}"
+        model.eval()
+        self.debug(f"Weights of {self._model_id} memory-mapped from {model_dir}.")
+        return model
+
+    def _configure_cpu_threads(self, cpu_config: dict) -> None:
+        if cpu_config.get("num_threads", None) is not None:
+            torch.set_num_threads(cpu_config["num_threads"])
+
+        if cpu_config.get("num_interop_threads", None) is not None:
+            try:
+                torch.set_num_interop_threads(cpu_config["num_interop_threads"])
+            except RuntimeError as e:
+                # It can only be set once, and before any inter-op parallel work is started.
+                self.warning(f"Failed to set the number of inter-op threads: {e}")
+        return
+
+    def _init_performance_stats(self) -> None:
+        self._stats_lock = threading.Lock()
+        self._num_generated_tokens: int = 0
+        self._generation_time: float = 0
+        return
+
+    def _record_generation(self, num_generated_tokens: int, time_used: float) -> None:
+        with self._stats_lock:
+            self._num_generated_tokens += num_generated_tokens
+            self._generation_time += time_used
         return
 
+    @property
+    def performance_stats(self) -> Dict[str, float]:
+        """The generation throughput and the peak resident set size of this process so far."""
+        with self._stats_lock:
+            return {
+                "num_generated_tokens": self._num_generated_tokens,
+                "generation_time": self._generation_time,
+                "tokens_per_second": (
+                    self._num_generated_tokens / self._generation_time if self._generation_time > 0 else 0.0
+                ),
+                # ru_maxrss is in kilobytes on Linux.
+                "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            }
+
+    def _init_batcher(self, batch_config: dict = None) -> None:
+        self._batcher: DynamicBatcher = None
+        if batch_config is None or batch_config.get("max_batch_size", 8) <= 1:
+            return
+
+        # Left padding to make the generated tokens of all prompts start at the same position.
+        self._tokenizer.padding_side = "left"
+        if self._tokenizer.pad_token is None:
+            self._tokenizer.pad_token = self._tokenizer.eos_token
+
+        self._batcher = DynamicBatcher(
+            batch_fn=self._generate_batch,
+            max_batch_size=batch_config.get("max_batch_size", 8),
+            max_wait_time=batch_config.get("max_wait_time", 0.02),
+        )
+        return
+
+    def _generate_single(self, messages: List[dict], llm_config: dict) -> torch.Tensor:
+        input_ids = self._tokenizer.apply_chat_template(
+            messages,
+            add_generation_prompt=True,
+            return_tensors="pt",
+        ).to(self._client.device)
+
+        start_time = time.time()
+        if self._kv_cache_reuse:
+            sequence = self._generate_with_kv_cache_reuse(input_ids, llm_config)
+        else:
+            sequence = self._client.generate(
+                input_ids,
+                pad_token_id=self._tokenizer.eos_token_id,
+                **llm_config,
+            )[0]
+
+        response = sequence[input_ids.shape[-1]:]
+        self._record_generation(response.shape[-1], time.time() - start_time)
+        return response
+
+    def _get_reusable_kv_cache(self, input_ids: torch.Tensor) -> Optional[object]:
+        with self._prefix_cache_lock:
+            if self._prefix_cache is None:
+                return None
+            cached_ids, cached_kv = self._prefix_cache
+
+        if not hasattr(cached_kv, "crop") or not hasattr(cached_kv, "get_seq_length"):
+            return None
+
+        # At least the last input token must be left un-cached to compute the next token logits.
+        num_comparable = min(cached_kv.get_seq_length(), input_ids.shape[-1] - 1)
+        if num_comparable <= 0:
+            return None
+
+        mismatch = (cached_ids[0, :num_comparable] != input_ids[0, :num_comparable]).nonzero()
+        num_common = mismatch[0].item() if len(mismatch) > 0 else num_comparable
+        if num_common == 0:
+            return None
+
+        kv_cache = copy.deepcopy(cached_kv)
+        kv_cache.crop(num_common)
+        return kv_cache
+
+    def _generate_with_kv_cache_reuse(self, input_ids: torch.Tensor, llm_config: dict) -> torch.Tensor:
+        outputs = self._client.generate(
+            input_ids,
+            past_key_values=self._get_reusable_kv_cache(input_ids),
+            pad_token_id=self._tokenizer.eos_token_id,
+            return_dict_in_generate=True,
+            **llm_config,
+        )
+
+        with self._prefix_cache_lock:
+            self._prefix_cache = (outputs.sequences, outputs.past_key_values)
+
+        return outputs.sequences[0]
+
+    def _generate_batch(self, config_key: str, messages_list: List[List[dict]]) -> List[torch.Tensor]:
+        llm_config: dict = json.loads(config_key)
+        if len(messages_list) == 1:
+            return [self._generate_single(messages_list[0], llm_config)]
+
+        prompts: List[str] = [
+            self._tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+            for messages in messages_list
+        ]
+        # The chat template already contains the special tokens like BOS.
+        inputs = self._tokenizer(
+            prompts, return_tensors="pt", padding=True, add_special_tokens=False,
+        ).to(self._client.device)
+
+        start_time = time.time()
+        outputs = self._client.generate(
+            **inputs,
+            pad_token_id=self._tokenizer.pad_token_id,
+            **llm_config,
+        )
+
+        # The generated part of every row starts right after the (left-padded) prompts; the trailing padding tokens
+        # would be skipped in decoding as special tokens.
+        responses = [output[inputs["input_ids"].shape[-1]:] for output in outputs]
+        num_generated_tokens = sum(
+            (response != self._tokenizer.pad_token_id).sum().item() for response in responses
+        )
+        self._record_generation(num_generated_tokens, time.time() - start_time)
+        return responses
+
     def _get_response_with_messages(self, messages: List[dict], **llm_config) -> str:
         llm_config.pop("model", None)
         # temperature must be positive, 1e-5 works same as 0
@@ -52,19 +340,12 @@ class HFMetaLlamaClient(BaseLLMClient):
         num_attempt: int = 0
         while num_attempt < self._max_attempt:
             try:
-                input_ids = self._tokenizer.apply_chat_template(
-                    messages,
-                    add_generation_prompt=True,
-                    return_tensors="pt",
-                ).to(self._client.device)
-
-                outputs = self._client.generate(
-                    input_ids,
-                    pad_token_id=self._tokenizer.eos_token_id,
-                    **llm_config,
-                )
-
-                response = outputs[0][input_ids.shape[-1]:]
+                if self._batcher is not None:
+                    # Requests are grouped by generation config to keep every batch homogeneous.
+                    config_key = json.dumps(llm_config, sort_keys=True)
+                    response = self._batcher.submit(config_key, messages)
+                else:
+                    response = self._generate_single(messages, llm_config)
 
                 break
 
@@ -92,3 +373,9 @@ class HFMetaLlamaClient(BaseLLMClient):
             content = ""
 
         return content
+
+    def close(self):
+        super().close()
+        if self._batcher is not None:
+            self._batcher.close()
+        self.debug(f"{self.NAME} performance: {self.performance_stats}")
@@ -0,0 +1,51 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+
+class JsonRequestHandler(BaseHTTPRequestHandler):
+    """The base request handler of the local stand-in servers answering json bodies.
+
+    The connections are kept alive so that the pooled sessions of the clients can be benchmarked, thus every response
+    is sent with a `Content-Length` and the request body should be fully read by `_read_body()` before responding. The
+    request logs are muted.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _send_bytes(
+        self, data: bytes, content_type: str, status: int = 200, headers: Dict[str, str] = None,
+    ) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        return
+
+    def _send_json(self, obj: dict, status: int = 200, headers: Dict[str, str] = None) -> None:
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self._send_bytes(data, "application/json", status, headers)
+        return
+
+    def log_message(self, format: str, *args) -> None:
+        return
+
+
+def create_json_server(
+    handler_class: type, host: str, port: int, **handler_attrs,
+) -> ThreadingHTTPServer:
+    """Create a threading server of a subclass of `handler_class` with the given class attributes, e.g. the shared
+    states the handlers serve from. Use port 0 to pick a free one, see `server.server_address`.
+    """
+    handler_class = type(handler_class.__name__.lstrip("_"), (handler_class,), handler_attrs)
+    server = ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    return server
@@ -0,0 +1,174 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import asyncio
+import gzip
+from typing import Any, List, Optional, Tuple
+
+import httpx
+
+from pikerag.llm_client.base import LLMRequestFailedError
+from pikerag.llm_client.rate_limiter import estimate_num_tokens, parse_retry_after
+
+
+class HttpSessionMixin:
+    """Pooled HTTP sessions for the LLM clients posting json bodies to a REST endpoint.
+
+    The sync requests share one `httpx.Client` and the asyncio requests one `aiohttp.ClientSession` per event loop,
+    both keeping at most `pool_size` keep-alive connections to the endpoint host, so that the TCP and TLS handshakes
+    are paid once per connection instead of once per request. Responses are requested gzip-compressed, and the
+    request bodies can be gzip-compressed too if the endpoint supports.
+
+    The client using this mixin should provide `_endpoint`, `_wrap_header()` and `_wrap_body()`, and be a
+    `BaseLLMClient` for the retrying and rate limiting utilities.
+    """
+    def _init_http_session(
+        self, pool_size: int = None, connect_timeout: float = 10, read_timeout: float = 600,
+        gzip_request: bool = False, **kwargs,
+    ) -> None:
+        """
+        Args:
+            pool_size (int): the maximum number of connections to the endpoint host. Set it no less than the number of
+                worker threads. Defaults to None, i.e. the `max_concurrency` of the client.
+            connect_timeout (float): the timeout in seconds to establish a connection. Defaults to 10.
+            read_timeout (float): the timeout in seconds to wait for the response data. Defaults to 600.
+            gzip_request (bool): gzip-compress the request bodies or not. Defaults to False.
+        """
+        self._http_pool_size: int = pool_size if pool_size is not None else self._max_concurrency
+        self._http_connect_timeout: float = connect_timeout
+        self._http_read_timeout: float = read_timeout
+        self._http_gzip_request: bool = gzip_request
+
+        self._http_session = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=self._http_pool_size,
+                max_keepalive_connections=self._http_pool_size,
+            ),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            headers={"Accept-Encoding": "gzip"},
+        )
+
+        # The aiohttp session is bound to the event loop it is created in, thus created lazily.
+        self._async_http_session: Any = None
+        self._async_http_session_loop: asyncio.AbstractEventLoop = None
+
+    def _prepare_request(self, messages: List[dict], llm_config: dict) -> Tuple[dict, bytes]:
+        header = self._wrap_header(**llm_config)
+        body = self._wrap_body(messages, **llm_config)
+        if self._http_gzip_request:
+            body = gzip.compress(body)
+            header["Content-Encoding"] = "gzip"
+        return header, body
+
+    def _post_with_retry(self, messages: List[dict], llm_config: dict) -> Optional[bytes]:
+        response: bytes = None
+        num_attempt: int = 0
+        while num_attempt < self._max_attempt:
+            header, body = self._prepare_request(messages, llm_config)
+            try:
+                with self._rate_limiter.limit(estimate_num_tokens(messages, llm_config)) as ticket:
+                    resp = self._http_session.post(self._endpoint, content=body, headers=header)
+                    if resp.status_code == 429:
+                        ticket.throttled = True
+                        self._rate_limiter.on_throttle(parse_retry_after(resp.headers.get("Retry-After", None)))
+
+            except httpx.TransportError as e:
+                self._record_retry(llm_config, type(e).__name__)
+                if self._fail_fast:
+                    raise LLMRequestFailedError(type(e).__name__) from e
+                self.warning(f"  Failed due to Exception: {e!r}")
+                num_attempt += 1
+                self._wait(num_attempt)
+                self.warning(f"  Retrying...")
+                continue
+
+            if resp.status_code < 400:
+                response = resp.content
+                break
+
+            self._record_retry(llm_config, f"HTTP{resp.status_code}")
+            if self._fail_fast:
+                raise LLMRequestFailedError(
+                    f"HTTP{resp.status_code}", parse_retry_after(resp.headers.get("Retry-After", None)),
+                )
+            self.warning(f"  Failed due to Exception: {str(resp.status_code)}")
+            print(resp.headers)
+            print(resp.text)
+            num_attempt += 1
+            # The shared rate limiter already makes all workers back off if throttled.
+            if not ticket.throttled:
+                self._wait(num_attempt)
+            self.warning(f"  Retrying...")
+
+        return response
+
+    def _get_async_http_session(self) -> Any:
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        if (
+            self._async_http_session is None
+            or self._async_http_session.closed
+            or self._async_http_session_loop is not loop
+        ):
+            self._async_http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self._http_pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=self._http_connect_timeout, sock_read=self._http_read_timeout),
+                headers={"Accept-Encoding": "gzip"},
+            )
+            self._async_http_session_loop = loop
+        return self._async_http_session
+
+    async def _apost_with_retry(self, messages: List[dict], llm_config: dict) -> Optional[bytes]:
+        import aiohttp
+
+        session = self._get_async_http_session()
+
+        response: bytes = None
+        num_attempt: int = 0
+        while num_attempt < self._max_attempt:
+            header, body = self._prepare_request(messages, llm_config)
+            try:
+                async with self._rate_limiter.alimit(estimate_num_tokens(messages, llm_config)) as ticket:
+                    async with session.post(self._endpoint, data=body, headers=header) as resp:
+                        if resp.status < 400:
+                            response = await resp.read()
+                            break
+
+                        if resp.status == 429:
+                            ticket.throttled = True
+                            self._rate_limiter.on_throttle(parse_retry_after(resp.headers.get("Retry-After", None)))
+                        self._record_retry(llm_config, f"HTTP{resp.status}")
+                        if self._fail_fast:
+                            raise LLMRequestFailedError(
+                                f"HTTP{resp.status}", parse_retry_after(resp.headers.get("Retry-After", None)),
+                            )
+                        self.warning(f"  Failed due to Exception: {str(resp.status)}")
+                        print(resp.headers)
+                        print(await resp.text(errors="ignore"))
+
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self._record_retry(llm_config, type(e).__name__)
+                if self._fail_fast:
+                    raise LLMRequestFailedError(type(e).__name__) from e
+                self.warning(f"  Failed due to Exception: {e!r}")
+                num_attempt += 1
+                await self._async_wait(num_attempt)
+                self.warning(f"  Retrying...")
+                continue
+
+            num_attempt += 1
+            # The shared rate limiter already makes all workers back off if throttled.
+            if not ticket.throttled:
+                await self._async_wait(num_attempt)
+            self.warning(f"  Retrying...")
+
+        return response
+
+    def _close_http_session(self) -> None:
+        self._http_session.close()
+
+    async def _aclose_http_session(self) -> None:
+        if self._async_http_session is not None and not self._async_http_session.closed:
+            await self._async_http_session.close()
+        self._async_http_session = None
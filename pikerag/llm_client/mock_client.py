@@ -0,0 +1,111 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import json
+import os
+import threading
+from typing import List, Optional, Tuple
+
+from pikerag.llm_client.base import BaseLLMClient
+from pikerag.llm_client.http_session import HttpSessionMixin
+from pikerag.llm_client.mock_server import create_mock_llm_server
+from pikerag.utils.logger import Logger
+
+
+class MockLLMClient(BaseLLMClient, HttpSessionMixin):
+    """The client of the mock LLM server (see `pikerag.llm_client.mock_server`), for benchmarking the workflows end to
+    end without any quota. The requests go through the same pooled HTTP sessions, rate limiter and retrying as the
+    real clients.
+
+    The server is located by `base_url` in the client args, or the environment variable named by `base_url_name`
+    (defaults to "MOCK_LLM_URL"). If neither is given, a server is started in-process with the `server_config` args of
+    `create_mock_llm_server()`, e.g.:
+
+        llm_client:
+          module_path: pikerag.llm_client
+          class_name: MockLLMClient
+          args:
+            server_config:
+              replay_locations: [logs/hotpotqa/qa_chunk/qa_chunk.sqlite]
+              latency_config: {distribution: lognormal, median: 1.0, sigma: 0.5}
+              throttle_rate: 0.02
+    """
+    NAME = "MockLLMClient"
+
+    def __init__(
+        self, location: str = None, auto_dump: bool = True, logger: Logger=None,
+        max_attempt: int = 5, exponential_backoff_factor: int = None, unit_wait_time: int = 60,
+        cache_backend: str = "sqlite", max_concurrency: int = 64, rate_limit_config: dict = None,
+        memory_cache_config: dict = None, stream_early_stop: bool = False, **kwargs,
+    ) -> None:
+        super().__init__(
+            location, auto_dump, logger, max_attempt, exponential_backoff_factor, unit_wait_time, cache_backend,
+            max_concurrency, rate_limit_config, memory_cache_config, stream_early_stop, **kwargs,
+        )
+
+        self._init_agent(**kwargs)
+
+        self._init_http_session(**kwargs.get("http_config", {}))
+
+    def _init_agent(self, **kwargs) -> None:
+        self._server = None
+
+        base_url_name = kwargs.get("base_url_name", None)
+        if base_url_name is None:
+            base_url_name = "MOCK_LLM_URL"
+        base_url: Optional[str] = kwargs.get("base_url", None) or os.getenv(base_url_name)
+
+        if base_url is None:
+            self._server = create_mock_llm_server(port=0, **kwargs.get("server_config", {}))
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            base_url = f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+            self.warning(f"Mock LLM server started in-process on {base_url}")
+
+        self._endpoint = base_url.rstrip("/") + "/chat/completions"
+
+    @property
+    def server_stats(self) -> dict:
+        """The stats of the in-process mock server, empty if talking to an external one."""
+        return self._server.responder.stats if self._server is not None else {}
+
+    def _wrap_header(self, **llm_config) -> dict:
+        return {"Content-Type": "application/json"}
+
+    def _wrap_body(self, messages: List[dict], **llm_config) -> bytes:
+        return json.dumps({"messages": messages, **llm_config}).encode("utf-8")
+
+    def _get_response_with_messages(self, messages: List[dict], **llm_config) -> bytes:
+        return self._post_with_retry(messages, llm_config)
+
+    async def _aget_response_with_messages(self, messages: List[dict], **llm_config) -> bytes:
+        return await self._apost_with_retry(messages, llm_config)
+
+    def _get_token_usage(self, response: bytes) -> Tuple[Optional[int], Optional[int]]:
+        try:
+            usage = json.loads(response.decode("utf-8"))["usage"]
+            return usage["prompt_tokens"], usage["completion_tokens"]
+        except Exception:
+            return None, None
+
+    def _get_content_from_response(self, response: bytes, messages: List[dict] = None) -> str:
+        try:
+            content = json.loads(response.decode("utf-8"))["choices"][0]["message"]["content"]
+        except Exception:
+            self.warning(f"Non-Content returned")
+            self.debug(f"  -- Complete response: {response}")
+            content = ""
+
+        return content
+
+    def close(self):
+        super().close()
+        self._close_http_session()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server.responder.close()
+            self._server = None
+
+    async def aclose(self):
+        await super().aclose()
+        await self._aclose_http_session()
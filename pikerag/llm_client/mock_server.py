@@ -0,0 +1,359 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""A deterministic stand-in LLM service for benchmarking the workflows offline, without any quota:
+
+    python -m pikerag.llm_client.mock_server --port 8766 [--replay CACHE ...] [--latency-median SECONDS] ...
+
+It serves the OpenAI-compatible `POST /v1/chat/completions` (any path ending with `chat/completions` is accepted, e.g.
+the Azure style deployment paths) and `GET /v1/stats`. Each request is answered with:
+- the response replayed from the given LLM cache files, looked up by the same cache key the clients use;
+- otherwise, a synthesized response following the output format asked in the prompt, i.e. the json object or the
+    `<result>` xml skeleton, or some plain text lines, so that the protocol parsers accept it.
+
+The latency, the server errors (HTTP 500) and the throttling (HTTP 429 with `Retry-After`) are injected by a random
+generator seeded by the request itself, so the same run is reproducible no matter how the requests interleave. Use
+`MockLLMClient` to talk to it, or to start one in-process.
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from pikerag.llm_client.cache import BaseLLMCache, generate_cache_key
+from pikerag.llm_client.http_server import JsonRequestHandler, create_json_server
+
+
+# The request fields not part of the LLM config when generating the cache key.
+_NON_CONFIG_FIELDS: Tuple[str, ...] = ("messages", "stream", "stream_options")
+
+_JSON_BLOCK_PATTERN = re.compile(r"\{\s*\n(?:[^{}]*?)\n\s*\}")
+_JSON_FIELD_PATTERN = re.compile(r'"(\w+)"\s*:\s*(<[^>]*>|null|true|false|-?\d+)')
+_XML_RESULT_PATTERN = re.compile(r"<result>.*?</result>", re.DOTALL)
+_XML_LEAF_PATTERN = re.compile(r"^(\s*)<(\w+)>([^<]*)</\2>\s*$")
+_XML_TAG_PATTERN = re.compile(r"^\s*</?\w+>\s*$")
+_INDEX_RANGE_PATTERN = re.compile(r"from (\d+) to (\d+)")
+_LINE_NUMBER_PATTERN = re.compile(r"^Line (\d+) \t", re.MULTILINE)
+_OPTION_PATTERN = re.compile(r"^([A-Z]): (.*)$", re.MULTILINE)
+
+
+def _get_request_key(body: dict) -> str:
+    llm_config = {key: value for key, value in body.items() if key not in _NON_CONFIG_FIELDS}
+    return generate_cache_key(body.get("messages", []), llm_config)
+
+
+def _synthesize_json_value(name: str, hint: str, prompt: str, rng: random.Random) -> Any:
+    if hint in ("null", "true", "false") or re.fullmatch(r"-?\d+", hint):
+        return json.loads(hint)
+
+    hint = hint.lower()
+    if "list" in hint:
+        return [f"Mock {name} {i + 1} {rng.getrandbits(24):06x}?" for i in range(rng.randint(1, 3))]
+    if "integer" in hint or "index" in hint:
+        match = _INDEX_RANGE_PATTERN.search(hint)
+        if match is None:
+            # The range may be filled in the prompt, e.g. "from 1 to {num_atoms}".
+            match = _INDEX_RANGE_PATTERN.search(prompt)
+        return rng.randint(int(match.group(1)), int(match.group(2))) if match is not None else 1
+    if "true or false" in hint or "bool" in hint:
+        return rng.random() < 0.5
+    return f"Mock {name} {rng.getrandbits(24):06x}."
+
+
+def _synthesize_json(prompt: str, rng: random.Random) -> Optional[str]:
+    candidates: List[List[Tuple[str, str]]] = []
+    for block in _JSON_BLOCK_PATTERN.findall(prompt):
+        fields = _JSON_FIELD_PATTERN.findall(block)
+        if len(fields) > 0:
+            candidates.append(fields)
+    if len(candidates) == 0:
+        return None
+
+    # Alternatives given with "or" are picked randomly, e.g. continue reasoning or give the final answer.
+    fields = rng.choice(candidates)
+    output = {name: _synthesize_json_value(name, hint, prompt, rng) for name, hint in fields}
+    return json.dumps(output, ensure_ascii=False, indent=4)
+
+
+def _synthesize_xml(prompt: str, rng: random.Random) -> Optional[str]:
+    match = _XML_RESULT_PATTERN.search(prompt)
+    if match is None:
+        return None
+
+    line_numbers = [int(number) for number in _LINE_NUMBER_PATTERN.findall(prompt)]
+    options = _OPTION_PATTERN.findall(prompt)
+    chosen_option = rng.choice(options) if len(options) > 0 else ("A", "")
+
+    lines: List[str] = []
+    for line in match.group(0).split("\n"):
+        leaf = _XML_LEAF_PATTERN.match(line)
+        if leaf is not None:
+            indent, tag, _ = leaf.groups()
+            if tag == "endline":
+                value = str(rng.randint(0, max(line_numbers))) if len(line_numbers) > 0 else "0"
+            elif tag == "mask":
+                value = chosen_option[0]
+            elif tag == "option":
+                value = chosen_option[1]
+            else:
+                value = f"Mock {tag} {rng.getrandbits(24):06x}."
+            lines.append(f"{indent}<{tag}>{value}</{tag}>")
+        elif _XML_TAG_PATTERN.match(line) is not None:
+            lines.append(line)
+        # The instruction lines inside the skeleton are dropped.
+    return "Thinking: Mock thinking.\n\n" + "\n".join(lines)
+
+
+def synthesize_content(messages: List[dict], rng: random.Random) -> str:
+    """Synthesize a response following the output format asked in the last message: the json object if a json skeleton
+    given, or the `<result>` xml skeleton if given, otherwise some plain text lines (e.g. the questions line by line).
+    """
+    prompt: str = str(messages[-1].get("content", "")) if len(messages) > 0 else ""
+    for synthesize in (_synthesize_json, _synthesize_xml):
+        content = synthesize(prompt, rng)
+        if content is not None:
+            return content
+    return "\n".join(f"Mock response line {i + 1} {rng.getrandbits(24):06x}?" for i in range(rng.randint(1, 3)))
+
+
+class MockResponder(object):
+    """Decide the response, the latency and the injected fault of each chat completion request.
+
+    Args:
+        replay_locations (List[str]): the LLM cache files to replay the responses from. Defaults to None.
+        synthesize (bool): synthesize the responses not found in the replay caches, or answer them with HTTP 404.
+            Defaults to True.
+        latency_config (dict): the latency of each response in seconds, with fields:
+            - distribution (str): "constant", "uniform" or "lognormal". Defaults to "lognormal".
+            - median (float): the constant latency, or the median of the lognormal one. Defaults to 0.
+            - sigma (float): the sigma of the lognormal distribution. Defaults to 0.5.
+            - min (float), max (float): the bounds of the latency, also the range of the uniform distribution.
+                Defaults to 0 and 60.
+            - seconds_per_token (float): the additional latency per completion token. Defaults to 0.
+            No latency if None. Defaults to None.
+        error_rate (float): the probability to answer with HTTP 500. Defaults to 0.
+        throttle_rate (float): the probability to answer with HTTP 429. Defaults to 0.
+        retry_after (float): the `Retry-After` seconds of the HTTP 429 responses. Defaults to 1.
+        seed (int): the seed of the random generators. Defaults to 0.
+    """
+    def __init__(
+        self, replay_locations: List[str] = None, synthesize: bool = True, latency_config: dict = None,
+        error_rate: float = 0, throttle_rate: float = 0, retry_after: float = 1, seed: int = 0,
+    ) -> None:
+        from pikerag.llm_client.cache.maintenance import open_cache
+
+        self._replay_caches: List[BaseLLMCache] = [open_cache(location) for location in replay_locations or []]
+        self._synthesize: bool = synthesize
+        self._latency_config: dict = latency_config or {}
+        self._error_rate: float = error_rate
+        self._throttle_rate: float = throttle_rate
+        self._retry_after: float = retry_after
+        self._seed: int = seed
+
+        self._lock = threading.Lock()
+        self._num_seen: Dict[str, int] = {}
+        self._stats: Dict[str, float] = {
+            "num_requests": 0,
+            "num_replayed": 0,
+            "num_synthesized": 0,
+            "num_not_found": 0,
+            "num_errors": 0,
+            "num_throttled": 0,
+            "total_latency": 0,
+        }
+
+    def _get_rng(self, *parts: Any) -> random.Random:
+        seed = hashlib.sha256(":".join(str(part) for part in (self._seed, *parts)).encode("utf-8")).hexdigest()
+        return random.Random(int(seed[:16], 16))
+
+    def _sample_latency(self, rng: random.Random, num_tokens: int) -> float:
+        if len(self._latency_config) == 0:
+            return 0
+
+        distribution: str = self._latency_config.get("distribution", "lognormal")
+        median: float = self._latency_config.get("median", 0)
+        low: float = self._latency_config.get("min", 0)
+        high: float = self._latency_config.get("max", 60)
+        if distribution == "constant":
+            latency = median
+        elif distribution == "uniform":
+            latency = rng.uniform(low, high)
+        elif distribution == "lognormal":
+            latency = median * math.exp(rng.gauss(0, self._latency_config.get("sigma", 0.5))) if median > 0 else 0
+        else:
+            raise ValueError(f"Unrecognized latency distribution: {distribution}")
+        latency += self._latency_config.get("seconds_per_token", 0) * num_tokens
+        return min(max(latency, low), high)
+
+    def _lookup(self, key: str) -> Optional[str]:
+        for cache in self._replay_caches:
+            value = cache.get(key)
+            if value is not False and value is not None:
+                return value
+        return None
+
+    def respond(self, body: dict) -> Tuple[int, Dict[str, str], dict, float]:
+        """Returns:
+            Tuple[int, Dict[str, str], dict, float]: the HTTP status code, the extra headers, the json payload and the
+                seconds to wait before responding.
+        """
+        key = _get_request_key(body)
+        with self._lock:
+            num_seen = self._num_seen.get(key, 0)
+            self._num_seen[key] = num_seen + 1
+            self._stats["num_requests"] += 1
+
+        # The faults and the latency vary among the retries of the same request, the content does not.
+        rng = self._get_rng(key, num_seen)
+        dice = rng.random()
+        if dice < self._throttle_rate:
+            status, headers, counter = 429, {"Retry-After": str(self._retry_after)}, "num_throttled"
+            payload = {"error": {"code": "429", "message": "Mock rate limit exceeded."}}
+            content = None
+        elif dice < self._throttle_rate + self._error_rate:
+            status, headers, counter = 500, {}, "num_errors"
+            payload = {"error": {"code": "500", "message": "Mock server error."}}
+            content = None
+        else:
+            content = self._lookup(key)
+            counter = "num_replayed"
+            if content is None and self._synthesize:
+                content = synthesize_content(body.get("messages", []), self._get_rng(key))
+                counter = "num_synthesized"
+            if content is None:
+                status, headers, counter = 404, {}, "num_not_found"
+                payload = {"error": {"code": "404", "message": "Request not found in the replay caches."}}
+            else:
+                status, headers = 200, {}
+                payload = self._wrap_completion(body, content)
+
+        num_tokens = len(content) // 4 if content is not None else 0
+        latency = self._sample_latency(rng, num_tokens)
+        with self._lock:
+            self._stats[counter] += 1
+            self._stats["total_latency"] += latency
+        return status, headers, payload, latency
+
+    def _wrap_completion(self, body: dict, content: str) -> dict:
+        num_prompt_chars = sum(len(str(message.get("content", ""))) for message in body.get("messages", []))
+        prompt_tokens, completion_tokens = num_prompt_chars // 4, len(content) // 4
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._stats)
+
+    def close(self) -> None:
+        for cache in self._replay_caches:
+            cache.close()
+        self._replay_caches = []
+
+
+class _MockRequestHandler(JsonRequestHandler):
+    responder: MockResponder = None
+
+    def do_POST(self) -> None:
+        data = self._read_body()
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if not path.endswith("chat/completions"):
+            return self._send_json({"error": {"message": f"{self.path} not found"}}, 404)
+
+        if self.headers.get("Content-Encoding", None) == "gzip":
+            import gzip
+            data = gzip.decompress(data)
+
+        status, headers, payload, latency = self.responder.respond(json.loads(data))
+        time.sleep(latency)
+        self._send_json(payload, status, headers)
+        return
+
+    def do_GET(self) -> None:
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path.endswith("/stats"):
+            return self._send_json(self.responder.stats)
+        self._send_json({"error": {"message": f"{self.path} not found"}}, 404)
+        return
+
+
+def create_mock_llm_server(
+    host: str = "127.0.0.1", port: int = 8766, replay_locations: List[str] = None, synthesize: bool = True,
+    latency_config: dict = None, error_rate: float = 0, throttle_rate: float = 0, retry_after: float = 1,
+    seed: int = 0,
+) -> ThreadingHTTPServer:
+    """Create the mock LLM server, see `MockResponder` for the arguments. Call `serve_forever()` on it (e.g. in a daemon
+    thread) to start serving and `shutdown()` to stop. Use port 0 to pick a free one, see `server.server_address`, and
+    `server.responder` for the stats.
+    """
+    responder = MockResponder(
+        replay_locations, synthesize, latency_config, error_rate, throttle_rate, retry_after, seed,
+    )
+    server = create_json_server(_MockRequestHandler, host, port, responder=responder)
+    server.responder = responder
+    return server
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="A deterministic stand-in LLM service for offline benchmarking.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="the host to bind")
+    parser.add_argument("--port", type=int, default=8766, help="the port to listen on")
+    parser.add_argument("--replay", type=str, nargs="*", default=[], help="the LLM cache files to replay from")
+    parser.add_argument("--no-synthesize", action="store_true", help="answer 404 if not found in the replay caches")
+    parser.add_argument(
+        "--latency-distribution", type=str, default="lognormal", choices=["constant", "uniform", "lognormal"],
+    )
+    parser.add_argument("--latency-median", type=float, default=0, help="the median latency in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="the sigma of the lognormal latency")
+    parser.add_argument("--latency-min", type=float, default=0, help="the minimum latency in seconds")
+    parser.add_argument("--latency-max", type=float, default=60, help="the maximum latency in seconds")
+    parser.add_argument("--seconds-per-token", type=float, default=0, help="the latency per completion token")
+    parser.add_argument("--error-rate", type=float, default=0, help="the probability of HTTP 500")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="the probability of HTTP 429")
+    parser.add_argument("--retry-after", type=float, default=1, help="the Retry-After seconds of HTTP 429")
+    parser.add_argument("--seed", type=int, default=0, help="the random seed")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    server = create_mock_llm_server(
+        args.host, args.port, args.replay, not args.no_synthesize,
+        {
+            "distribution": args.latency_distribution,
+            "median": args.latency_median,
+            "sigma": args.latency_sigma,
+            "min": args.latency_min,
+            "max": args.latency_max,
+            "seconds_per_token": args.seconds_per_token,
+        },
+        args.error_rate, args.throttle_rate, args.retry_after, args.seed,
+    )
+    print(f"[Mock LLM Server] Serving on http://{args.host}:{server.server_address[1]}/v1 ...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f"[Mock LLM Server] Stats: {server.responder.stats}")
@@ -0,0 +1,482 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import asyncio
+import importlib
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from pikerag.llm_client.base import BaseLLMClient, LLMRequestFailedError
+from pikerag.llm_client.rate_limiter import estimate_num_tokens
+from pikerag.utils.completion_detector import BaseCompletionDetector
+from pikerag.utils.logger import Logger
+
+
+class _Backend(object):
+    """A backend client of the pool, with the recent latencies and the cool-down state used for routing."""
+    def __init__(
+        self, name: str, client: BaseLLMClient, llm_config: dict, window_size: int, latency_decay: float,
+    ) -> None:
+        self.name: str = name
+        self.client: BaseLLMClient = client
+        self.llm_config: dict = llm_config
+
+        self._lock = threading.Lock()
+        self._latency_decay: float = latency_decay
+        self.latency_ewma: Optional[float] = None
+        self.recent_latencies: Deque[float] = deque(maxlen=window_size)
+        self.num_in_flight: int = 0
+        self.cool_down_until: float = 0
+        self._num_consecutive_failures: int = 0
+
+        self.num_requests: int = 0
+        self.num_failures: int = 0
+        self.num_hedged: int = 0
+
+    def on_start(self) -> None:
+        with self._lock:
+            self.num_in_flight += 1
+            self.num_requests += 1
+
+    def on_success(self, latency: float) -> None:
+        with self._lock:
+            self.num_in_flight -= 1
+            self._num_consecutive_failures = 0
+            self.recent_latencies.append(latency)
+            if self.latency_ewma is None:
+                self.latency_ewma = latency
+            else:
+                self.latency_ewma += self._latency_decay * (latency - self.latency_ewma)
+
+    def on_failure(self, retry_after: Optional[float], backoff_base: float, max_backoff: float) -> float:
+        """Cool the backend down for the retry-after time, or an exponential back-off if no hint given. Return the
+        seconds of the cool-down.
+        """
+        with self._lock:
+            self.num_in_flight -= 1
+            self.num_failures += 1
+            self._num_consecutive_failures += 1
+            if retry_after is None:
+                retry_after = backoff_base * 2 ** (self._num_consecutive_failures - 1)
+            retry_after = min(retry_after, max_backoff)
+            self.cool_down_until = max(self.cool_down_until, time.monotonic() + retry_after)
+            return retry_after
+
+    def on_hedge(self) -> None:
+        with self._lock:
+            self.num_hedged += 1
+
+    def on_abandon(self) -> None:
+        """The request lost the hedging race and its result is dropped."""
+        with self._lock:
+            self.num_in_flight -= 1
+
+    def percentile_latency(self, q: float) -> Optional[float]:
+        with self._lock:
+            if len(self.recent_latencies) == 0:
+                return None
+            latencies = sorted(self.recent_latencies)
+        return latencies[min(len(latencies) - 1, int(q / 100 * len(latencies)))]
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "num_requests": self.num_requests,
+                "num_failures": self.num_failures,
+                "num_hedged": self.num_hedged,
+                "num_in_flight": self.num_in_flight,
+                "latency_ewma": self.latency_ewma,
+                "cooling_down": max(0, self.cool_down_until - time.monotonic()),
+            }
+
+
+class _HedgeRace(object):
+    """The requests racing for one hedged call, the first one succeeded wins and the others' results are dropped."""
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.winner: Optional[_Backend] = None
+
+    def finish(self, backend: _Backend) -> bool:
+        """Return True if the request to the `backend` is the first one succeeded."""
+        with self._lock:
+            if self.winner is None:
+                self.winner = backend
+            return self.winner is backend
+
+
+class PooledResponse(object):
+    """The response of a backend, with the backend kept to extract the content from it."""
+    def __init__(self, backend: _Backend, response: Any) -> None:
+        self.backend: _Backend = backend
+        self.response: Any = response
+
+
+class PooledLLMClient(BaseLLMClient):
+    NAME = "PooledLLMClient"
+
+    def __init__(
+        self, location: str = None, auto_dump: bool = True, logger: Logger = None,
+        max_attempt: int = 5, exponential_backoff_factor: int = None, unit_wait_time: int = 60,
+        cache_backend: str = "sqlite", max_concurrency: int = 64, rate_limit_config: dict = None,
+        memory_cache_config: dict = None, stream_early_stop: bool = False, backends: List[dict] = None,
+        hedge_config: dict = None, latency_window_size: int = 200, latency_decay: float = 0.2,
+        failover_backoff_base: float = 1, failover_max_backoff: float = 60, **kwargs,
+    ) -> None:
+        """LLM Communication Client routing the requests among several backend clients, e.g. the Azure OpenAI
+        deployments in different regions. The cache lives in the pool, the backends are created without one.
+
+        Each request goes to the available backend with the lowest score, i.e. the recent latency (EWMA) scaled up by
+        the in-flight requests and down by the quota remaining in its rate limiter. The backends run in fail-fast mode:
+        a throttled (429), server-error (5xx) or connection-failed request makes its backend cool down for the
+        retry-after time, and the request is re-sent to the next backend right away instead of sleeping. The pool only
+        waits if all the backends are cooling down.
+
+        Args:
+            backends (List[dict]): the configs of the backends, each with `module_path`, `class_name` and `args` to
+                initialize the client, an optional `name` (defaults to `{class_name}_{index}`) and an optional
+                `llm_config` overriding the one of the requests, e.g. the deployment name as `model`. The
+                `rate_limit_config` of a backend is named after the backend if no `name` given, so that the quotas
+                of the backends are tracked separately.
+            hedge_config (dict): set to hedge the slow requests, i.e. re-send a request to a second backend if no
+                response after the p-th percentile latency of the first one, and take the first successful response.
+                Available keys: `percentile` (defaults to 95), `min_delay` and `max_delay` in seconds (defaults to 1
+                and 60) to clamp the delay, `min_samples` of latencies before hedging starts (defaults to 20).
+                Streaming requests are not hedged. Defaults to None, i.e. disabled.
+            latency_window_size (int): the number of recent latencies kept per backend for the hedging delay.
+                Defaults to 200.
+            latency_decay (float): the weight of the latest latency in the EWMA used for routing. Defaults to 0.2.
+            failover_backoff_base (float): the cool-down seconds of a backend failed without retry-after hint, doubled
+                for each consecutive failure. Defaults to 1.
+            failover_max_backoff (float): the upper bound of the cool-down seconds. Defaults to 60.
+
+            The other arguments are the same as `AzureOpenAIClient`. `max_attempt` here is the number of backends a
+            request would be tried on, and the `rate_limit_config` of the pool itself is usually left empty.
+
+        An example of the `llm_client` block in the yaml config:
+
+            llm_client:
+              module_path: pikerag.llm_client
+              class_name: PooledLLMClient
+              args:
+                backends:
+                  - name: eastus
+                    module_path: pikerag.llm_client
+                    class_name: AzureOpenAIClient
+                    args:
+                      client_config: {azure_endpoint: https://xxx-eastus.openai.azure.com/, api_version: 2024-08-01-preview}
+                      rate_limit_config: {tokens_per_minute: 300000}
+                  - name: westus
+                    module_path: pikerag.llm_client
+                    class_name: AzureOpenAIClient
+                    args:
+                      client_config: {azure_endpoint: https://xxx-westus.openai.azure.com/, api_version: 2024-08-01-preview}
+                    llm_config: {model: gpt-4-westus}
+                hedge_config: {percentile: 95}
+        """
+        super().__init__(
+            location, auto_dump, logger, max_attempt, exponential_backoff_factor, unit_wait_time, cache_backend,
+            max_concurrency, rate_limit_config, memory_cache_config, stream_early_stop, **kwargs,
+        )
+
+        assert backends is not None and len(backends) > 0, "At least one backend should be given to PooledLLMClient!"
+        self._backends: List[_Backend] = [
+            self._init_backend(idx, backend_config, latency_window_size, latency_decay, **kwargs)
+            for idx, backend_config in enumerate(backends)
+        ]
+        self._failover_backoff_base: float = failover_backoff_base
+        self._failover_max_backoff: float = failover_max_backoff
+
+        self._hedge_config: Optional[dict] = None
+        self._hedge_executor: Optional[ThreadPoolExecutor] = None
+        if hedge_config is not None and len(self._backends) > 1:
+            self._hedge_config = {
+                "percentile": 95, "min_delay": 1, "max_delay": 60, "min_samples": 20, **hedge_config,
+            }
+            # The sync hedging runs the racing requests in worker threads.
+            self._hedge_executor = ThreadPoolExecutor(max_workers=max_concurrency * 2)
+
+    def _init_backend(
+        self, idx: int, backend_config: dict, window_size: int, latency_decay: float, **kwargs,
+    ) -> _Backend:
+        client_module = importlib.import_module(backend_config["module_path"])
+        client_class = getattr(client_module, backend_config["class_name"])
+        assert issubclass(client_class, BaseLLMClient)
+        name: str = backend_config.get("name", f"{backend_config['class_name']}_{idx}")
+
+        args: dict = dict(backend_config.get("args", {}))
+        rate_limit_config: dict = dict(args.get("rate_limit_config", None) or {})
+        rate_limit_config.setdefault("name", name)
+        args["rate_limit_config"] = rate_limit_config
+        if "llm_config" in kwargs:
+            args.setdefault("llm_config", {**kwargs["llm_config"], **backend_config.get("llm_config", {})})
+
+        client: BaseLLMClient = client_class(location=None, logger=self.logger, **args)
+        client.set_fail_fast(True)
+        return _Backend(name, client, backend_config.get("llm_config", {}), window_size, latency_decay)
+
+    def _select_backend(self, num_tokens: int, exclude: Set[str]) -> Tuple[Optional[_Backend], float]:
+        """Return the available backend with the lowest score, or None with the seconds to wait if all are cooling
+        down or blocked by their rate limiters.
+        """
+        now = time.monotonic()
+        known_latencies = [backend.latency_ewma for backend in self._backends if backend.latency_ewma is not None]
+        # The backends without latency samples yet are assumed to be as fast as the fastest one, to be explored.
+        default_latency = min(known_latencies) if len(known_latencies) > 0 else 1.0
+
+        best_backend, best_score = None, None
+        min_wait_time: float = self._failover_max_backoff
+        for backend in self._backends:
+            if backend.name in exclude:
+                continue
+            limiter_wait_time, remaining_ratio = backend.client._rate_limiter.probe(num_tokens)
+            wait_time = max(backend.cool_down_until - now, limiter_wait_time)
+            if wait_time > 0:
+                min_wait_time = min(min_wait_time, wait_time)
+                continue
+
+            latency = backend.latency_ewma if backend.latency_ewma is not None else default_latency
+            score = latency * (1 + backend.num_in_flight) / max(remaining_ratio, 0.05)
+            if best_score is None or score < best_score:
+                best_backend, best_score = backend, score
+        return best_backend, min_wait_time
+
+    def _get_backend_llm_config(self, backend: _Backend, llm_config: dict) -> dict:
+        return {**llm_config, **backend.llm_config}
+
+    def _get_hedge_delay(self, backend: _Backend) -> Optional[float]:
+        if self._hedge_config is None or len(backend.recent_latencies) < self._hedge_config["min_samples"]:
+            return None
+        delay = backend.percentile_latency(self._hedge_config["percentile"])
+        return min(max(delay, self._hedge_config["min_delay"]), self._hedge_config["max_delay"])
+
+    def _on_backend_failure(self, backend: _Backend, error: LLMRequestFailedError) -> None:
+        cool_down = backend.on_failure(error.retry_after, self._failover_backoff_base, self._failover_max_backoff)
+        self.warning(f"  Backend {backend.name} failed due to {error.reason}, cooling down for {cool_down:.1f} s.")
+        return
+
+    def _call_backend(
+        self, backend: _Backend, request_fn: Callable[[_Backend], Any], race: Optional[_HedgeRace] = None,
+    ) -> Any:
+        backend.on_start()
+        start_time = time.time()
+        try:
+            response = request_fn(backend)
+        except LLMRequestFailedError as e:
+            self._on_backend_failure(backend, e)
+            raise
+        except BaseException:
+            backend.on_abandon()
+            raise
+        if race is not None and not race.finish(backend):
+            # The hedging loser did not serve the request, its latency is not sampled.
+            backend.on_abandon()
+            return response
+        backend.on_success(time.time() - start_time)
+        return response
+
+    def _route(self, messages: List[dict], llm_config: dict, request_fn: Callable[[_Backend], Any], hedge: bool) -> Any:
+        num_tokens = estimate_num_tokens(messages, llm_config)
+        tried: Set[str] = set()
+        num_attempt: int = 0
+        while num_attempt < self._max_attempt:
+            backend, wait_time = self._select_backend(num_tokens, exclude=tried)
+            if backend is None and len(tried) > 0:
+                # All the other backends were tried, give the cooled-down ones another chance.
+                tried = set()
+                backend, wait_time = self._select_backend(num_tokens, exclude=tried)
+            if backend is None:
+                self.warning(f"  All backends unavailable, waiting {wait_time:.1f} s...")
+                time.sleep(wait_time)
+                continue
+
+            num_attempt += 1
+            tried.add(backend.name)
+            hedge_delay = self._get_hedge_delay(backend) if hedge else None
+            try:
+                if hedge_delay is None:
+                    response = self._call_backend(backend, request_fn)
+                else:
+                    backend, response = self._hedged_call(backend, hedge_delay, num_tokens, request_fn)
+                return PooledResponse(backend, response) if response is not None else None
+            except LLMRequestFailedError:
+                self.warning(f"  Retrying on another backend...")
+
+        return None
+
+    def _hedged_call(
+        self, primary: _Backend, delay: float, num_tokens: int, request_fn: Callable[[_Backend], Any],
+    ) -> Tuple[_Backend, Any]:
+        race = _HedgeRace()
+        futures: Dict[Future, _Backend] = {
+            self._hedge_executor.submit(self._call_backend, primary, request_fn, race): primary,
+        }
+        done, _ = wait(futures.keys(), timeout=delay)
+        if len(done) == 0:
+            secondary, _ = self._select_backend(num_tokens, exclude={primary.name})
+            if secondary is not None:
+                primary.on_hedge()
+                futures[self._hedge_executor.submit(self._call_backend, secondary, request_fn, race)] = secondary
+
+        error: Optional[LLMRequestFailedError] = None
+        pending = set(futures.keys())
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except LLMRequestFailedError as e:
+                    error = e
+                    continue
+                if race.winner is not futures[future]:
+                    continue
+                # The running thread cannot be cancelled, the loser is marked abandoned once it returns.
+                return futures[future], response
+        raise error
+
+    def _get_response_with_messages(self, messages: List[dict], **llm_config) -> Optional[PooledResponse]:
+        def request_fn(backend: _Backend) -> Any:
+            return backend.client._get_response_with_messages(
+                messages, **self._get_backend_llm_config(backend, llm_config),
+            )
+
+        return self._route(messages, llm_config, request_fn, hedge=True)
+
+    def _get_streamed_response_with_messages(
+        self, messages: List[dict], completion_detector: BaseCompletionDetector, **llm_config,
+    ) -> Optional[PooledResponse]:
+        def request_fn(backend: _Backend) -> Any:
+            return backend.client._get_streamed_response_with_messages(
+                messages, completion_detector, **self._get_backend_llm_config(backend, llm_config),
+            )
+
+        # The detector is stateful, thus the streams are never raced against each other.
+        return self._route(messages, llm_config, request_fn, hedge=False)
+
+    async def _acall_backend(
+        self, backend: _Backend, request_fn: Callable[[_Backend], Awaitable[Any]], race: Optional[_HedgeRace] = None,
+    ) -> Any:
+        backend.on_start()
+        start_time = time.time()
+        try:
+            response = await request_fn(backend)
+        except LLMRequestFailedError as e:
+            self._on_backend_failure(backend, e)
+            raise
+        except BaseException:
+            # Including the cancellation of the hedging loser.
+            backend.on_abandon()
+            raise
+        if race is not None and not race.finish(backend):
+            backend.on_abandon()
+            return response
+        backend.on_success(time.time() - start_time)
+        return response
+
+    async def _aroute(
+        self, messages: List[dict], llm_config: dict, request_fn: Callable[[_Backend], Awaitable[Any]], hedge: bool,
+    ) -> Any:
+        num_tokens = estimate_num_tokens(messages, llm_config)
+        tried: Set[str] = set()
+        num_attempt: int = 0
+        while num_attempt < self._max_attempt:
+            backend, wait_time = self._select_backend(num_tokens, exclude=tried)
+            if backend is None and len(tried) > 0:
+                tried = set()
+                backend, wait_time = self._select_backend(num_tokens, exclude=tried)
+            if backend is None:
+                self.warning(f"  All backends unavailable, waiting {wait_time:.1f} s...")
+                await asyncio.sleep(wait_time)
+                continue
+
+            num_attempt += 1
+            tried.add(backend.name)
+            hedge_delay = self._get_hedge_delay(backend) if hedge else None
+            try:
+                if hedge_delay is None:
+                    response = await self._acall_backend(backend, request_fn)
+                else:
+                    backend, response = await self._ahedged_call(backend, hedge_delay, num_tokens, request_fn)
+                return PooledResponse(backend, response) if response is not None else None
+            except LLMRequestFailedError:
+                self.warning(f"  Retrying on another backend...")
+
+        return None
+
+    async def _ahedged_call(
+        self, primary: _Backend, delay: float, num_tokens: int, request_fn: Callable[[_Backend], Awaitable[Any]],
+    ) -> Tuple[_Backend, Any]:
+        race = _HedgeRace()
+        tasks: Dict[asyncio.Task, _Backend] = {
+            asyncio.ensure_future(self._acall_backend(primary, request_fn, race)): primary,
+        }
+        done, _ = await asyncio.wait(tasks.keys(), timeout=delay)
+        if len(done) == 0:
+            secondary, _ = self._select_backend(num_tokens, exclude={primary.name})
+            if secondary is not None:
+                primary.on_hedge()
+                tasks[asyncio.ensure_future(self._acall_backend(secondary, request_fn, race))] = secondary
+
+        error: Optional[LLMRequestFailedError] = None
+        pending = set(tasks.keys())
+        while len(pending) > 0:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    response = task.result()
+                except LLMRequestFailedError as e:
+                    error = e
+                    continue
+                if race.winner is not tasks[task]:
+                    continue
+                for loser in pending:
+                    loser.cancel()
+                return tasks[task], response
+        raise error
+
+    async def _aget_response_with_messages(self, messages: List[dict], **llm_config) -> Optional[PooledResponse]:
+        async def request_fn(backend: _Backend) -> Any:
+            return await backend.client._aget_response_with_messages(
+                messages, **self._get_backend_llm_config(backend, llm_config),
+            )
+
+        return await self._aroute(messages, llm_config, request_fn, hedge=True)
+
+    async def _aget_streamed_response_with_messages(
+        self, messages: List[dict], completion_detector: BaseCompletionDetector, **llm_config,
+    ) -> Optional[PooledResponse]:
+        async def request_fn(backend: _Backend) -> Any:
+            return await backend.client._aget_streamed_response_with_messages(
+                messages, completion_detector, **self._get_backend_llm_config(backend, llm_config),
+            )
+
+        return await self._aroute(messages, llm_config, request_fn, hedge=False)
+
+    def _get_token_usage(self, response: PooledResponse) -> Tuple[Optional[int], Optional[int]]:
+        return response.backend.client._get_token_usage(response.response)
+
+    def _get_content_from_response(self, response: PooledResponse, messages: List[dict] = None) -> str:
+        return response.backend.client._get_content_from_response(response.response, messages=messages)
+
+    @property
+    def backend_stats(self) -> Dict[str, Dict[str, float]]:
+        """The routing counters of the backends by name: requests sent, failures, hedged ones, in-flight ones, the
+        latency EWMA and the seconds left cooling down.
+        """
+        return {backend.name: backend.stats for backend in self._backends}
+
+    def close(self):
+        super().close()
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False)
+        for backend in self._backends:
+            backend.client.close()
+
+    async def aclose(self):
+        # The sync resources of the backends are released by `close()` called in `super().aclose()`.
+        await super().aclose()
+        for backend in self._backends:
+            await backend.client.aclose()
@@ -0,0 +1,356 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Dict, List, Optional, Tuple, Type
+
+
+class _TokenBucket(object):
+    def __init__(self, capacity_per_minute: float) -> None:
+        self.capacity: float = capacity_per_minute
+        self.rate: float = capacity_per_minute / 60
+        self.tokens: float = capacity_per_minute
+        self.last_refill: float = time.monotonic()
+
+    def resize(self, capacity_per_minute: float) -> None:
+        """Change the quota per minute, keeping the tokens already spent as spent."""
+        self.tokens = min(capacity_per_minute, self.tokens - self.capacity + capacity_per_minute)
+        self.capacity = capacity_per_minute
+        self.rate = capacity_per_minute / 60
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def wait_time(self, amount: float) -> float:
+        # A single request larger than the capacity can only wait for a full bucket.
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+
+class RateLimitTicket(object):
+    def __init__(self, num_tokens_estimated: float) -> None:
+        self.num_tokens_estimated: float = num_tokens_estimated
+        self.num_tokens_used: Optional[float] = None
+        self.throttled: bool = False
+
+
+class RateLimiter(object):
+    """A client-side rate limiter shared by the LLM / embedding clients in one process.
+
+    It combines three mechanisms:
+    - Token buckets of requests per minute and tokens per minute, refilled continuously.
+    - AIMD (additive-increase / multiplicative-decrease) adaptive concurrency: the limit of in-flight requests is
+        halved on a throttling (429) and grows by about 1 for every `limit` successful requests. The throttlings
+        arriving during the back-off window, i.e. from the requests in flight before it, count as the same event.
+    - Shared back-off: once any worker gets throttled, all workers pause until the retry-after time (or an exponential
+        back-off if no hint given) instead of sleeping on their own.
+
+    Args:
+        requests_per_minute (Optional[float]): the request quota. No limit if None. Defaults to None.
+        tokens_per_minute (Optional[float]): the token quota. No limit if None. Defaults to None.
+        max_concurrency (Optional[int]): the upper bound of the adaptive concurrency limit. The concurrency would not
+            be limited until the first throttling if None. Defaults to None.
+        min_concurrency (int): the lower bound of the adaptive concurrency limit. Defaults to 1.
+        backoff_base (float): the back-off time in seconds for the first throttling without retry-after hint. It is
+            doubled for each consecutive throttling. Defaults to 1.
+        max_backoff (float): the upper bound of the back-off time in seconds. Defaults to 60.
+    """
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_concurrency: Optional[int] = None,
+        min_concurrency: int = 1,
+        backoff_base: float = 1,
+        max_backoff: float = 60,
+    ) -> None:
+        self._lock = threading.Lock()
+
+        self._concurrency_limit: Optional[float] = max_concurrency
+        self._num_in_flight: int = 0
+
+        self._request_bucket: Optional[_TokenBucket] = None
+        self._token_bucket: Optional[_TokenBucket] = None
+        self._max_concurrency: Optional[int] = max_concurrency
+        self._min_concurrency: int = max(1, min_concurrency)
+        self._backoff_base: float = backoff_base
+        self._max_backoff: float = max_backoff
+        self.configure(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+
+        self._blocked_until: float = 0
+        self._num_consecutive_throttles: int = 0
+
+        self.num_acquired: int = 0
+        self.num_throttled: int = 0
+
+    def configure(self, **config) -> None:
+        """Update the given fields of the config only, the others are kept. The quota already spent is kept as well,
+        i.e. re-configuring never refills the buckets.
+        """
+        with self._lock:
+            bucket_attrs = (("requests_per_minute", "_request_bucket"), ("tokens_per_minute", "_token_bucket"))
+            for key, bucket_attr in bucket_attrs:
+                if key not in config:
+                    continue
+                bucket: Optional[_TokenBucket] = getattr(self, bucket_attr)
+                if not config[key]:
+                    setattr(self, bucket_attr, None)
+                elif bucket is None:
+                    setattr(self, bucket_attr, _TokenBucket(config[key]))
+                else:
+                    bucket.resize(config[key])
+
+            if "max_concurrency" in config:
+                self._max_concurrency = config["max_concurrency"]
+                if self._max_concurrency is not None:
+                    self._concurrency_limit = min(
+                        self._concurrency_limit or self._max_concurrency, self._max_concurrency,
+                    )
+            if "min_concurrency" in config:
+                self._min_concurrency = max(1, config["min_concurrency"])
+            if "backoff_base" in config:
+                self._backoff_base = config["backoff_base"]
+            if "max_backoff" in config:
+                self._max_backoff = config["max_backoff"]
+
+    def _try_acquire(self, num_tokens: float) -> float:
+        """Return 0 if acquired, otherwise the seconds to wait before the next try."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+
+            if self._concurrency_limit is not None and self._num_in_flight >= int(self._concurrency_limit):
+                # Wake up soon to check again, a slot would be released once any in-flight request finishes.
+                return 0.05
+
+            wait_time: float = 0
+            buckets: List[Tuple[_TokenBucket, float]] = []
+            for bucket, amount in ((self._request_bucket, 1), (self._token_bucket, num_tokens)):
+                if bucket is None:
+                    continue
+                bucket.refill(now)
+                wait_time = max(wait_time, bucket.wait_time(amount))
+                buckets.append((bucket, amount))
+            if wait_time > 0:
+                return wait_time
+
+            for bucket, amount in buckets:
+                bucket.tokens -= amount
+            self._num_in_flight += 1
+            self.num_acquired += 1
+            return 0
+
+    def probe(self, num_tokens: float = 0) -> Tuple[float, float]:
+        """Peek at the limiter without acquiring, e.g. to route the request to the least loaded endpoint.
+
+        Returns:
+            Tuple[float, float]: the seconds to wait before a request with estimated `num_tokens` tokens could be sent
+                (ignoring the concurrency limit), and the ratio of the quota remaining in the most drained bucket (1
+                if no quota set).
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait_time: float = max(0, self._blocked_until - now)
+            remaining_ratio: float = 1
+            for bucket, amount in ((self._request_bucket, 1), (self._token_bucket, num_tokens)):
+                if bucket is None:
+                    continue
+                bucket.refill(now)
+                wait_time = max(wait_time, bucket.wait_time(amount))
+                remaining_ratio = min(remaining_ratio, max(0, bucket.tokens) / bucket.capacity)
+            return wait_time, remaining_ratio
+
+    def acquire(self, num_tokens: float = 0) -> None:
+        """Block until a request with estimated `num_tokens` tokens is allowed to be sent."""
+        while True:
+            wait_time = self._try_acquire(num_tokens)
+            if wait_time <= 0:
+                return
+            time.sleep(min(wait_time, 1))
+
+    async def aacquire(self, num_tokens: float = 0) -> None:
+        """The asyncio version of `acquire()`."""
+        while True:
+            wait_time = self._try_acquire(num_tokens)
+            if wait_time <= 0:
+                return
+            await asyncio.sleep(min(wait_time, 1))
+
+    def release(self, throttled: bool = False, num_tokens_corrected: float = 0) -> None:
+        """Release the in-flight slot acquired before.
+
+        Args:
+            throttled (bool): whether this request was throttled. Call `on_throttle()` in addition to make all workers
+                back off. Defaults to False.
+            num_tokens_corrected (float): the actual token usage minus the estimated one, used to correct the token
+                bucket. Defaults to 0.
+        """
+        with self._lock:
+            self._num_in_flight = max(0, self._num_in_flight - 1)
+            if self._token_bucket is not None and num_tokens_corrected != 0:
+                self._token_bucket.tokens -= num_tokens_corrected
+
+            if not throttled:
+                self._num_consecutive_throttles = 0
+                # Additive increase: about +1 for every `limit` successful requests.
+                if self._concurrency_limit is not None:
+                    self._concurrency_limit += 1 / max(self._concurrency_limit, 1)
+                    if self._max_concurrency is not None:
+                        self._concurrency_limit = min(self._concurrency_limit, self._max_concurrency)
+        return
+
+    def on_throttle(self, retry_after: Optional[float] = None) -> float:
+        """Record a throttling response and make all workers back off together.
+
+        Returns:
+            float: the seconds every worker would wait from now on.
+        """
+        with self._lock:
+            self.num_throttled += 1
+
+            # The throttlings within the back-off window come from the requests sent before it, i.e. the same overload,
+            # so the limit is not decreased and the back-off not doubled again, only a longer retry-after respected.
+            now = time.monotonic()
+            if now < self._blocked_until:
+                if retry_after is not None:
+                    self._blocked_until = max(self._blocked_until, now + min(retry_after, self._max_backoff))
+                return self._blocked_until - now
+
+            self._num_consecutive_throttles += 1
+
+            # Multiplicative decrease, starting from current in-flight level if no limit set yet.
+            base = self._concurrency_limit if self._concurrency_limit is not None else self._num_in_flight
+            self._concurrency_limit = max(self._min_concurrency, base / 2)
+
+            if retry_after is None:
+                retry_after = self._backoff_base * 2 ** (self._num_consecutive_throttles - 1)
+            retry_after = min(retry_after, self._max_backoff)
+
+            self._blocked_until = max(self._blocked_until, now + retry_after)
+            return self._blocked_until - now
+
+    @contextmanager
+    def limit(
+        self,
+        num_tokens: float = 0,
+        throttle_errors: Tuple[Type[BaseException], ...] = (),
+        retry_after_parser: Callable[[BaseException], Optional[float]] = None,
+    ):
+        """Acquire before, and release after, the request inside the context. The exceptions of `throttle_errors`
+        raised inside would be reported by `on_throttle()`, with the retry-after hint parsed by `retry_after_parser`,
+        before re-raised.
+
+        Yields:
+            RateLimitTicket: set its `num_tokens_used` to the actual usage, if known, to correct the token bucket.
+        """
+        ticket = RateLimitTicket(num_tokens)
+        self.acquire(num_tokens)
+        try:
+            yield ticket
+        except throttle_errors as e:
+            ticket.throttled = True
+            self.on_throttle(retry_after_parser(e) if retry_after_parser is not None else None)
+            raise
+        finally:
+            self._release_ticket(ticket)
+
+    @asynccontextmanager
+    async def alimit(
+        self,
+        num_tokens: float = 0,
+        throttle_errors: Tuple[Type[BaseException], ...] = (),
+        retry_after_parser: Callable[[BaseException], Optional[float]] = None,
+    ):
+        """The asyncio version of `limit()`."""
+        ticket = RateLimitTicket(num_tokens)
+        await self.aacquire(num_tokens)
+        try:
+            yield ticket
+        except throttle_errors as e:
+            ticket.throttled = True
+            self.on_throttle(retry_after_parser(e) if retry_after_parser is not None else None)
+            raise
+        finally:
+            self._release_ticket(ticket)
+
+    def _release_ticket(self, ticket: "RateLimitTicket") -> None:
+        num_tokens_corrected: float = 0
+        if ticket.num_tokens_used is not None:
+            num_tokens_corrected = ticket.num_tokens_used - ticket.num_tokens_estimated
+        self.release(throttled=ticket.throttled, num_tokens_corrected=num_tokens_corrected)
+        return
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "num_acquired": self.num_acquired,
+                "num_throttled": self.num_throttled,
+                "num_in_flight": self._num_in_flight,
+                "concurrency_limit": self._concurrency_limit,
+            }
+
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+# The config fields given to each limiter so far, to tell the ones to merge from the conflicting ones.
+_configured_fields: Dict[str, Dict[str, float]] = {}
+
+
+def get_rate_limiter(name: str = "default", **config) -> RateLimiter:
+    """Get the process-wide rate limiter of the given name, create it if not exist. For an existing limiter, the config
+    fields not given before are merged into it, while the ones conflicting with the given ones are ignored with a
+    warning, so that the clients sharing a limiter never reset the limits or the quota spent by each other.
+    """
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(name, None)
+        if limiter is None:
+            limiter = RateLimiter(**config)
+            _rate_limiters[name] = limiter
+            _configured_fields[name] = {key: value for key, value in config.items() if value is not None}
+            return limiter
+
+        configured = _configured_fields[name]
+        new_fields: Dict[str, float] = {}
+        for key, value in config.items():
+            if value is None:
+                continue
+            if key not in configured:
+                new_fields[key] = value
+            elif configured[key] != value:
+                print(
+                    f"[Rate Limiter] {name}: {key}={value} ignored, conflicting with {key}={configured[key]} given "
+                    f"before. Set a different `name` in the rate_limit_config to limit separately."
+                )
+        if len(new_fields) > 0:
+            limiter.configure(**new_fields)
+            configured.update(new_fields)
+    return limiter
+
+
+def estimate_num_tokens(messages: List[dict], llm_config: dict = {}) -> int:
+    """Roughly estimate the tokens a chat request costs against the quota: ~4 characters per prompt token, plus the
+    `max_tokens` reserved for the completion if set.
+    """
+    num_chars = sum(len(str(message.get("content", ""))) for message in messages)
+    return num_chars // 4 + len(messages) * 4 + (llm_config.get("max_tokens", None) or 0)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse the seconds from the `Retry-After` (or `retry-after-ms` if ends with "ms") header value, None if failed."""
+    if value is None:
+        return None
+    try:
+        value = value.strip()
+        if value.endswith("ms"):
+            return float(value[:-2]) / 1000
+        return float(value)
+    except Exception:
+        return None
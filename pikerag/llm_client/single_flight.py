@@ -0,0 +1,110 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+
+class _Call(object):
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: BaseException = None
+
+
+class SingleFlight(object):
+    """Coalesce the concurrent calls with the same key into one execution.
+
+    The first caller of a key (the leader) executes the function, the callers arriving while it is still in flight
+    (the followers) wait for it and share its result, or its exception. The same mechanism is provided for the asyncio
+    callers, which are only coalesced with the ones in the same event loop.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._async_calls: Dict[Tuple[int, str], asyncio.Future] = {}
+
+        self.num_executed: int = 0
+        self.num_coalesced: int = 0
+
+    def do(self, key: str, func: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Execute `func` as the leader, or wait for the in-flight leader of the same `key`.
+
+        Returns:
+            Any: the return value of `func`.
+            bool: True if the result is shared from another caller.
+        """
+        with self._lock:
+            call = self._calls.get(key, None)
+            if call is not None:
+                self.num_coalesced += 1
+                is_leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.num_executed += 1
+                is_leader = True
+
+        if not is_leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+        return call.result, False
+
+    async def ado(self, key: str, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """The asyncio version of `do()`, `func` here is a coroutine function."""
+        loop = asyncio.get_running_loop()
+        loop_key = (id(loop), key)
+        with self._lock:
+            future = self._async_calls.get(loop_key, None)
+            if future is not None:
+                self.num_coalesced += 1
+                is_leader = False
+            else:
+                future = loop.create_future()
+                self._async_calls[loop_key] = future
+                self.num_executed += 1
+                is_leader = True
+
+        if not is_leader:
+            # Shield it so that a cancelled follower would not cancel the leader's result for others.
+            return await asyncio.shield(future), True
+
+        try:
+            result = await func()
+            future.set_result(result)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved in case there is no follower.
+            future.exception()
+            raise
+        finally:
+            with self._lock:
+                self._async_calls.pop(loop_key, None)
+
+        return result, False
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        num_total = self.num_executed + self.num_coalesced
+        return {
+            "num_executed": self.num_executed,
+            "num_coalesced": self.num_coalesced,
+            "coalescing_ratio": self.num_coalesced / num_total if num_total > 0 else 0.0,
+        }
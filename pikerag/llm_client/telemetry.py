@@ -0,0 +1,206 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import csv
+import json
+import os
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+
+DEFAULT_CALL_TAG: str = "default"
+
+_call_tag: ContextVar[str] = ContextVar("llm_call_tag", default=DEFAULT_CALL_TAG)
+
+
+@contextmanager
+def llm_call_tag(tag: str):
+    """Tag the LLM calls made inside the context, e.g. by the workflow stage, so that the telemetry can be broken down
+    by it. The tag is bound to the current thread / asyncio task, the worker threads need to set their own.
+    """
+    token = _call_tag.set(tag)
+    try:
+        yield
+    finally:
+        _call_tag.reset(token)
+
+
+def get_llm_call_tag() -> str:
+    return _call_tag.get()
+
+
+class LatencyHistogram(object):
+    """A histogram of latencies in seconds with exponential buckets from 10 ms to about 11 min, precise enough for the
+    percentiles of LLM calls without keeping every sample.
+    """
+    BOUNDS: Tuple[float, ...] = tuple(0.01 * 2 ** i for i in range(17))
+
+    def __init__(self) -> None:
+        self.counts: List[int] = [0] * (len(self.BOUNDS) + 1)
+        self.count: int = 0
+        self.total: float = 0
+        self.max: float = 0
+
+    def add(self, value: float) -> None:
+        idx = 0
+        while idx < len(self.BOUNDS) and value > self.BOUNDS[idx]:
+            idx += 1
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q: float) -> float:
+        """Estimate the q-th (0 ~ 100) percentile by the upper bound of the bucket it falls in."""
+        if self.count == 0:
+            return 0.0
+        rank = q / 100 * self.count
+        cumulative = 0
+        for idx, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count > 0:
+                upper_bound = self.BOUNDS[idx] if idx < len(self.BOUNDS) else self.max
+                return min(upper_bound, self.max)
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count > 0 else 0.0
+
+
+class _CallStats(object):
+    def __init__(self) -> None:
+        self.num_calls: int = 0
+        self.num_cache_hits: int = 0
+        self.num_cache_misses: int = 0
+        self.num_requests: int = 0
+        self.num_failed: int = 0
+        self.num_skipped: int = 0
+        self.num_early_stopped: int = 0
+        self.retries: Dict[str, int] = {}
+        self.skipped: Dict[str, int] = {}
+        self.prompt_tokens: int = 0
+        self.completion_tokens: int = 0
+        self.latency = LatencyHistogram()
+
+    def as_dict(self) -> dict:
+        return {
+            "num_calls": self.num_calls,
+            "num_cache_hits": self.num_cache_hits,
+            "num_cache_misses": self.num_cache_misses,
+            "cache_hit_ratio": self.num_cache_hits / self.num_calls if self.num_calls > 0 else 0.0,
+            "num_requests": self.num_requests,
+            "num_failed": self.num_failed,
+            "num_skipped": self.num_skipped,
+            "num_early_stopped": self.num_early_stopped,
+            "num_retries": sum(self.retries.values()),
+            "retries_by_type": dict(self.retries),
+            "skipped_by_type": dict(self.skipped),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "latency_mean": self.latency.mean,
+            "latency_p50": self.latency.percentile(50),
+            "latency_p90": self.latency.percentile(90),
+            "latency_p99": self.latency.percentile(99),
+            "latency_max": self.latency.max,
+        }
+
+
+class LLMTelemetry(object):
+    """Thread-safe counters and latency histograms of the LLM calls, broken down by model and caller tag.
+
+    - Calls and cache hits / misses are counted per `generate_content_with_messages()` call.
+    - Requests, failures, token usage and latencies are counted per actual request to the LLM, i.e. cache misses that
+        are not coalesced with an identical in-flight one. The latency includes the retries.
+    - Retries and skipped requests (e.g. the BadRequests) are counted by the exception type.
+    - Streaming requests terminated once the output is decodable are counted as early stopped.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._stats: Dict[Tuple[str, str], _CallStats] = {}
+
+    def _get_stats(self, model: str) -> _CallStats:
+        key = (model, get_llm_call_tag())
+        stats = self._stats.get(key, None)
+        if stats is None:
+            stats = _CallStats()
+            self._stats[key] = stats
+        return stats
+
+    def record_cache_lookup(self, model: str, hit: bool) -> None:
+        with self._lock:
+            stats = self._get_stats(model)
+            stats.num_calls += 1
+            if hit:
+                stats.num_cache_hits += 1
+            else:
+                stats.num_cache_misses += 1
+
+    def record_request(
+        self, model: str, latency: float, success: bool,
+        prompt_tokens: Optional[int] = None, completion_tokens: Optional[int] = None,
+    ) -> None:
+        with self._lock:
+            stats = self._get_stats(model)
+            stats.num_requests += 1
+            stats.num_failed += int(not success)
+            stats.prompt_tokens += prompt_tokens or 0
+            stats.completion_tokens += completion_tokens or 0
+            stats.latency.add(latency)
+
+    def record_retry(self, model: str, error_type: str) -> None:
+        with self._lock:
+            stats = self._get_stats(model)
+            stats.retries[error_type] = stats.retries.get(error_type, 0) + 1
+
+    def record_skip(self, model: str, error_type: str) -> None:
+        with self._lock:
+            stats = self._get_stats(model)
+            stats.num_skipped += 1
+            stats.skipped[error_type] = stats.skipped.get(error_type, 0) + 1
+
+    def record_early_stop(self, model: str) -> None:
+        with self._lock:
+            self._get_stats(model).num_early_stopped += 1
+
+    def snapshot(self) -> List[dict]:
+        """Return the current metrics, one dict per (model, tag)."""
+        with self._lock:
+            return [
+                {"model": model, "tag": tag, **stats.as_dict()}
+                for (model, tag), stats in sorted(self._stats.items())
+            ]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats = {}
+
+    def dump(self, path_prefix: str) -> None:
+        """Dump the current metrics to `{path_prefix}.json` and `{path_prefix}.csv`."""
+        rows = self.snapshot()
+        os.makedirs(os.path.dirname(os.path.abspath(path_prefix)), exist_ok=True)
+
+        with open(f"{path_prefix}.json", "w") as fout:
+            json.dump(rows, fout, indent=2)
+
+        with open(f"{path_prefix}.csv", "w", newline="") as fout:
+            if len(rows) == 0:
+                return
+            writer = csv.DictWriter(fout, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            for row in rows:
+                writer.writerow({
+                    key: json.dumps(value) if isinstance(value, dict) else value
+                    for key, value in row.items()
+                })
+        return
+
+
+_llm_telemetry = LLMTelemetry()
+
+
+def get_llm_telemetry() -> LLMTelemetry:
+    """Get the process-wide telemetry shared by all the LLM clients."""
+    return _llm_telemetry
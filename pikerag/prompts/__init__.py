@@ -4,6 +4,10 @@
 from pikerag.prompts.base_parser import BaseContentParser
 from pikerag.prompts.message_template import MessageTemplate
 from pikerag.prompts.protocol import CommunicationProtocol
+from pikerag.prompts.token_budget import BudgetResult, TokenBudgeter, TokenCounter, get_last_budget_result
 
 
-__all__ = ["BaseContentParser", "MessageTemplate", "CommunicationProtocol"]
+__all__ = [
+    "BaseContentParser", "MessageTemplate", "CommunicationProtocol",
+    "BudgetResult", "TokenBudgeter", "TokenCounter", "get_last_budget_result",
+]
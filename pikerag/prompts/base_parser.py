@@ -1,7 +1,9 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
-from typing import Any, Tuple
+from typing import Any, Optional, Tuple
+
+from pikerag.utils.completion_detector import BaseCompletionDetector
 
 
 class BaseContentParser:
@@ -23,3 +25,9 @@ class BaseContentParser:
 
     def decode(self, content: str, **kwargs) -> Any:
         return content
+
+    def completion_detector(self) -> Optional[BaseCompletionDetector]:
+        """Create a detector for the streaming output to stop as soon as it is decodable. Return None if the full
+        output is always needed.
+        """
+        return None
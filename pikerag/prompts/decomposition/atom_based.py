@@ -6,6 +6,7 @@ from typing import Dict, List, Tuple
 from pikerag.knowledge_retrievers.chunk_atom_retriever import AtomRetrievalInfo
 from pikerag.prompts import MessageTemplate, BaseContentParser, CommunicationProtocol
 from pikerag.prompts.qa.generation import generation_qa_with_reference_template, GenerationQaParser
+from pikerag.utils.completion_detector import JsonObjectDetector
 from pikerag.utils.json_parser import parse_json
 
 
@@ -81,6 +82,9 @@ class QuestionDecompositionParser(BaseContentParser):
             print(f"Exception: {e}")
             return False, "", []
 
+    def completion_detector(self) -> JsonObjectDetector:
+        return JsonObjectDetector()
+
 
 question_decompose_protocol = CommunicationProtocol(
     template=question_decomposition_template,
@@ -160,6 +164,9 @@ class AtomQuestionSelectionParser(BaseContentParser):
             print(f"Exception: {e}")
             return False, "", None
 
+    def completion_detector(self) -> JsonObjectDetector:
+        return JsonObjectDetector()
+
 
 atom_question_selection_protocol = CommunicationProtocol(
     template=atom_question_selection_template,
@@ -242,6 +249,9 @@ class ChunkSelectionParser(BaseContentParser):
             print(f"Exception: {e}")
             return False, "", None
 
+    def completion_detector(self) -> JsonObjectDetector:
+        return JsonObjectDetector()
+
 
 chunk_selection_protocol = CommunicationProtocol(
     template=chunk_selection_template,
@@ -4,6 +4,7 @@
 from typing import Dict, List, Tuple
 
 from pikerag.prompts import BaseContentParser, CommunicationProtocol, MessageTemplate
+from pikerag.utils.completion_detector import JsonObjectDetector
 from pikerag.utils.json_parser import parse_json
 
 
@@ -118,6 +119,9 @@ class IRCoTParser(BaseContentParser):
                 output[key] = str(value)
         return output
 
+    def completion_detector(self) -> JsonObjectDetector:
+        return JsonObjectDetector()
+
 
 ircot_qa_protocol = CommunicationProtocol(
     template=ircot_template,
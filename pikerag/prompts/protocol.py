@@ -2,16 +2,20 @@
 # Licensed under the MIT license.
 
 from dataclasses import dataclass
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
 from pikerag.prompts.base_parser import BaseContentParser
 from pikerag.prompts.message_template import MessageTemplate
+from pikerag.prompts.token_budget import TokenBudgeter
+from pikerag.utils.completion_detector import BaseCompletionDetector
 
 
 @dataclass
 class CommunicationProtocol:
     template: MessageTemplate
     parser: BaseContentParser
+    # Set to trim the references to fit the input messages into the token budget of the target model.
+    token_budgeter: Optional[TokenBudgeter] = None
 
     def template_partial(self, **kwargs) -> List[str]:
         """Partially fill in the template placeholders to update the template.
@@ -35,6 +39,16 @@ class CommunicationProtocol:
         Returns:
             List[Dict[str, str]]: the formatted message list for LLM chat.
         """
+        if self.token_budgeter is None:
+            return self._render_input(content, kwargs)
+
+        # The references are dropped if over budget, see `get_last_budget_result()` for which are kept.
+        messages, _ = self.token_budgeter.fit(
+            content, kwargs, lambda budget_kwargs: self._render_input(content, budget_kwargs),
+        )
+        return messages
+
+    def _render_input(self, content: str, kwargs: dict) -> List[Dict[str, str]]:
         encoded_content, encoded_dict = self.parser.encode(content, **kwargs)
         return self.template.format(content=encoded_content, **kwargs, **encoded_dict)
 
@@ -49,3 +63,9 @@ class CommunicationProtocol:
             Any: value(s) returned by the parser, the return value types varied according to different applications.
         """
         return self.parser.decode(content, **kwargs)
+
+    def completion_detector(self) -> Optional[BaseCompletionDetector]:
+        """Create a new detector to terminate the streaming output early once the parser can decode it, None if not
+        supported by the parser. Pass it to the LLM client together with the messages.
+        """
+        return self.parser.completion_detector()
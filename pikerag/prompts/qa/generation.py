@@ -4,6 +4,7 @@
 from typing import Dict, List, Tuple
 
 from pikerag.prompts import BaseContentParser, CommunicationProtocol, MessageTemplate
+from pikerag.utils.completion_detector import JsonObjectDetector
 from pikerag.utils.json_parser import parse_json
 
 
@@ -105,6 +106,9 @@ class GenerationQaParser(BaseContentParser):
             output[key] = str(value)
         return output
 
+    def completion_detector(self) -> JsonObjectDetector:
+        return JsonObjectDetector()
+
 
 generation_qa_protocol = CommunicationProtocol(
     template=generation_qa_template,
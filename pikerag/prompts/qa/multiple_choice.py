@@ -7,6 +7,7 @@ from typing import Dict, List, Tuple
 from bs4 import BeautifulSoup
 
 from pikerag.prompts import BaseContentParser, CommunicationProtocol, MessageTemplate
+from pikerag.utils.completion_detector import ClosingTagDetector
 from pikerag.utils.lxml_parser import get_soup_from_content
 
 
@@ -202,6 +203,9 @@ class MultipleChoiceQaParser(BaseContentParser):
             "chosen_option": option,
         }
 
+    def completion_detector(self) -> ClosingTagDetector:
+        return ClosingTagDetector(tag="result")
+
 
 class MultipleChoiceQaWithReferenceParser(MultipleChoiceQaParser):
     def encode(self, content: str, options: Dict[str, str], answer_mask_labels: List[str], **kwargs) -> Tuple[str, Dict]:
@@ -0,0 +1,218 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import re
+import threading
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+
+# The role, separators and so on of a chat message take about 4 tokens, and the reply is primed with 3 more.
+TOKENS_PER_MESSAGE: int = 4
+TOKENS_PER_REPLY: int = 3
+
+
+class TokenCounter(object):
+    """Count the tokens of the texts and the chat messages.
+
+    Args:
+        model (str): the model name used to pick the tiktoken encoding, e.g. "gpt-4o". Defaults to None.
+        tokenizer (str): the tiktoken encoding name, e.g. "cl100k_base", or "hf:<name or path>" to use a HuggingFace
+            tokenizer. Defaults to None, i.e. the encoding of the `model`, or "cl100k_base" if unknown.
+
+    If `tiktoken` is not installed, the tokens are estimated as 4 characters each.
+    """
+    def __init__(self, model: str = None, tokenizer: str = None) -> None:
+        self._encode: Callable[[str], Sequence[int]] = None
+        self.name: str = "char_estimate"
+
+        if tokenizer is not None and tokenizer.startswith("hf:"):
+            from transformers import AutoTokenizer
+
+            hf_tokenizer = AutoTokenizer.from_pretrained(tokenizer[3:])
+            self._encode = lambda text: hf_tokenizer.encode(text, add_special_tokens=False)
+            self.name = tokenizer
+            return
+
+        try:
+            import tiktoken
+        except ImportError:
+            print("[TokenCounter] tiktoken not installed, the tokens would be estimated by the characters.")
+            return
+
+        encoding = None
+        if tokenizer is None and model is not None:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = None
+        if encoding is None:
+            encoding = tiktoken.get_encoding(tokenizer or "cl100k_base")
+        self._encode = lambda text: encoding.encode(text, disallowed_special=())
+        self.name = encoding.name
+
+    def count(self, text: str) -> int:
+        if self._encode is None:
+            return (len(text) + 3) // 4
+        return len(self._encode(text))
+
+    def count_message(self, message: Dict[str, str]) -> int:
+        return self.count(str(message.get("content", ""))) + TOKENS_PER_MESSAGE
+
+    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+        return sum(self.count_message(message) for message in messages) + TOKENS_PER_REPLY
+
+
+@dataclass
+class BudgetResult:
+    """The budgeting result of one `CommunicationProtocol.process_input()` call."""
+    num_tokens: int
+    num_references: int
+    num_references_dropped: int
+    over_budget: bool
+    # The indices of the references kept, in the original order.
+    kept_indices: List[int] = field(default_factory=list)
+
+
+_last_budget_result: ContextVar[Optional[BudgetResult]] = ContextVar("last_budget_result", default=None)
+
+
+def get_last_budget_result() -> Optional[BudgetResult]:
+    """Get the result of the latest budgeted `process_input()` call in current thread / asyncio task, None if no
+    budget applied.
+    """
+    return _last_budget_result.get()
+
+
+def _reference_text(reference: Any) -> str:
+    if isinstance(reference, str):
+        return reference
+    # E.g. the AtomRetrievalInfo, ranked by the source chunk it brings into the context.
+    for attr_name in ("source_chunk", "atom"):
+        value = getattr(reference, attr_name, None)
+        if isinstance(value, str):
+            return value
+    return str(reference)
+
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def _word_set(text: str) -> set:
+    return set(word.lower() for word in _WORD_PATTERN.findall(text))
+
+
+class TokenBudgeter(object):
+    """Fit the input messages of a protocol into the token budget of the target model, by dropping the lowest ranked
+    references until the messages fit.
+
+    The references are the list passed to `process_input()` as the first present keyword of `reference_keys`. The
+    largest number of top ranked references that fits is found by a binary search over the rendered messages, so
+    the parser formatting and de-duplication are all taken into account. The kept references are passed in their
+    original order.
+
+    Args:
+        max_input_tokens (int): the token budget of the input messages, e.g. the context window of the model minus the
+            tokens reserved for the output.
+        model (str): the target model, to pick the tokenizer. Defaults to None.
+        tokenizer (str): the tokenizer, see `TokenCounter`. Defaults to None.
+        ranking (str): how to rank the references to keep. "order" to keep the top ones in the given order, i.e. the
+            retrieval ranking; "overlap" to keep the ones sharing the most words with the content (the question).
+            Defaults to "order".
+        reference_keys (List[str]): the keywords of the reference lists that can be trimmed. Defaults to
+            ["references", "chosen_atom_infos"].
+    """
+    def __init__(
+        self, max_input_tokens: int, model: str = None, tokenizer: str = None, ranking: str = "order",
+        reference_keys: List[str] = None,
+    ) -> None:
+        assert max_input_tokens > 0, f"max_input_tokens should be positive (but {max_input_tokens} was given)!"
+        assert ranking in ("order", "overlap"), f"Unrecognized ranking: {ranking}, should be 'order' or 'overlap'."
+
+        self._max_input_tokens: int = max_input_tokens
+        self._counter = TokenCounter(model=model, tokenizer=tokenizer)
+        self._ranking: str = ranking
+        self._reference_keys: List[str] = reference_keys or ["references", "chosen_atom_infos"]
+
+        self._lock = threading.Lock()
+        self._num_calls: int = 0
+        self._num_trimmed: int = 0
+        self._num_over_budget: int = 0
+        self._num_references_dropped: int = 0
+
+    @property
+    def counter(self) -> TokenCounter:
+        return self._counter
+
+    def _rank(self, content: str, references: List[Any]) -> List[int]:
+        if self._ranking == "order":
+            return list(range(len(references)))
+
+        query_words = _word_set(content)
+        overlaps = [len(query_words & _word_set(_reference_text(reference))) for reference in references]
+        # Stable sort, ties keep the retrieval ranking.
+        return sorted(range(len(references)), key=lambda idx: -overlaps[idx])
+
+    def fit(
+        self, content: str, kwargs: dict, render: Callable[[dict], List[Dict[str, str]]],
+    ) -> Tuple[List[Dict[str, str]], BudgetResult]:
+        """Render the messages by `render(kwargs)` within the budget, with the references in `kwargs` trimmed if
+        needed. The last `render()` call is always the one of the returned messages, for the parsers keeping states.
+        """
+        reference_key: Optional[str] = next(
+            (key for key in self._reference_keys if isinstance(kwargs.get(key, None), list)), None,
+        )
+
+        messages = render(kwargs)
+        num_tokens = self._counter.count_messages(messages)
+        num_references = len(kwargs[reference_key]) if reference_key is not None else 0
+        kept_indices: List[int] = list(range(num_references))
+
+        if num_tokens > self._max_input_tokens and num_references > 0:
+            references: List[Any] = kwargs[reference_key]
+            ranked = self._rank(content, references)
+
+            def render_top(k: int) -> Tuple[List[Dict[str, str]], int]:
+                top_k_indices = sorted(ranked[:k])
+                top_k_messages = render({**kwargs, reference_key: [references[idx] for idx in top_k_indices]})
+                return top_k_messages, self._counter.count_messages(top_k_messages)
+
+            # Binary search the largest k in [0, n) that fits, n is known not fitting.
+            low, high = 0, num_references - 1
+            while low < high:
+                mid = (low + high + 1) // 2
+                if render_top(mid)[1] <= self._max_input_tokens:
+                    low = mid
+                else:
+                    high = mid - 1
+            kept_indices = sorted(ranked[:low])
+            messages, num_tokens = render_top(low)
+
+        result = BudgetResult(
+            num_tokens=num_tokens,
+            num_references=num_references,
+            num_references_dropped=num_references - len(kept_indices),
+            over_budget=num_tokens > self._max_input_tokens,
+            kept_indices=kept_indices,
+        )
+        with self._lock:
+            self._num_calls += 1
+            self._num_trimmed += int(result.num_references_dropped > 0)
+            self._num_over_budget += int(result.over_budget)
+            self._num_references_dropped += result.num_references_dropped
+        _last_budget_result.set(result)
+        return messages, result
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """The counters of the budgeted calls: `num_calls`, `num_trimmed` calls with references dropped,
+        `num_over_budget` calls still over the budget without any reference, and `num_references_dropped` in total.
+        """
+        with self._lock:
+            return {
+                "num_calls": self._num_calls,
+                "num_trimmed": self._num_trimmed,
+                "num_over_budget": self._num_over_budget,
+                "num_references_dropped": self._num_references_dropped,
+            }
@@ -0,0 +1,103 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import json
+
+
+class BaseCompletionDetector:
+    """Detect whether a streaming LLM output already contains a complete result to decode.
+
+    A new detector should be created for every request. The streamed text is fed in by `feed()` piece by piece, once it
+    returns True the rest of the stream can be dropped and the `content` is what is worth keeping.
+    """
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        """Clear the text fed in, e.g. to start over for a retried request."""
+        self._buffer: str = ""
+        self._end: int = -1
+
+    def feed(self, delta: str) -> bool:
+        """Append the newly streamed text, return True if the output is complete."""
+        if self._end < 0:
+            self._buffer += delta
+            self._end = self._detect()
+        return self._end >= 0
+
+    def _detect(self) -> int:
+        """Return the end index of the complete result in the buffer, -1 if not complete yet."""
+        return -1
+
+    @property
+    def is_complete(self) -> bool:
+        return self._end >= 0
+
+    @property
+    def content(self) -> str:
+        """The text streamed in so far, truncated right after the complete result if detected."""
+        return self._buffer[:self._end] if self._end >= 0 else self._buffer
+
+
+class JsonObjectDetector(BaseCompletionDetector):
+    """Complete once the first top-level json object decodable by `json.loads()` is closed. The braces inside the json
+    strings are skipped, and the text before the object, e.g. the step-by-step thinking, is kept.
+    """
+    def reset(self) -> None:
+        super().reset()
+        self._pos: int = 0
+        self._depth: int = 0
+        self._start: int = -1
+        self._in_string: bool = False
+        self._escaped: bool = False
+
+    def _detect(self) -> int:
+        buffer = self._buffer
+        while self._pos < len(buffer):
+            char = buffer[self._pos]
+            self._pos += 1
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"' and self._depth > 0:
+                self._in_string = True
+            elif char == "{":
+                if self._depth == 0:
+                    self._start = self._pos - 1
+                self._depth += 1
+            elif char == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        json.loads(buffer[self._start:self._pos], strict=False)
+                        return self._pos
+                    except Exception:
+                        # Not a json object, e.g. braces in the thinking text, keep looking for the next one.
+                        self._start = -1
+        return -1
+
+
+class ClosingTagDetector(BaseCompletionDetector):
+    """Complete once the closing tag, e.g. `</result>`, is streamed."""
+    def __init__(self, tag: str) -> None:
+        self._closing_tag: str = f"</{tag}>"
+        super().__init__()
+
+    def reset(self) -> None:
+        super().reset()
+        self._search_start: int = 0
+
+    def _detect(self) -> int:
+        idx = self._buffer.find(self._closing_tag, self._search_start)
+        if idx >= 0:
+            return idx + len(self._closing_tag)
+        # The closing tag may be split across the pieces.
+        self._search_start = max(0, len(self._buffer) - len(self._closing_tag) + 1)
+        return -1
@@ -2,15 +2,17 @@
 # Licensed under the MIT license.
 
 import importlib
+import json
 import os
 import pathlib
+import threading
 from copy import deepcopy
 from dotenv import load_dotenv
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Dict, Optional
 
 from langchain_core.embeddings import Embeddings
 
-from pikerag.prompts import CommunicationProtocol
+from pikerag.prompts import CommunicationProtocol, TokenBudgeter
 
 
 def load_dot_env(env_path: Optional[str]) -> None:
@@ -30,10 +32,14 @@ def load_constant(module_path: str, variable_name: str) -> Any:
     return target
 
 
-def load_protocol(module_path: str, protocol_name: str, partial_values: dict={}) -> CommunicationProtocol:
+def load_protocol(
+    module_path: str, protocol_name: str, partial_values: dict={}, token_budget: Optional[dict]=None,
+) -> CommunicationProtocol:
     protocol_module = importlib.import_module(module_path)
     protocol: CommunicationProtocol = deepcopy(getattr(protocol_module, protocol_name))
     protocol.template_partial(**partial_values)
+    if token_budget is not None:
+        protocol.token_budgeter = TokenBudgeter(**token_budget)
     return protocol
 
 
@@ -50,18 +56,65 @@ def load_class(module_path: str, class_name: str, base_class=None) -> object:
     return loaded_class
 
 
+# The embeddings loaded, shared by all the retrievers and workflow steps with the same embedding setting.
+_shared_embeddings: Dict[str, Embeddings] = {}
+_shared_embeddings_lock = threading.Lock()
+
+
 def load_embedding_func(module_path: Optional[str]=None, class_name: Optional[str]=None, **kwargs) -> Embeddings:
+    """Load the embedding function, the same instance is returned for the same setting so that the model and the query
+    embedding memo are shared. The query embeddings are memoized by `MemoizedEmbeddings` with `memo_config` in the
+    args (`max_entries`, defaults to 4096, 0 to disable; `prime_from_store`, defaults to False, only for the symmetric
+    models). The vectors are reduced by `CompressedEmbeddings` if `compression_config` is given in the args.
+    """
+    setting_key = json.dumps([module_path, class_name, kwargs], sort_keys=True, default=str)
+    with _shared_embeddings_lock:
+        if setting_key not in _shared_embeddings:
+            _shared_embeddings[setting_key] = _create_embedding_func(module_path, class_name, **kwargs)
+        return _shared_embeddings[setting_key]
+
+
+def _create_embedding_func(module_path: Optional[str]=None, class_name: Optional[str]=None, **kwargs) -> Embeddings:
     # Set to disable huggingface/tokenizers fork warning of deadlocks.
     os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+    memo_config: dict = dict(kwargs.pop("memo_config", None) or {})
+    compression_config: Optional[dict] = kwargs.pop("compression_config", None)
+
     if module_path is None or class_name is None:
         from langchain_huggingface import HuggingFaceEmbeddings
         embedding_class = HuggingFaceEmbeddings
     else:
         embedding_class = load_callable(module_path, class_name)
 
+    # The embeddings without a cache of their own (e.g. the HuggingFace ones) are wrapped by the mmap cache if
+    # `cache_config` given. The ones with `MANAGES_CACHE`, e.g. AzureOpenAIEmbedding, take it as their own argument.
+    cache_config: Optional[dict] = None
+    if not getattr(embedding_class, "MANAGES_CACHE", False):
+        cache_config = kwargs.pop("cache_config", None)
+
     if "model_name" not in kwargs or kwargs["model_name"] is None:
         kwargs["model_name"] = "BAAI/bge-m3"
 
     embedding = embedding_class(**kwargs)
+
+    if cache_config is not None and cache_config.get("location", None) is not None:
+        from pikerag.llm_client.embedding_cache import CachedEmbeddings
+        # The model is identified by its class and args, so that a cache is never reused across the models.
+        embedding = CachedEmbeddings(
+            embedding,
+            location=cache_config["location"],
+            dtype=cache_config.get("dtype", "float32"),
+            readonly=cache_config.get("readonly", False),
+            model_id=json.dumps([embedding_class.__name__, kwargs], sort_keys=True, default=str),
+        )
+
+    # Compress after the cache so that the full vectors cached are reusable by other compression settings.
+    if compression_config is not None:
+        from pikerag.llm_client.embedding_compression import CompressedEmbeddings
+        embedding = CompressedEmbeddings(embedding, **compression_config)
+
+    if memo_config.get("max_entries", 4096) > 0:
+        from pikerag.llm_client.embedding_cache import MemoizedEmbeddings
+        embedding = MemoizedEmbeddings(embedding, **memo_config)
     return embedding
@@ -11,6 +11,7 @@ from tqdm import tqdm
 from pikerag.document_loaders import get_loader
 from pikerag.document_transformers import LLMPoweredRecursiveSplitter
 from pikerag.llm_client import BaseLLMClient
+from pikerag.llm_client.cache import get_cache_class
 from pikerag.utils.config_loader import load_class
 from pikerag.utils.logger import Logger
 from pikerag.utils.walker import list_files_recursively
@@ -37,9 +38,10 @@ class ChunkingWorkflow:
         self._client_logger = Logger(name="client", dump_mode="a", dump_folder=self._yaml_config["log_dir"])
 
         llm_client_config = self._yaml_config["llm_client"]
+        cache_backend: str = llm_client_config["cache_config"].get("backend", "sqlite")
         cache_location = os.path.join(
             self._yaml_config["log_dir"],
-            f"{llm_client_config['cache_config']['location_prefix']}.db",
+            f"{llm_client_config['cache_config']['location_prefix']}{get_cache_class(cache_backend).EXTENSION}",
         )
 
         client_module = importlib.import_module(llm_client_config["module_path"])
@@ -48,6 +50,8 @@ class ChunkingWorkflow:
         self._client = client_class(
             location=cache_location,
             auto_dump=llm_client_config["cache_config"]["auto_dump"],
+            cache_backend=cache_backend,
+            memory_cache_config=llm_client_config["cache_config"].get("memory", None),
             logger=self._client_logger,
             llm_config=llm_client_config["llm_config"],
             **llm_client_config.get("args", {}),
@@ -138,3 +142,5 @@ class ChunkingWorkflow:
             # Dump document chunks to disk.
             with open(output_path, "wb") as fout:
                 pickle.dump(chunk_docs, fout)
+
+        self._client.telemetry.dump(os.path.join(self._yaml_config["log_dir"], "llm_telemetry"))
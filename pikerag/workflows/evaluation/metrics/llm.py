@@ -1,7 +1,7 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
-from typing import Tuple
+from typing import List, Tuple
 
 from pikerag.llm_client import AzureOpenAIClient
 from pikerag.prompts import BaseContentParser, CommunicationProtocol, MessageTemplate
@@ -75,8 +75,19 @@ class LLM(BaseMetric):
             "temperature": kwargs.get("temperature", 0),
         }
 
+    @property
+    def client(self) -> AzureOpenAIClient:
+        return self._client
+
+    @property
+    def llm_config(self) -> dict:
+        return self._llm_config
+
+    def get_judge_messages(self, qa: GenerationQaData) -> List[dict]:
+        return answer_judge_protocol.process_input(content=qa.answer, qa=qa)
+
     def _scoring_generation_qa(self, qa: GenerationQaData) -> float:
-        messages = answer_judge_protocol.process_input(content=qa.answer, qa=qa)
+        messages = self.get_judge_messages(qa)
         judgement = self._client.generate_content_with_messages(messages, **self._llm_config)
         score = answer_judge_protocol.parse_output(judgement)
         return score
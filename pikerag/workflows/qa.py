@@ -4,17 +4,22 @@
 import importlib
 import os
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import List
+from typing import List, Optional
 
 import jsonlines
 from tqdm import tqdm
 
 from pikerag.knowledge_retrievers import BaseQaRetriever
 from pikerag.llm_client.base import BaseLLMClient
+from pikerag.llm_client.batch import BatchRequestCollector, OpenAIBatchRunner, load_batch_results
+from pikerag.llm_client.cache import get_cache_class
+from pikerag.llm_client.telemetry import llm_call_tag
+from pikerag.prompts import get_last_budget_result
 from pikerag.utils.config_loader import load_class, load_protocol
 from pikerag.utils.logger import Logger
 from pikerag.workflows.common import BaseQaData, GenerationQaData, MultipleChoiceQaData
 from pikerag.workflows.evaluation.evaluator import Evaluator
+from pikerag.workflows.evaluation.metrics.llm import LLM
 
 
 # TODO: add yaml config checker for it.
@@ -35,6 +40,8 @@ class QaWorkflow:
         self._workflow_config: dict = self._yaml_config["workflow"].get("args", {})
         self._num_parallel: int = self._workflow_config.get("num_parallel", 1)
 
+        self._init_batch_mode()
+
     def _init_logger(self) -> None:
         self._logger: Logger = Logger(
             name=self._yaml_config["experiment_name"],
@@ -58,6 +65,7 @@ class QaWorkflow:
             module_path=self._yaml_config["qa_protocol"]["module_path"],
             protocol_name=self._yaml_config["qa_protocol"]["attr_name"],
             partial_values=self._yaml_config["qa_protocol"].get("template_partial", {}),
+            token_budget=self._yaml_config["qa_protocol"].get("token_budget", None),
         )
 
     def _init_retriever(self) -> None:
@@ -90,6 +98,8 @@ class QaWorkflow:
         self._client = client_class(
             location=None,
             auto_dump=llm_client_config["cache_config"]["auto_dump"],
+            cache_backend=llm_client_config["cache_config"].get("backend", "sqlite"),
+            memory_cache_config=llm_client_config["cache_config"].get("memory", None),
             logger=self._client_logger,
             llm_config=self.llm_config,
             **llm_client_config.get("args", {}),
@@ -97,13 +107,121 @@ class QaWorkflow:
 
     def _update_llm_cache(self, round_idx: int) -> None:
         # Update cache location for different rounds.
+        cache_config: dict = self._yaml_config["llm_client"]["cache_config"]
+        extension = get_cache_class(cache_config.get("backend", "sqlite")).EXTENSION
         location = os.path.join(
             self._yaml_config["log_dir"],
-            f"{self._yaml_config['llm_client']['cache_config']['location_prefix']}_round{round_idx}.db",
+            f"{cache_config['location_prefix']}_round{round_idx}{extension}",
         )
         self._client.update_cache_location(location)
         return
 
+    def _dump_llm_telemetry(self, round_idx: int) -> None:
+        # Dump the LLM call metrics of this round and start over for the next one.
+        telemetry = self._client.telemetry
+        telemetry.dump(os.path.join(self._yaml_config["log_dir"], f"llm_telemetry_round{round_idx}"))
+        telemetry.reset()
+        return
+
+    def _init_batch_mode(self) -> None:
+        # Batch mode: send the LLM requests of each round by the Batch API ahead of the normal run, see `_run_batch()`.
+        self._batch_config: Optional[dict] = self._workflow_config.get("batch", None)
+        self._batch_runner: Optional[OpenAIBatchRunner] = None
+        self._batch_judge_cache_location: Optional[str] = None
+        if self._batch_config is None or not self._batch_config.get("enabled", True):
+            self._batch_config = None
+            return
+
+        assert type(self).answer is QaWorkflow.answer, (
+            f"Batch mode only supports the single-step `QaWorkflow.answer()`, but {type(self).__name__} overrides it."
+        )
+        self._batch_runner = OpenAIBatchRunner(logger=self._logger, **self._batch_config)
+        return
+
+    def _send_batch_requests(self, client: BaseLLMClient, collector: BatchRequestCollector, name: str) -> None:
+        if len(collector) == 0:
+            return
+
+        requests = collector.requests
+        output_paths = self._batch_runner.run(
+            requests,
+            work_dir=os.path.join(self._yaml_config["log_dir"], "batch"),
+            name=name,
+            max_requests_per_file=self._batch_config.get("max_requests_per_file", 50000),
+        )
+        num_loaded, num_failed = load_batch_results(output_paths, client.save_batch_results, keys=requests.keys())
+        self._logger.info(
+            f"[{name}] {num_loaded} of {len(requests)} batch results loaded into {client.cache_location}, "
+            f"{num_failed} failed. The rest would be requested online.",
+            tag="BatchMode",
+        )
+        return
+
+    def _collect_answer_requests(self, qa: BaseQaData, question_idx: int) -> None:
+        try:
+            with llm_call_tag("batch_collect"):
+                self.answer(qa, question_idx)
+        except Exception:
+            # The empty responses returned in collecting may fail the parsing, which does not matter.
+            pass
+        return
+
+    def _collect_judge_requests(self, qa: BaseQaData, question_idx: int, judge: LLM) -> None:
+        if not isinstance(qa, GenerationQaData):
+            return
+
+        try:
+            # The answers are loaded into the cache by the previous stage, the missed ones are requested online here.
+            output_dict: dict = self._answer_with_tag(qa, question_idx)
+            qa.update_answer(output_dict["answer"])
+
+            messages = judge.get_judge_messages(qa)
+            with llm_call_tag("batch_collect"):
+                judge.client.generate_content_with_messages(messages, **judge.llm_config)
+        except Exception as e:
+            print(f"Exception collecting the judge request of {question_idx}-th question: {e}")
+        return
+
+    def _for_each_qa(self, func, *args) -> None:
+        if self._num_parallel == 1:
+            for q_idx, qa in enumerate(self._testing_suite):
+                func(qa, q_idx, *args)
+            return
+
+        with ThreadPoolExecutor(max_workers=self._num_parallel) as executor:
+            futures = [executor.submit(func, qa, q_idx, *args) for q_idx, qa in enumerate(self._testing_suite)]
+            for future in as_completed(futures):
+                future.result()
+        return
+
+    def _run_batch(self, round_idx: int) -> None:
+        """Collect the cache-missing LLM requests of this round, send them by the Batch API and load the results into
+        the LLM caches, so that the normal run of the round completes from the caches. It takes two stages since the
+        LLM judge depends on the answers: the answer requests first, then the judge requests of the `LLM` metric if
+        configured and `evaluation` is not disabled in the batch config.
+        """
+        with self._client.collect_batch_requests() as collector:
+            self._for_each_qa(self._collect_answer_requests)
+        self._send_batch_requests(self._client, collector, f"round{round_idx}_answer")
+
+        judge = self._evaluator._metrics_by_name.get(LLM.name, None)
+        if not isinstance(judge, LLM) or not self._batch_config.get("evaluation", True):
+            return
+
+        # The judge caches nothing by default, give it one per round to load the results into.
+        if judge.client.cache_location in (None, self._batch_judge_cache_location):
+            cache_config: dict = self._yaml_config["llm_client"]["cache_config"]
+            extension = get_cache_class(cache_config.get("backend", "sqlite")).EXTENSION
+            self._batch_judge_cache_location = os.path.join(
+                self._yaml_config["log_dir"], f"llm_judge_round{round_idx}{extension}",
+            )
+            judge.client.update_cache_location(self._batch_judge_cache_location)
+
+        with judge.client.collect_batch_requests() as collector:
+            self._for_each_qa(self._collect_judge_requests, judge)
+        self._send_batch_requests(judge.client, collector, f"round{round_idx}_evaluation")
+        return
+
     def _init_agent(self) -> None:
         """Initialize the components the `answer` function is going to use. Currently, the `agent` is only a virtual
         concept that there is actually no `agent` instance here (to shorten the instance layers).
@@ -181,19 +299,21 @@ class QaWorkflow:
         for round_idx in range(self._yaml_config["test_rounds"]):
             round_id: str = f"Round{round_idx}"
             self._update_llm_cache(round_idx)
+            if self._batch_config is not None:
+                self._run_batch(round_idx)
             self._evaluator.on_round_test_start(round_id)
 
             question_idx: int = 0
             pbar = tqdm(self._testing_suite, desc=f"[{self._yaml_config['experiment_name']}] Round {round_idx}")
             for qa in pbar:
-                output_dict: dict = self.answer(qa, question_idx)
+                output_dict: dict = self._answer_with_tag(qa, question_idx)
 
                 assert "answer" in output_dict, "`answer` should be included in output_dict"
                 answer = output_dict.pop("answer")
                 qa.update_answer(answer)
                 qa.answer_metadata.update(output_dict)
 
-                self._evaluator.update_round_metrics(qa)
+                self._evaluate_with_tag(qa)
 
                 fout.write(qa.as_dict())
                 self._update_qas_metrics_table(qa)
@@ -202,6 +322,7 @@ class QaWorkflow:
                 self._update_pbar_desc(pbar, round_idx=round_idx, count=question_idx)
 
             self._evaluator.on_round_test_end(round_id)
+            self._dump_llm_telemetry(round_idx)
 
         self._evaluator.on_test_end()
 
@@ -213,6 +334,8 @@ class QaWorkflow:
         for round_idx in range(self._yaml_config["test_rounds"]):
             round_id: str = f"Round{round_idx}"
             self._update_llm_cache(round_idx)
+            if self._batch_config is not None:
+                self._run_batch(round_idx)
             self._evaluator.on_round_test_start(round_id)
 
             self._logger.info(f"[{self._yaml_config['experiment_name']}] Round {round_idx} with parallel level set to {self._num_parallel}.")
@@ -222,7 +345,7 @@ class QaWorkflow:
 
                 # Submit all qa to the executor for question answering
                 future_to_index = {
-                    executor.submit(self.answer, qa, q_idx): q_idx
+                    executor.submit(self._answer_with_tag, qa, q_idx): q_idx
                     for q_idx, qa in enumerate(self._testing_suite)
                 }
 
@@ -250,7 +373,7 @@ class QaWorkflow:
 
                 # Submit all qa to the executor for evaluation
                 evaluation_future_to_index = {
-                    executor.submit(self._evaluator.update_round_metrics, qa): q_idx
+                    executor.submit(self._evaluate_with_tag, qa): q_idx
                     for q_idx, qa in enumerate(qas_with_answer)
                 }
                 for future in as_completed(evaluation_future_to_index):
@@ -268,6 +391,7 @@ class QaWorkflow:
                     self._update_qas_metrics_table(qa)
 
             self._evaluator.on_round_test_end(round_id)
+            self._dump_llm_telemetry(round_idx)
 
         self._evaluator.on_test_end()
 
@@ -280,6 +404,16 @@ class QaWorkflow:
         else:
             return self._multiple_threads_run()
 
+    def _answer_with_tag(self, qa: BaseQaData, question_idx: int) -> dict:
+        # The tag is bound to the calling thread, thus set here instead of around the executor submissions.
+        with llm_call_tag("answer"):
+            return self.answer(qa, question_idx)
+
+    def _evaluate_with_tag(self, qa: BaseQaData) -> None:
+        with llm_call_tag("evaluation"):
+            self._evaluator.update_round_metrics(qa)
+        return
+
     def answer(self, qa: BaseQaData, question_idx: int) -> dict:
         """The decision making process when a Question is given.
 
@@ -289,12 +423,22 @@ class QaWorkflow:
         reference_chunks: List[str] = self._retriever.retrieve_contents(qa, retrieve_id=f"Q{question_idx:03}")
         messages = self._qa_protocol.process_input(content=qa.question, references=reference_chunks, **qa.as_dict())
 
-        response = self._client.generate_content_with_messages(messages, **self.llm_config)
+        response = self._client.generate_content_with_messages(
+            messages,
+            completion_detector=self._qa_protocol.completion_detector(),
+            **self.llm_config,
+        )
         output_dict: dict = self._qa_protocol.parse_output(response, **qa.as_dict())
 
         if "response" not in output_dict:
             output_dict["response"] = response
 
+        if self._qa_protocol.token_budgeter is not None:
+            # Log the references the model was actually sent.
+            budget_result = get_last_budget_result()
+            reference_chunks = [reference_chunks[idx] for idx in budget_result.kept_indices]
+            output_dict["num_references_dropped"] = budget_result.num_references_dropped
+
         if "reference_chunks" not in output_dict:
             output_dict["reference_chunks"] = reference_chunks
 
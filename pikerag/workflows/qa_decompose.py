@@ -4,6 +4,7 @@
 from typing import Dict, List, Tuple
 
 from pikerag.knowledge_retrievers.chunk_atom_retriever import AtomRetrievalInfo, ChunkAtomRetriever
+from pikerag.llm_client.telemetry import llm_call_tag
 from pikerag.utils.config_loader import load_protocol
 from pikerag.utils.logger import Logger
 from pikerag.workflows.common import BaseQaData
@@ -24,6 +25,7 @@ class QaDecompositionWorkflow(QaWorkflow):
             module_path=decompose_proposal_config["module_path"],
             protocol_name=decompose_proposal_config["protocol_name"],
             partial_values=decompose_proposal_config.get("template_partial", {}),
+            token_budget=decompose_proposal_config.get("token_budget", None),
         )
 
         retrieval_info_selection_config = self._yaml_config["selection_protocol"]
@@ -31,6 +33,7 @@ class QaDecompositionWorkflow(QaWorkflow):
             module_path=retrieval_info_selection_config["module_path"],
             protocol_name=retrieval_info_selection_config["protocol_name"],
             partial_values=retrieval_info_selection_config.get("template_partial", {}),
+            token_budget=retrieval_info_selection_config.get("token_budget", None),
         )
 
         backup_retrieval_info_selection_config = self._yaml_config.get("backup_selection_protocol", None)
@@ -41,6 +44,7 @@ class QaDecompositionWorkflow(QaWorkflow):
                 module_path=backup_retrieval_info_selection_config["module_path"],
                 protocol_name=backup_retrieval_info_selection_config["protocol_name"],
                 partial_values=backup_retrieval_info_selection_config.get("template_partial", {}),
+                token_budget=backup_retrieval_info_selection_config.get("token_budget", None),
             )
 
         original_question_answering_config = self._yaml_config["original_question_answering_protocol"]
@@ -48,6 +52,7 @@ class QaDecompositionWorkflow(QaWorkflow):
             module_path=original_question_answering_config["module_path"],
             protocol_name=original_question_answering_config["protocol_name"],
             partial_values=original_question_answering_config.get("template_partial", {}),
+            token_budget=original_question_answering_config.get("token_budget", None),
         )
 
     def _init_retriever(self) -> None:
@@ -66,7 +71,12 @@ class QaDecompositionWorkflow(QaWorkflow):
             content=question,
             chosen_atom_infos=chosen_atom_infos,
         )
-        content = self._client.generate_content_with_messages(messages, **self.llm_config)
+        with llm_call_tag("decompose"):
+            content = self._client.generate_content_with_messages(
+                messages,
+                completion_detector=self._decompose_proposal_protocol.completion_detector(),
+                **self.llm_config,
+            )
         decompose, thinking, question_list = self._decompose_proposal_protocol.parse_output(content)
         return decompose, thinking, question_list
 
@@ -136,7 +146,12 @@ class QaDecompositionWorkflow(QaWorkflow):
             atom_info_candidates=atom_info_candidates,
             chosen_atom_infos=chosen_atom_infos,
         )
-        content = self._client.generate_content_with_messages(messages, **self.llm_config)
+        with llm_call_tag("select_atom"):
+            content = self._client.generate_content_with_messages(
+                messages,
+                completion_detector=self._retrieval_info_selection_protocol.completion_detector(),
+                **self.llm_config,
+            )
         selected, thinking, chosen_atom = self._retrieval_info_selection_protocol.parse_output(content)
 
         if not selected and self._backup_retrieval_info_selection_protocol is not None:
@@ -145,7 +160,12 @@ class QaDecompositionWorkflow(QaWorkflow):
                 atom_info_candidates=atom_info_candidates,
                 chosen_atom_infos=chosen_atom_infos,
             )
-            content = self._client.generate_content_with_messages(messages, **self.llm_config)
+            with llm_call_tag("select_atom_backup"):
+                content = self._client.generate_content_with_messages(
+                    messages,
+                    completion_detector=self._backup_retrieval_info_selection_protocol.completion_detector(),
+                    **self.llm_config,
+                )
             selected, thinking2, chosen_atom = self._backup_retrieval_info_selection_protocol.parse_output(content)
             thinking += "\n" + thinking2
 
@@ -158,7 +178,11 @@ class QaDecompositionWorkflow(QaWorkflow):
             content=question,
             chosen_atom_infos=chosen_atom_infos,
         )
-        response = self._client.generate_content_with_messages(messages, **self.llm_config)
+        response = self._client.generate_content_with_messages(
+            messages,
+            completion_detector=self._original_question_answering_protocol.completion_detector(),
+            **self.llm_config,
+        )
         output = self._original_question_answering_protocol.parse_output(response)
         if "response" not in output:
             output["response"] = response
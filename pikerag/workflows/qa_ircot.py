@@ -19,6 +19,7 @@ class QaIRCoTWorkflow(QaWorkflow):
         self._ircot_protocol = load_protocol(
             module_path=self._yaml_config["ircot_protocol"]["module_path"],
             protocol_name=self._yaml_config["ircot_protocol"]["protocol_name"],
+            token_budget=self._yaml_config["ircot_protocol"].get("token_budget", None),
         )
 
     def answer(self, qa: BaseQaData, question_idx: int) -> Dict:
@@ -39,7 +40,11 @@ class QaIRCoTWorkflow(QaWorkflow):
             messages = self._ircot_protocol.process_input(
                 qa.question, rationales=rationales, references=references, is_limit=False,
             )
-            response = self._client.generate_content_with_messages(messages, **self.llm_config)
+            response = self._client.generate_content_with_messages(
+                messages,
+                completion_detector=self._ircot_protocol.completion_detector(),
+                **self.llm_config,
+            )
             responses.append(response)
             output_dict = self._ircot_protocol.parse_output(response)
 
@@ -55,7 +60,11 @@ class QaIRCoTWorkflow(QaWorkflow):
             messages = self._ircot_protocol.process_input(
                 qa.question, rationales=rationales, references=references, is_limit=True,
             )
-            response = self._client.generate_content_with_messages(messages, **self.llm_config)
+            response = self._client.generate_content_with_messages(
+                messages,
+                completion_detector=self._ircot_protocol.completion_detector(),
+                **self.llm_config,
+            )
             responses.append(response)
             output_dict = self._ircot_protocol.parse_output(response)
             final_answer = output_dict["answer"]
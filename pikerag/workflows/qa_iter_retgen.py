@@ -6,6 +6,8 @@ from typing import Dict, List
 import jsonlines
 from tqdm import tqdm
 
+from pikerag.llm_client.telemetry import llm_call_tag
+from pikerag.prompts import get_last_budget_result
 from pikerag.workflows.common import BaseQaData
 from pikerag.workflows.evaluation.evaluator import Evaluator
 from pikerag.workflows.qa import QaWorkflow
@@ -41,12 +43,22 @@ class QaIterRetgenWorkflow(QaWorkflow):
         chunks: List[str] = self._retriever.retrieve_contents_by_query(query, retrieve_id=f"Q{question_idx:03}")
         messages = self._qa_protocol.process_input(content=qa.question, references=chunks, **qa.as_dict())
 
-        response = self._client.generate_content_with_messages(messages, **self.llm_config)
+        response = self._client.generate_content_with_messages(
+            messages,
+            completion_detector=self._qa_protocol.completion_detector(),
+            **self.llm_config,
+        )
         output_dict: dict = self._qa_protocol.parse_output(response, **qa.as_dict())
 
         if "response" not in output_dict:
             output_dict["response"] = response
 
+        if self._qa_protocol.token_budgeter is not None:
+            # Log the references the model was actually sent.
+            budget_result = get_last_budget_result()
+            chunks = [chunks[idx] for idx in budget_result.kept_indices]
+            output_dict["num_references_dropped"] = budget_result.num_references_dropped
+
         if "reference_chunks" not in output_dict:
             output_dict["reference_chunks"] = chunks
 
@@ -74,7 +86,7 @@ class QaIterRetgenWorkflow(QaWorkflow):
                 references: List[List[str]] = []
 
                 # First Iteration
-                output_dict: dict = self.answer(qa, question_idx)
+                output_dict: dict = self._answer_with_tag(qa, question_idx)
                 # Later Iteration
                 for iter in range(self._num_iteration):
                     for key in ["answer", "rationale", "response", "reference_chunks"]:
@@ -87,7 +99,8 @@ class QaIterRetgenWorkflow(QaWorkflow):
                     if iter == self._num_iteration - 1:
                         break
 
-                    output_dict = self._iter_answer(qa, question_idx, answers, rationales)
+                    with llm_call_tag("iter_answer"):
+                        output_dict = self._iter_answer(qa, question_idx, answers, rationales)
 
                 for iter in range(self._num_iteration):
                     qa.answer_metadata[f"Iter-{iter + 1}"] = {
@@ -98,7 +111,8 @@ class QaIterRetgenWorkflow(QaWorkflow):
                     }
 
                     qa.update_answer(answers[iter])
-                    self._evaluator_list[iter].update_round_metrics(qa)
+                    with llm_call_tag("evaluation"):
+                        self._evaluator_list[iter].update_round_metrics(qa)
                     fout_list[iter].write(qa.as_dict())
 
                 self._update_qas_metrics_table(qa)
@@ -107,6 +121,7 @@ class QaIterRetgenWorkflow(QaWorkflow):
 
             for evaluator in self._evaluator_list:
                 evaluator.on_round_test_end(round_id)
+            self._dump_llm_telemetry(round_idx)
 
         for evaluator in self._evaluator_list:
             evaluator.on_test_end()
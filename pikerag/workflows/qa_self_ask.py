@@ -22,6 +22,7 @@ class QaSelfAskWorkflow(QaWorkflow):
             module_path=self._yaml_config["followup_qa_protocol"]["module_path"],
             protocol_name=self._yaml_config["followup_qa_protocol"]["protocol_name"],
             partial_values=self._yaml_config["followup_qa_protocol"].get("template_partial", {}),
+            token_budget=self._yaml_config["followup_qa_protocol"].get("token_budget", None),
         )
 
     def _answer_followup_question(self, followup: str, retrieve_id: str) -> Tuple[str, List[str]]: